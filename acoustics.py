@@ -0,0 +1,64 @@
+# Copyright 2007 Benjamin M. Schwartz
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Properties of air that do not need the signal processing in arange, for
+the parts of the activity that start before it is loaded.
+"""
+
+import math
+
+
+def speed_of_sound(t=25.0, h=0.6, p=101325.0, x_c=0.0004):
+    """
+    t= temperature in Celsius
+    h = relative humidity as a fraction
+    p = pressure in Pa
+    x_c = mole fraction of CO2
+    returns an estimate of the speed of sound in (m/s)
+    from Cramer, O. "The variation of the specific heat ratio and the
+    speed of sound in air with temperature, pressure, humidity, and
+    CO2 concentration". Journal of the Acoustical Society of America,
+    1993, Vol. 93, Issue 5, p. 2510, eq. 15 and A1-A3."""
+
+    a0 = 331.5024
+    a1 = 0.603055
+    a2 = -0.000528
+    a3 = 51.471935
+    a4 = 0.1495874
+    a5 = -0.000782
+    a6 = -1.82e-7
+    a7 = 3.73e-8
+    a8 = -2.93e-10
+    a9 = -85.20931
+    a10 = -0.228525
+    a11 = 5.91e-5
+    a12 = -2.835149
+    a13 = -2.15e-13
+    a14 = 29.179762
+    a15 = 0.000486
+
+    t2 = t**2
+    T = t + 273.15
+
+    f = 1.00062 + 3.14e-8 * p + 5.6e-7 * t2
+    psv = math.exp(1.2811805e-5 * (T**2) - 1.9509874e-2 * T +
+                   34.04926034 - 6.3536311e3 / T)  # Pa
+    x_w = h * f * psv / p
+
+    return a0 + a1 * t + a2 * t2 + (a3 + a4 * t + a5 * t2) * x_w \
+        + (a6 + a7 * t + a8 * t2) * p + (a9 + a10 * t + a11 * t2) * x_c \
+        + a12 * (x_w**2) + a13 * (p**2) + a14 * (x_c**2) + a15 * x_w * p * x_c
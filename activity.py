@@ -22,7 +22,6 @@ import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('TelepathyGLib', '0.12')
 
-from gi.repository import TelepathyGLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
@@ -40,14 +39,15 @@ from sugar3.presence import presenceservice
 from gettext import gettext as _
 
 # For socket code
-import threading
-import thread
 import socket
+import errno
 import os
 import os.path
-import dbus
+import shutil
+import time
 
-import arange
+# TelepathyGLib, dbus and the measurement modules, with numpy, are
+# imported when first needed, after the window is up
 import atm_toolbars
 import smoot_toolbar
 
@@ -56,20 +56,6 @@ IFACE = SERVICE
 PATH = "/org/laptop/AcousticMeasure"
 
 
-def gobject_idle_do(func, *args):
-    ev = threading.Event()
-    retval = []
-
-    def helper(r, f, a, e):
-        r.append(f(*a))
-        e.set()
-        return False
-
-    GObject.idle_add(helper, retval, func, args, ev)
-    ev.wait()
-    return retval[0]
-
-
 class AcousticMeasureActivity(activity.Activity):
     '''AcousticMeasure Activity: Uses sound propagation delay to
     measure distance'''
@@ -152,23 +138,36 @@ class AcousticMeasureActivity(activity.Activity):
         self.set_toolbar_box(toolbar_box)
         toolbar_box.show()
 
-        if not self.powerd_running():
-            try:
-                bus = dbus.SystemBus()
-                proxy = bus.get_object('org.freedesktop.ohm',
-                                       '/org/freedesktop/ohm/Keystore')
-                self.ohm_keystore = dbus.Interface(
-                    proxy, 'org.freedesktop.ohm.Keystore')
-            except dbus.DBusException as e:
-                self._logger.warning("Error setting OHM inhibit: %s" % e)
-                self.ohm_keystore = None
+        # found once the window is up, as the system bus can be slow
+        self.using_powerd = False
+        self.ohm_keystore = None
+        GObject.idle_add(self._setup_suspend)
 
         # distance in meters
         self.current_distance = 0.0
-
-        # worker thread
-        self._button_event = threading.Event()
-        thread.start_new_thread(self._helper_thread, ())
+        # distance in meters between each pair of laptops, numbered by the
+        # sharer, and the number of this one
+        self.distance_matrix = None
+        self.device_index = None
+
+        # every measurement of this session, and of the sessions it
+        # resumes, saved in the Journal entry after the text.  The file
+        # is opened by the first measurement, and until then only copied.
+        self._history_path = os.path.join(
+            sugar3.activity.activity.get_activity_root(), 'instance',
+            'history')
+        if os.path.exists(self._history_path):
+            os.remove(self._history_path)
+        self._history = None
+
+        # phase name -> [count, total seconds], over all measurements
+        self._phase_totals = {}
+
+        # set up by _load_measurement, once sharing starts
+        self._adaptive = None
+        self._loop = None
+        self._task = None
+        self._ui = None
 
         # Main Panel GUI
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -183,8 +182,6 @@ Waiting for partner to be ready.")
         self._message_dict['playing'] = _("Recording sound from each laptop.")
         self._message_dict['processing'] = _("Processing recorded audio.")
         self._message_dict['done'] = self._message_dict['ready']
-        self._message_dict['full'] = _("This activity already has two \
-participants, so you cannot join.")
 
         self._button_dict['waiting'] = _("Begin Measuring Distance")
         self._button_dict['going'] = _("Stop Measuring Distance")
@@ -200,14 +197,13 @@ participants, so you cannot join.")
         self.message.set_selectable(True)
         self.message.set_single_line_mode(True)
 
+        # drawn once the window is up
         img = Gtk.Image()
-        pb = GdkPixbuf.Pixbuf.new_from_file(
-            sugar3.activity.activity.get_bundle_path() + '/dist.svg')
-        img.set_from_pixbuf(pb)
+        GObject.idle_add(self._load_image, img)
 
         self.value = Gtk.Label()
         self.value.set_selectable(True)
-        thread.start_new_thread(self._update_distance, (0, ))
+        self._update_distance(0)
 
         valuefont = Pango.FontDescription()
         valuefont.set_family("monospace")
@@ -243,6 +239,9 @@ participants, so you cannot join.")
         self.server_socket = None
         self.main_socket = None
         self.main_socket_addr = None
+        self.main_channel = None
+        # the sharer's connection to each laptop that joined
+        self.peer_channels = []
         self.main_tube_id = None
         self.initiating = False
 
@@ -258,6 +257,50 @@ participants, so you cannot join.")
 
         self.connect('key-press-event', self._keypress_cb)
 
+    def _load_image(self, img):
+        pb = GdkPixbuf.Pixbuf.new_from_file(
+            sugar3.activity.activity.get_bundle_path() + '/dist.svg')
+        img.set_from_pixbuf(pb)
+        return False
+
+    def _setup_suspend(self):
+        if not self.powerd_running():
+            import dbus
+            try:
+                bus = dbus.SystemBus()
+                proxy = bus.get_object('org.freedesktop.ohm',
+                                       '/org/freedesktop/ohm/Keystore')
+                self.ohm_keystore = dbus.Interface(
+                    proxy, 'org.freedesktop.ohm.Keystore')
+            except dbus.DBusException as e:
+                self._logger.warning("Error setting OHM inhibit: %s" % e)
+                self.ohm_keystore = None
+        return False
+
+    def _load_measurement(self):
+        """Imports and starts what measuring needs, the first time only"""
+        if self._loop is not None:
+            return
+        import arange
+        import engine
+
+        # MLS order for the next measurement, agreed with the other laptops
+        self._adaptive = arange.AdaptiveOrder()
+
+        # measurements run as coroutines on the GLib main loop, so they
+        # can update the interface directly
+        self._loop = engine.GLibLoop()
+        # labels are updated once a frame, with the latest text only, so
+        # that the measurement never waits for the interface
+        self._ui = engine.Dispatcher(self._loop)
+
+    def _show(self, key, fn, *args):
+        """Updates the interface, through the dispatcher once there is one"""
+        if self._ui is None:
+            fn(*args)
+        else:
+            self._ui.post(key, fn, *args)
+
     def powerd_running(self):
         self.using_powerd = os.access(POWERD_INHIBIT_DIR, os.W_OK)
         self._logger.debug("using_powerd: %d" % self.using_powerd)
@@ -272,6 +315,7 @@ participants, so you cannot join.")
             return True
 
         if self.ohm_keystore is not None:
+            import dbus
             try:
                 self.ohm_keystore.SetKey('suspend.inhibit', 1)
                 return self.ohm_keystore.GetKey('suspend.inhibit')
@@ -289,6 +333,7 @@ participants, so you cannot join.")
             return True
 
         if self.ohm_keystore is not None:
+            import dbus
             try:
                 self.ohm_keystore.SetKey('suspend.inhibit', 0)
                 return self.ohm_keystore.GetKey('suspend.inhibit')
@@ -298,44 +343,154 @@ participants, so you cannot join.")
         else:
             return False
 
+    def can_close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._loop is not None:
+            import arange
+            # Stop the capture that runs between measurements
+            arange.backend.close()
+            arange.stop_workers()
+        return True
+
     def _button_clicked(self, button):
         if button.get_active():
             self._inhibit_suspend()
-            self._button_event.set()
-            self._logger.debug("button_clicked: self._button_event.isSet(): "
-                               + str(self._button_event.isSet()))
             button.set_label(self._button_dict['going'])
+            if self._task is None or self._task.done():
+                import engine
+                self._load_measurement()
+                self._task = engine.Task(self._loop, self._measure_loop())
         else:
-            self._button_event.clear()
+            # the measurement under way is finished first
             self._allow_suspend()
             button.set_label(self._button_dict['waiting'])
 
-    def _helper_thread(self):
-        self._logger.debug("helper_thread starting")
-        while True:
-            self._logger.debug("helper_thread: button_event.isSet(): "
-                               + str(self._button_event.isSet()))
-            self._button_event.wait()
+    def _measure_loop(self):
+        import arange
+        import engine
+        self._logger.debug("measure_loop starting")
+        while self.button.get_active():
             self._logger.debug("initiating measurement")
-            dt = arange.measure_dt_seq(self.main_socket, self.initiating,
-                                       self._change_message)
-            x = dt * self._t_h_bar.get_speed() - arange.OLPC_OFFSET
-            self.current_distance = x
-            self._update_distance(x)
+            if self.initiating:
+                s = self._live_peers()
+                if not s:
+                    self._logger.error("no laptop left to measure")
+                    self.button.set_active(False)
+                    self._change_message('ready')
+                    continue
+            try:
+                if not self.initiating:
+                    stats = yield engine.follow(
+                        self.main_channel, send_signal=self._change_message,
+                        send_event=self._phase_event, adaptive=self._adaptive)
+                elif len(s) == 1:
+                    # two laptops take turns, which needs no time slots
+                    stats = yield engine.measure_pair(
+                        s[0], True, rounds=arange.BURST_ROUNDS,
+                        send_signal=self._change_message,
+                        send_event=self._phase_event, adaptive=self._adaptive)
+                else:
+                    stats = yield engine.measure_matrix(
+                        s, True, rounds=arange.BURST_ROUNDS,
+                        send_signal=self._change_message,
+                        send_event=self._phase_event, adaptive=self._adaptive)
+            except arange.ProtocolError as e:
+                # A partner left, took too long to answer or runs an
+                # incompatible version
+                self._logger.error("measurement failed: %s" % e)
+                self._measurement_failed()
+                continue
+            except (IOError, socket.error, ValueError):
+                # the sound device failed, or a recording could not be
+                # analysed
+                self._logger.exception("measurement failed")
+                self._measurement_failed()
+                continue
+            speed = self._t_h_bar.get_speed()
+            n = stats['n']
+            me = stats['index']
+            self.device_index = me
+            self.distance_matrix = [
+                [stats['median'][i][j] * speed - arange.OLPC_OFFSET
+                 if i != j else 0.0 for j in xrange(n)] for i in xrange(n)]
+            if n == 2:
+                other = 1 - me
+                x = self.distance_matrix[me][other]
+                # Half the width of the confidence interval of the median
+                spread = (stats['high'][me][other]
+                          - stats['low'][me][other]) / 2 * speed
+                self.current_distance = x
+                self._update_distance(x, spread)
+            else:
+                row = self.distance_matrix[me]
+                self.current_distance = min(row[:me] + row[me + 1:])
+                self._update_distances(row[:me] + row[me + 1:])
+            self._record(stats, speed)
+
+    def _measurement_failed(self):
+        """Stops measuring after a failed measurement"""
+        if self.initiating:
+            self._live_peers()
+        self.button.set_active(False)
+        self._change_message('ready')
 
-    def _update_distance(self, x):
+    def _record(self, stats, speed):
+        """Adds the result for each other laptop to the history"""
+        import history
+        if self._history is None:
+            try:
+                self._history = history.History(self._history_path)
+            except history.HistoryError as e:
+                self._logger.error("cannot resume the history: %s" % e)
+                os.remove(self._history_path)
+                self._history = history.History(self._history_path)
+        me = stats['index']
+        now = time.time()
+        for j in xrange(stats['n']):
+            if j == me:
+                continue
+            self._history.append(
+                time=now, dt=stats['median'][me][j],
+                distance=self.distance_matrix[me][j],
+                spread=(stats['high'][me][j] - stats['low'][me][j]) / 2
+                * speed,
+                speed=speed, own_peak=stats['peak'][me],
+                peer_peak=stats['peak'][j], psr=stats['psr'],
+                ppm=stats['ppm'][me][j], rounds=stats['rounds'],
+                order=stats['order'], devices=stats['n'], device=me, peer=j)
+        self._history.flush()
+
+    def _update_distance(self, x, spread=None):
         scale = self._smoot_bar.get_scale()
         mes = locale.format("%.2f", x * scale)
-        gobject_idle_do(self.value.set_text, mes)
+        if spread is not None:
+            mes += " \xc2\xb1 " + locale.format("%.2f", spread * scale)
+        self._show('value', self.value.set_text, mes)
+
+    def _update_distances(self, distances):
+        """Shows the distance to each of the other laptops, in order"""
+        scale = self._smoot_bar.get_scale()
+        mes = " / ".join([locale.format("%.2f", x * scale)
+                          for x in distances])
+        self._show('value', self.value.set_text, mes)
 
     def read_file(self, file_path):
-        f = open(file_path, 'r')
-        L = f.readlines()
-        f.close()
+        f = open(file_path, 'rb')
+        L = [f.readline() for i in xrange(3)]
         text = L[0][:-1]  # Strip trailing "\n"
         t = locale.atof(L[1][:-1])
         h = locale.atof(L[2][:-1])
-        self.value.set_text(text)
+        # the history follows, in entries saved since it was added; it is
+        # only copied now, and opened by the next measurement
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+        history_file = open(self._history_path, 'wb')
+        shutil.copyfileobj(f, history_file)
+        history_file.close()
+        f.close()
+        self._show('value', self.value.set_text, text)
         self._t_h_bar.set_temp(t)
         self._t_h_bar.set_humid(h)
 
@@ -346,16 +501,47 @@ participants, so you cannot join.")
         h = locale.str(self._t_h_bar.get_humid())
         self.metadata['fulltext'] = text
 
-        f = open(file_path, 'w')
+        f = open(file_path, 'wb')
         f.writelines([text + "\n", t + "\n", h + "\n"])
+        if self._history is not None:
+            self._history.save(f)
+        elif os.path.exists(self._history_path):
+            history_file = open(self._history_path, 'rb')
+            shutil.copyfileobj(history_file, f)
+            history_file.close()
         f.close()
 
     def _change_message(self, signal):
         self._logger.debug("_change_message got signal: " + signal)
-        gobject_idle_do(self.message.set_text, self._message_dict[signal])
+        self._show('message', self.message.set_text,
+                   self._message_dict[signal])
+
+    def _phase_event(self, event):
+        if event['previous'] is not None:
+            totals = self._phase_totals.setdefault(event['previous'], [0, 0])
+            totals[0] += 1
+            totals[1] += event['duration']
+            self._logger.debug("phase %s took %.3f s" %
+                               (event['previous'], event['duration']))
+        if event['phase'] == 'done':
+            self._logger.debug("measurement: %r" % event)
+            lines = []
+            for phase in ('preparing', 'waiting', 'playing', 'processing'):
+                if phase in self._phase_totals:
+                    (n, total) = self._phase_totals[phase]
+                    lines.append(_("%(phase)s: %(mean).3f s (mean of %(n)i)")
+                                 % {'phase': phase, 'mean': total / n,
+                                    'n': n})
+            self._show('tooltip', self.fr.set_tooltip_text,
+                       '\n'.join(lines))
+            self._logger.debug("interface updates: %r" % self._ui.stats())
 
     def _shared_cb(self, activity):
+        from gi.repository import TelepathyGLib
+        import dbus
+        import engine
         self._logger.debug('My activity was shared')
+        self._load_measurement()
         self.initiating = True
         self._sharing_setup()
 
@@ -376,18 +562,48 @@ participants, so you cannot join.")
             dbus.ByteArray(f), TelepathyGLib.SocketAccessControl.LOCALHOST,
             "")
 
-        thread.start_new_thread(self.watch_for_join, ())
+        engine.Task(self._loop, self.watch_for_join())
+
+    def _live_peers(self):
+        """
+        Drops the connections to laptops that left, or whose connection
+        broke, from peer_channels and returns the others, in the order of
+        their device numbers
+        """
+        live = []
+        for channel in self.peer_channels:
+            if channel.alive():
+                live.append(channel)
+            else:
+                self._logger.debug("dropping a closed connection")
+                channel.sock.close()
+        self.peer_channels = live
+        return list(live)
 
     def watch_for_join(self):
-        self.server_socket.listen(1)
-        (self.main_socket, self.main_socket_addr) = self.server_socket.accept()
-        self.main_socket.setblocking(1)
-        # don't know if this works with Telepathy's pseudosockets
-        # self.server_socket.close()
-
-        self._make_ready()
+        import engine
+        self.server_socket.listen(5)
+        while True:
+            try:
+                (conn, addr) = yield engine.accept(self._loop,
+                                                   self.server_socket)
+            except socket.error as e:
+                self._logger.error("cannot accept a connection: %s" % e)
+                if e.args[0] not in (errno.ECONNABORTED, errno.EINTR,
+                                     errno.EMFILE, errno.ENFILE,
+                                     errno.ENOBUFS, errno.ENOMEM):
+                    return
+                # out of resources for now, or a laptop that gave up
+                yield engine.sleep(self._loop, 1.0)
+                continue
+            # every laptop that joins takes part in the next measurement
+            self.peer_channels.append(engine.AsyncChannel(self._loop, conn))
+            if self.main_socket is None:
+                (self.main_socket, self.main_socket_addr) = (conn, addr)
+                self._make_ready()
 
     def _sharing_setup(self):
+        from gi.repository import TelepathyGLib
         if self.shared_activity is None:
             self._logger.error('Failed to share or join activity')
             return
@@ -417,33 +633,29 @@ participants, so you cannot join.")
         self._logger.error('ListTubes() failed: %s', e)
 
     def _joined_cb(self, activity):
+        from gi.repository import TelepathyGLib
         if not self.shared_activity:
             return
+        self._load_measurement()
 
         # Find out who's already in the shared activity:
-        n = 0
         for buddy in self.shared_activity.get_joined_buddies():
-            n += 1
             self._logger.debug('Buddy %s is already in the activity' %
                                buddy.props.nick)
 
-        if n <= 2:
-            self._logger.debug('Joined an existing shared activity')
-            self.initiating = False
-            self._sharing_setup()
+        self._logger.debug('Joined an existing shared activity')
+        self.initiating = False
+        self._sharing_setup()
 
-            self._logger.debug(
-                'This is not my activity: waiting for a tube...')
-            self.tubes_chan[TelepathyGLib.IFACE_CHANNEL_TYPE_TUBES].ListTubes(
-                reply_handler=self._list_tubes_reply_cb,
-                error_handler=self._list_tubes_error_cb)
-        else:
-            self._logger.debug("There are already two people, not joining")
-            self.shared_activity.leave()
-            thread.start_new_thread(self._change_message, ('full',))
+        self._logger.debug(
+            'This is not my activity: waiting for a tube...')
+        self.tubes_chan[TelepathyGLib.IFACE_CHANNEL_TYPE_TUBES].ListTubes(
+            reply_handler=self._list_tubes_reply_cb,
+            error_handler=self._list_tubes_error_cb)
 
     def _new_tube_cb(self, tube_id, initiator, tube_type, service, params,
                      state):
+        from gi.repository import TelepathyGLib
         self._logger.debug('New tube: ID=%d initator=%d type=%d service=%s '
                            'params=%r state=%d', tube_id, initiator, tube_type,
                            service, params, state)
@@ -458,6 +670,8 @@ participants, so you cannot join.")
                     byte_arrays=True))
 
     def _tube_state_cb(self, tube_id, tube_state):
+        from gi.repository import TelepathyGLib
+        import engine
         if (self.main_socket is None) and \
             (tube_state == TelepathyGLib.TubeState.OPEN) and \
                 (tube_id == self.main_tube_id):
@@ -466,10 +680,12 @@ participants, so you cannot join.")
                 socket.AF_UNIX, socket.SOCK_STREAM)
             self.main_socket.setblocking(1)
             self.main_socket.connect(self.main_socket_addr)
-            thread.start_new_thread(self._make_ready, ())
+            self.main_channel = engine.AsyncChannel(self._loop,
+                                                    self.main_socket)
+            self._make_ready()
 
     def _make_ready(self):
-        gobject_idle_do(self.button.set_sensitive, True)
+        self.button.set_sensitive(True)
         self._change_message('ready')
 
     def _buddy_joined_cb(self, activity, buddy):
@@ -477,9 +693,13 @@ participants, so you cannot join.")
 
     def _buddy_left_cb(self, activity, buddy):
         self._logger.debug('Buddy %s left' % buddy.props.nick)
+        # a measurement under way finds out for itself
+        if self.initiating and (self._task is None or self._task.done()):
+            self._live_peers()
 
     def _get_buddy(self, cs_handle):
         '''Get a Buddy from a channel specific handle.'''
+        from gi.repository import TelepathyGLib
         self._logger.debug('Trying to find owner of handle %u...', cs_handle)
         group = self.text_chan[TelepathyGLib.IFACE_CHANNEL_INTERFACE_GROUP]
         my_csh = group.GetSelfHandle()
@@ -27,6 +27,16 @@ import subprocess
 import os
 import os.path
 import signal
+import sys
+import threading
+import fractions
+import mmap
+import multiprocessing
+import multiprocessing.pool
+from collections import OrderedDict
+
+import archive
+from acoustics import speed_of_sound
 
 REC_HZ = 48000
 MLS_INDEX = 14
@@ -34,20 +44,121 @@ MLS_INDEX = 14
 OLPC_OFFSET = -0.05  # Measured constant offset due to geometry and electronics
 
 REC_TIMEOUT = 10  # Max number of seconds to record before stopping
+RING_SECONDS = 2 * REC_TIMEOUT  # Length of the CaptureRing buffer
+RING_WAIT = 1.0  # Max seconds to wait for samples from the CaptureRing
 
-cache_dict = {}
+USE_FHT = True  # Correlate with the fast Hadamard transform, not the FFT
+STREAM_CORRELATION = True  # Correlate measure_dt_seq while recording
+PEAK_INTERPOLATION = 'sinc'  # 'sinc', 'parabolic', 'gaussian' or None
+PEAK_HALFWIDTH = 8  # Samples each side of a peak used to interpolate it
+PRECISION = 'float64'  # or 'float32', to save memory; see README.md
 
+# measure_dt_seq's adaptive mode looks for the shortest MLS order whose
+# peaks stand this many times above the correlation noise floor.
+ADAPTIVE_TARGET_PSR = 8.0
+ADAPTIVE_MIN_ORDER = 10
+ADAPTIVE_MAX_ORDER = 16
 
-def compute_mls(R):
+# The two correlations of a measurement can run in parallel on a pool of
+# WORKERS 'thread' or 'process' workers; 0 runs them one after the other.
+# A process pool must be started by start_workers before any other thread.
+WORKERS = 0
+WORKER_POOL = 'thread'
+
+SIMUL_MIN_PSR = 8.0  # Separation below which measure_dt_simul falls back
+SIMUL_CANCEL_TAPS = 256  # Length of the impulse response cancelled
+
+DRIFT_COMPENSATION = True  # Correct for the peers' sample clocks differing
+DRIFT_MAX_PPM = 300.0  # Largest difference (parts per million) looked for
+ARCHIVE_DIR = None  # Where to keep the recording of each measurement, or None
+
+BURST_ROUNDS = 5  # Rounds in a measure_dt_burst
+MATRIX_GUARD = 0.25  # Silence (s) before and after each measure_dt_matrix slot
+BURST_TRIM = 0.2  # Fraction trimmed from each end for the trimmed mean
+
+CACHE_MAX_BYTES = 32 * 2**20  # Budget for sequences, spectra and tables
+
+
+class ArrayCache(object):
     """
-    Computes a Maximum-Length-Sequence using a naive LFSR approach
-    for n=3...32. R is the register initializer (cannot be all-zero) which
-    determines the phase of the MLS.
+    A thread-safe least-recently-used cache whose budget is the total size
+    in bytes of the stored values (numpy arrays, or tuples of them), not
+    the number of entries.  Values must not be modified once stored.
     """
 
-    # 1-indexed collection of MLS taps from
-    # http://homepage.mac.com/afj/taplist.html
-    taps = ((), (), (),  # ignore n=0,1,2
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _sizeof(self, value):
+        if hasattr(value, 'nbytes'):
+            return value.nbytes
+        if isinstance(value, tuple):
+            return sum([self._sizeof(v) for v in value])
+        return sys.getsizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                # Re-insert to mark the entry as most recently used
+                entry = self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self.nbytes + size > self.max_bytes:
+                (k, (v, s)) = self._entries.popitem(last=False)
+                self.nbytes -= s
+                self.evictions += 1
+            self._entries[key] = (value, size)
+            self.nbytes += size
+
+    def fetch(self, key, compute):
+        """
+        Returns the value stored under key, or stores and returns compute()
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Returns a dict of the cache size and hit/miss/eviction counters"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+cache = ArrayCache(CACHE_MAX_BYTES)
+
+
+# 1-indexed collection of MLS taps from
+# http://homepage.mac.com/afj/taplist.html
+MLS_TAPS = ((), (), (),  # ignore n=0,1,2
             (3, 2),
             (4, 3),
             (5, 3),
@@ -79,8 +190,56 @@ def compute_mls(R):
             (31, 28),
             (32, 31, 30, 10))
 
+
+def compute_mls(R):
+    """
+    Computes a Maximum-Length-Sequence for n=3...32.  R is the register
+    initializer (cannot be all-zero) which determines the phase of the MLS.
+    The output is identical to that of the naive LFSR, but is generated
+    in blocks by LFSR_blocks.
+    """
     n = len(R)
-    return LFSR(R, [i - 1 for i in taps[n]], 2**n - 1)
+    return LFSR_blocks(R, [i - 1 for i in MLS_TAPS[n]], 2**n - 1)
+
+
+def LFSR_blocks(R, taps, m):
+    """
+    Computes the same output as LFSR(R, taps, m), but many samples at a time.
+
+    The output bits o[i] of the shift register obey the linear recurrence
+    o[i] = XOR(o[i - 1 - t] for t in taps).  Over GF(2), p(x)**(2**k) equals
+    p(x**(2**k)), so the same sequence also obeys the recurrence with every
+    lag multiplied by 2**k.  Once enough history exists, each pass of the
+    loop below uses the largest such stretched recurrence and produces a
+    whole block of output with a few vectorized XORs.  The number of passes
+    grows only logarithmically with m.
+
+    R = an indexable object, left in the state it would have after m steps
+    taps = zero-indexed collection of taps
+
+    returns a num.array of length m
+    """
+    n = len(R)
+    lags = [t + 1 for t in taps]
+    min_lag = min(lags)
+    total = m + n
+    o = num.zeros((total), num.bool)
+    # The first n outputs are the initial register contents, last first.
+    o[:n] = num.asarray(R, num.bool)[::-1]
+    filled = n
+    while filled < total:
+        scale = 1
+        while 2 * scale * n <= filled:
+            scale *= 2
+        end = min(filled + scale * min_lag, total)
+        block = o[filled - scale * lags[0]:end - scale * lags[0]].copy()
+        for lag in lags[1:]:
+            block ^= o[filled - scale * lag:end - scale * lag]
+        o[filled:end] = block
+        filled = end
+    # After m steps the register holds the next n outputs, newest first.
+    R[:] = o[m:total][::-1]
+    return o[:m]
 
 
 def LFSR(R, taps, m):
@@ -122,6 +281,18 @@ def LFSR(R, taps, m):
     return o
 
 
+def render_samples(o):
+    """
+    Renders a [0,1]-scaled array o into the left channel of 8-bit unsigned
+    stereo frames at REC_HZ, returned as a string
+    """
+    n = num.size(o)
+    q = num.zeros((2 * n), num.uint8)
+    q[::2] = o * 255
+    q[1::2] = 128
+    return q.tostring()
+
+
 def write_wav(o):
     """
     Writes a [0,1]-scaled array o into the left channel of a 8-bit stereo
@@ -130,11 +301,7 @@ def write_wav(o):
     f = tempfile.NamedTemporaryFile(mode='wb', prefix='out')
     w = wave.open(f)
     w.setparams((2, 1, REC_HZ, 0, 'NONE', 'NONE'))
-    n = num.size(o)
-    q = num.zeros((2 * n), num.uint8)
-    q[::2] = o * 255
-    q[1::2] = 128
-    w.writeframes(q.tostring())
+    w.writeframes(render_samples(o))
     return f
 
 
@@ -145,22 +312,42 @@ def play_wav_alsa(fname):
 play_wav = play_wav_alsa
 
 
-def record_while_playing(play_name, t):
+def play_samples_alsa(frames):
+    """
+    Plays frames from render_samples by streaming them to aplay's standard
+    input, so nothing touches the filesystem.  Like play_wav, it returns
+    once playback has finished.
     """
-    This function starts recording, plays the file named 'play_name',
+    player = subprocess.Popen(
+        [
+            "/usr/bin/aplay",
+            "--file-type=raw",
+            "--channels=2",
+            "--format=U8",
+            "--rate=%i" %
+            REC_HZ,
+            "-"],
+        stdin=subprocess.PIPE)
+    player.communicate(frames)
+
+
+def record_while_playing(frames, t):
+    """
+    This function starts recording, plays the frames from render_samples,
     waits a time t (s) after playback has finished, then stops recording.
-    It returns a filehandle to a WAV file containing the recording.
+    It returns the recording made by the audio backend.
     """
-    (recorder, f) = start_recording()
-    if play_name:
-        play_wav(play_name)
+    recording = backend.start_recording()
+    if frames:
+        backend.play(frames)
     time.sleep(t)
-    stop_recording(recorder)
-    return f
+    backend.stop_recording(recording)
+    return recording
 
 
 def start_recording_alsa():
-    fname = os.tempnam()
+    (fd, fname) = tempfile.mkstemp(suffix='.raw')
+    os.close(fd)
 
     rec_process = subprocess.Popen(
         [
@@ -175,7 +362,7 @@ def start_recording_alsa():
             fname])
 
     s = 0
-    while s <= 0:
+    while s <= 0 and rec_process.poll() is None:
         try:
             s = os.path.getsize(fname)
         except os.error:
@@ -185,64 +372,686 @@ def start_recording_alsa():
     return (rec_process, f)
 
 
-start_recording = start_recording_alsa
-
-
 def stop_recording_alsa(rec_process):
     os.kill(rec_process.pid, signal.SIGKILL)
     rec_process.wait()
 
 
-stop_recording = stop_recording_alsa
-
-
-def read_wav(f):
+def read_wav(f, dtype=None):
     """
-    Reads one channel of a .wav file object (f) into a float array, unscaled
+    Reads one channel of a .wav file object (f) into an array, unscaled.
+    The samples are a strided view of the file data, as int16 or int8,
+    unless dtype (e.g. num.float) asks for a converted copy.
     """
     w = wave.open(f)
     n = w.getnframes()
     nc = w.getnchannels()
     b = w.getsampwidth()
     if b == 2:
-        typecode = 'h'
+        typecode = '<i2'
     elif b == 1:
-        typecode = 'b'
+        typecode = 'i1'
     s = w.readframes(n)
     n = len(s) / (nc * b)
-    a = struct.unpack('<' + str(n * nc) + typecode, s)
-    return num.array(a[::nc], num.float)
+    a = num.frombuffer(s, typecode, n * nc)[::nc]
+    if dtype is not None:
+        return a.astype(dtype)
+    return a
 
 
-def read_raw(f):
+def read_raw(f, dtype=None):
+    """
+    Reads a raw S16_LE recording from the file object f.  The result is an
+    int16 view of the data read, converted only if dtype is given.
+    """
     x = f.read()
     n = len(x) / 2
-    print "length " + str(n)
-    typecode = 'h'
-    a = struct.unpack('<' + str(n) + typecode, x[:(2 * n)])
-    return num.array(a, num.float)
+    a = num.frombuffer(x, '<i2', n)
+    if dtype is not None:
+        return a.astype(dtype)
+    return a
 
 
 read_recorded_file = read_raw
 
 
+class AudioBackend(object):
+    """
+    The sound input and output used by a measurement.  Subclasses provide
+    play, start_recording and stop_recording.  A recording returned by
+    start_recording provides read_available(), which returns the int16
+    samples captured since the previous call without blocking, read(dtype),
+    which returns all the samples not yet returned, and close().
+    """
+
+    def play(self, frames):
+        """Plays frames from render_samples, returning when done"""
+        raise NotImplementedError
+
+    def start_recording(self):
+        """Starts recording and returns the recording"""
+        raise NotImplementedError
+
+    def stop_recording(self, recording):
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any sound device held between measurements"""
+        pass
+
+
+class AlsaRecording(object):
+    """A raw capture written to a file by arecord"""
+
+    def __init__(self):
+        (self.process, self.file) = start_recording_alsa()
+        self._rest = ''
+
+    def read_available(self):
+        data = self._rest + os.read(self.file.fileno(), 1 << 16)
+        n = len(data) / 2
+        self._rest = data[2 * n:]
+        return num.frombuffer(data, '<i2', n)
+
+    def read(self, dtype=None):
+        return read_recorded_file(self.file, dtype)
+
+    def close(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+
+class AlsaBackend(AudioBackend):
+    """Plays through aplay and records through arecord"""
+
+    def play(self, frames):
+        play_samples_alsa(frames)
+
+    def start_recording(self):
+        return AlsaRecording()
+
+    def stop_recording(self, recording):
+        stop_recording_alsa(recording.process)
+
+
+class CaptureRing(object):
+    """
+    A long-lived arecord process whose output fills an in-memory ring
+    buffer of the last seconds of sound.  Samples are indexed by their
+    position in the capture since start(), and the arrival time of each
+    block is kept, so that an index can be mapped to a monotonic time.
+    """
+
+    def __init__(self, seconds=RING_SECONDS, blocksize=1024):
+        self.size = int(seconds * REC_HZ)
+        self.blocksize = blocksize
+        self._buffer = num.zeros(self.size, num.int16)
+        self._cond = threading.Condition()
+        self._process = None
+        self._thread = None
+        self.written = 0  # Index of the next sample to be captured
+        self._stamp = None  # (index, monotonic time) of the latest block
+
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        if self.running():
+            return
+        self._process = subprocess.Popen(
+            ["/usr/bin/arecord",
+             "--file-type=raw",
+             "--channels=1",
+             "--format=S16_LE",
+             "--rate=%i" % REC_HZ,
+             "--buffer-size=%i" % (4 * self.blocksize),
+             "-"],
+            stdout=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._reader,
+                                        args=(self._process.stdout,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+        self._thread.join()
+        self._process = None
+
+    def _reader(self, pipe):
+        rest = ''
+        while True:
+            data = os.read(pipe.fileno(), 2 * self.blocksize)
+            if not data:
+                break
+            data = rest + data
+            n = len(data) / 2
+            rest = data[2 * n:]
+            self.append(num.frombuffer(data, '<i2', n), monotonic())
+        pipe.close()
+        with self._cond:
+            self._cond.notify_all()
+
+    def append(self, samples, t):
+        """Adds samples, the last of which was captured at time t"""
+        chunk = samples[-self.size:]
+        with self._cond:
+            i = (self.written + samples.size - chunk.size) % self.size
+            k = min(chunk.size, self.size - i)
+            self._buffer[i:i + k] = chunk[:k]
+            self._buffer[:chunk.size - k] = chunk[k:]
+            self.written += samples.size
+            self._stamp = (self.written, t)
+            self._cond.notify_all()
+
+    def position(self):
+        """Returns the index of the next sample to be captured"""
+        with self._cond:
+            return self.written
+
+    def time_of(self, index):
+        """Returns the estimated monotonic time of the sample index"""
+        with self._cond:
+            (i, t) = self._stamp
+        return t - float(i - index) / REC_HZ
+
+    def index_at(self, t):
+        """Returns the index of the sample captured at monotonic time t"""
+        with self._cond:
+            (i, t_i) = self._stamp
+        return i - int(round((t_i - t) * REC_HZ))
+
+    def wait_for(self, index, timeout=None):
+        """
+        Waits until sample index - 1 has been captured, or the capture has
+        stopped, or timeout (s) has passed.  Returns the position.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while self.written < index and self.running():
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    left = deadline - monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+            return self.written
+
+    def read(self, start, end):
+        """
+        Returns a copy of the samples start...end - 1, which must have been
+        captured and still be in the buffer
+        """
+        with self._cond:
+            if end > self.written:
+                raise ValueError("samples %i...%i not captured yet"
+                                 % (self.written, end - 1))
+            if start < self.written - self.size:
+                raise IOError("samples %i...%i overwritten"
+                              % (start, self.written - self.size - 1))
+            i = start % self.size
+            n = end - start
+            k = min(n, self.size - i)
+            return num.concatenate((self._buffer[i:i + k],
+                                    self._buffer[:n - k]))
+
+
+class RingRecording(object):
+    """The samples of a CaptureRing from a given index on"""
+
+    def __init__(self, ring, start):
+        self.ring = ring
+        self.start = start
+        self.stop = None
+        self._next = start
+
+    def read_available(self):
+        end = self.ring.position()
+        if self.stop is not None:
+            end = min(end, self.stop)
+        a = self.ring.read(self._next, end)
+        self._next = end
+        return a
+
+    def read(self, dtype=None):
+        if self.stop is not None:
+            self.ring.wait_for(self.stop, RING_WAIT)
+        a = self.read_available()
+        if dtype is not None:
+            return a.astype(dtype)
+        return a
+
+    def close(self):
+        pass
+
+
+class RingBackend(AudioBackend):
+    """
+    Plays through aplay and records from a CaptureRing, which is started
+    with the first recording and kept running until close(), so that a
+    recording starts without spawning a process
+    """
+
+    def __init__(self, ring=None):
+        self.ring = ring or CaptureRing()
+
+    def play(self, frames):
+        play_samples_alsa(frames)
+
+    def start_recording(self):
+        if not self.ring.running():
+            self.ring.start()
+            if self.ring.wait_for(1, RING_WAIT) < 1:
+                self.ring.stop()
+                raise IOError("arecord captured nothing in %g s" % RING_WAIT)
+        return RingRecording(self.ring, self.ring.position())
+
+    def stop_recording(self, recording):
+        # Samples captured before now may still be on their way from
+        # arecord, so the recording ends where now falls in the capture
+        recording.stop = max(self.ring.position(),
+                             self.ring.index_at(monotonic()))
+        self.ring.wait_for(recording.stop, RING_WAIT)
+
+    def close(self):
+        self.ring.stop()
+
+
+backend = RingBackend()
+
+
+def play_samples(frames):
+    """Plays frames from render_samples through backend"""
+    backend.play(frames)
+
+
+def start_recording():
+    """Starts recording through backend and returns the recording"""
+    return backend.start_recording()
+
+
+def stop_recording(recording):
+    """Stops a recording from start_recording"""
+    backend.stop_recording(recording)
+
+
+def real_dtype():
+    """Returns the numpy dtype of real arrays for PRECISION"""
+    return num.dtype(PRECISION)
+
+
+def complex_dtype():
+    """Returns the numpy dtype of spectra for PRECISION"""
+    return num.result_type(real_dtype(), num.complex64)
+
+
+def next_fast_len(n):
+    """Returns the smallest 2**i * 3**j * 5**k >= n"""
+    best = 2**int(math.ceil(math.log(n, 2)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # The smallest power of 2 taking p35 to at least n
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _spectrum(a, n):
+    return num.fft.rfft(a, n).astype(complex_dtype(), copy=False)
+
+
 def cross_cov(a, b, a_id=None):
-    """computes the cross-covariance of signals in a and b"""
+    """
+    computes the cross-covariance of signals in a and b, for lags 0 to
+    max(len(a), len(b)) - 1, with a transform long enough that none wrap
+    """
     assert (a.ndim == 1) and (b.ndim == 1)
     n = max(a.size, b.size)
-    n2 = 2**int(math.ceil(math.log(n, 2)))  # power of 2 >=n
+    n2 = next_fast_len(a.size + n - 1)
     if a_id is not None:
-        if ('fft', a_id, n2) in cache_dict:
-            fa = cache_dict[('fft', a_id, n2)]
-        else:
-            fa = num.fft.rfft(a, n2)
-            cache_dict[('fft', a_id, n2)] = fa
+        fa = cache.fetch(('fft', a_id, n2, PRECISION),
+                         lambda: num.conjugate(_spectrum(a, n2)))
+    else:
+        fa = num.conjugate(_spectrum(a, n2))
+    fprod = fa * _spectrum(b, n2)
+    xc = num.fft.irfft(fprod, n2)
+    return xc[:n].astype(real_dtype(), copy=False)
+
+
+def peak_error_bound(L, energy, value, n):
+    """
+    Returns a bound, in samples, on the error in the location of a peak of
+    the given value caused by rounding at PRECISION.  The template has L
+    values of +-0.5, the signal has the given energy (sum of squares) and
+    the transforms have length n.  The rounding error of each correlation
+    value is at most about eps * log2(n) * |a| * |b|, and moves the vertex
+    of the peak by at most three times that over its curvature, which is
+    of the order of the peak value.
+    """
+    if value == 0:
+        return float('inf')
+    eps = float(num.finfo(real_dtype()).eps)
+    error = eps * math.log(n, 2) * math.sqrt(0.25 * L * energy)
+    return 3 * error / abs(value)
+
+
+def fwht(a):
+    """
+    In-place fast Walsh-Hadamard transform of a, whose length must be a
+    power of 2.  Uses only additions and subtractions.  Returns a.
+    """
+    h = 1
+    while h < a.size:
+        v = a.reshape((-1, 2, h))
+        x = v[:, 0, :].copy()
+        v[:, 0, :] += v[:, 1, :]
+        num.subtract(x, v[:, 1, :], v[:, 1, :])
+        h *= 2
+    return a
+
+
+def mls_fht_tables(mls):
+    """
+    Computes the permutations that turn circular correlation with the
+    m-sequence mls (length 2**n - 1) into a Walsh-Hadamard transform.
+
+    Every shift of an m-sequence is a GF(2) combination of n consecutive
+    shifts, so mls[(u - k) % L] = parity(q[k] & r[u]), where r[u] packs
+    mls[u], mls[u - 1], ... mls[u - n + 1] into an integer and q[k] is read
+    off the columns u for which r[u] is a power of 2.  Both r and q are
+    permutations of 1...2**n - 1.
+
+    returns (r, q)
+    """
+    L = mls.size
+    n = int(round(math.log(L + 1, 2)))
+    assert 2**n - 1 == L
+    b = mls.astype(num.intp)
+    r = num.zeros((L), num.intp)
+    for j in xrange(n):
+        r |= num.roll(b, j) << j
+    where = num.zeros((L + 1), num.intp)
+    where[r] = num.arange(L)
+    k = num.arange(L)
+    q = num.zeros((L), num.intp)
+    for j in xrange(n):
+        q |= b[(where[1 << j] - k) % L] << j
+    return (r, q)
+
+
+def fold(b, L):
+    """Sums consecutive length-L blocks of b, zero-padding the last one"""
+    z = num.zeros((L), real_dtype())
+    full = b.size - b.size % L
+    if full:
+        z += b[:full].reshape((-1, L)).sum(axis=0, dtype=real_dtype())
+    z[:b.size - full] += b[full:]
+    return z
+
+
+def mls_circular_cov(mls, b, mls_id=None):
+    """
+    Computes the circular cross-covariance of the [0,1] m-sequence mls,
+    taken as mls - 0.5, with a length-len(mls) segment b, using a fast
+    Hadamard transform instead of FFTs.  Longer signals should be folded
+    first.  The permutation tables are cached under mls_id.
+    """
+    L = mls.size
+    assert b.size == L
+    if mls_id is not None:
+        (r, q) = cache.fetch(('fht', mls_id), lambda: mls_fht_tables(mls))
     else:
-        fa = num.fft.rfft(a, n2)
-    fb = num.fft.rfft(b, n2)
-    fprod = num.conjugate(fa) * fb
-    xc = num.fft.irfft(fprod)
-    return xc[:n].real
+        (r, q) = mls_fht_tables(mls)
+    z = num.zeros((L + 1), real_dtype())
+    z[r] = b
+    fwht(z)
+    # mls - 0.5 == -0.5 * (-1)**mls, the Hadamard matrix entries scaled
+    return -0.5 * z[q]
+
+
+def mls_peak(mls, b, mls_id=None):
+    """
+    Finds the peak of cross_cov(mls - 0.5, b) for a [0,1] m-sequence mls.
+
+    b is folded modulo the sequence length and correlated with
+    mls_circular_cov, which places the peak correctly up to a multiple of
+    the length.  Each candidate lag is then evaluated directly, by adding
+    and subtracting samples of b, and the strongest is returned.
+
+    returns (peak index, cross-covariance at the peak)
+    """
+    return _mls_peak(mls, b, mls_id)[:2]
+
+
+def _mls_peak(mls, b, mls_id):
+    """Returns (peak index, value, folded circular cross-covariance)"""
+    L = mls.size
+    xc = mls_circular_cov(mls, fold(b, L), mls_id)
+    k = getpeak(xc)
+    lags = range(k, max(L, b.size), L)
+    values = mls_cov_at(mls, b, lags, mls_id)
+    i = getpeak(values)
+    return (lags[i], values[i], xc)
+
+
+def mls_cov_at(mls, b, lags, mls_id=None):
+    """
+    Evaluates cross_cov(mls - 0.5, b) directly at each of lags, which must
+    be evenly spaced, and returns the values as an array.  The lags whose
+    window lies within b take one product of a strided view of b with
+    mls - 0.5, cached under mls_id; the others are computed one by one.
+    """
+    L = mls.size
+    if mls_id is not None:
+        t = cache.fetch(('mls_float', mls_id), lambda: mls - 0.5)
+    else:
+        t = mls - 0.5
+    b = num.ascontiguousarray(b)
+    values = num.zeros((len(lags)))
+    inside = [i for (i, lag) in enumerate(lags)
+              if lag >= 0 and lag + L <= b.size]
+    if inside:
+        (i0, i1) = (inside[0], inside[-1] + 1)
+        step = lags[i0 + 1] - lags[i0] if i1 - i0 > 1 else 1
+        rows = num.lib.stride_tricks.as_strided(
+            b[lags[i0]:], shape=(i1 - i0, L),
+            strides=(step * b.strides[0], b.strides[0]))
+        values[i0:i1] = num.dot(rows, t)
+    else:
+        i0 = i1 = len(lags)
+    for i in range(i0) + range(i1, len(lags)):
+        if lags[i] < 0:
+            continue
+        seg = b[lags[i]:lags[i] + L]
+        values[i] = num.dot(seg, t[:seg.size])
+    return values
+
+
+def mls_peak_fine(mls, b, mls_id=None, method=None):
+    """
+    Like mls_peak, but the peak index is refined to a fraction of a sample
+    by interpolate_peak, from values computed by mls_cov_at.  Returns
+    (peak, value, psr), where psr is the peak_to_sidelobe ratio of the
+    folded correlation.
+    """
+    (k, value, xc) = _mls_peak(mls, b, mls_id)
+    y = mls_cov_at(mls, b, range(k - PEAK_HALFWIDTH, k + PEAK_HALFWIDTH + 1),
+                   mls_id)
+    psr = peak_to_sidelobe(xc, k % mls.size)
+    return (k + interpolate_peak(y, method), value, psr)
+
+
+class StreamingCorrelator(object):
+    """
+    Computes the linear cross-covariance of a template a with a signal b
+    that arrives in blocks, using overlap-save, and keeps track of the
+    strongest peak found so far.  When b is complete, finish() returns the
+    same values as cross_cov(a, b) where cross_cov does not wrap around.
+    """
+
+    def __init__(self, a, a_id=None):
+        self._size = a.size
+        self.nfft = next_fast_len(4 * a.size)
+        self._hop = self.nfft - a.size + 1
+        if a_id is not None:
+            self._fa = cache.fetch(
+                ('ols', a_id, self.nfft, PRECISION),
+                lambda: num.conjugate(_spectrum(a, self.nfft)))
+        else:
+            self._fa = num.conjugate(_spectrum(a, self.nfft))
+        self._buf = num.zeros((0), real_dtype())
+        self._xc = []
+        self.done = 0  # Number of lags computed so far
+        self.nsamples = 0  # Number of samples of b received so far
+        self.energy = 0.0  # Sum of the squares of b
+        self.peak = 0
+        self.peak_value = 0.0
+
+    def _process(self, n):
+        seg = self._buf[:self.nfft]
+        xc = num.fft.irfft(self._fa * _spectrum(seg, self.nfft),
+                           self.nfft)[:min(self._hop, n)]
+        xc = xc.astype(real_dtype(), copy=False)
+        k = getpeak(xc)
+        if abs(xc[k]) > abs(self.peak_value):
+            self.peak = self.done + k
+            self.peak_value = xc[k]
+        self._xc.append(xc)
+        self.done += xc.size
+        self._buf = self._buf[self._hop:]
+
+    def feed(self, b):
+        """Adds the next block of the signal"""
+        self._buf = num.concatenate((self._buf, b.astype(real_dtype())))
+        self.nsamples += b.size
+        x = b.astype(num.float)
+        self.energy += float(num.dot(x, x))
+        while self._buf.size >= self.nfft:
+            self._process(self._hop)
+
+    def finish(self):
+        """Correlates the rest of the signal and returns the full result"""
+        n = max(self._size, self.nsamples)
+        while self.done < n:
+            self._process(n - self.done)
+        self._xc = [num.concatenate(self._xc)]
+        return self._xc[0]
+
+    def fine_peak(self, method=None):
+        """
+        Finishes the correlation and returns (peak, value, psr), with the
+        peak index refined by interpolate_peak and its peak_to_sidelobe
+        ratio
+        """
+        xc = self.finish()
+        y = peak_neighbourhood(xc, self.peak)
+        return (self.peak + interpolate_peak(y, method), self.peak_value,
+                peak_to_sidelobe(xc, self.peak))
+
+
+class SplitStream(object):
+    """
+    Routes the samples of a measure_dt_seq recording, as they arrive, to
+    one StreamingCorrelator for [startnum, breaknum) and another from
+    breaknum on.  Samples past startnum are held until breaknum is known.
+    """
+
+    def __init__(self, first, second, startnum):
+        self.first = first
+        self.second = second
+        self._startnum = startnum
+        self._breaknum = None
+        self._held = []
+        self._pos = 0  # Index of the next sample of the recording
+        self._lock = threading.Lock()
+
+    def _route(self, x, pos):
+        end = pos + x.size
+        lo = max(pos, self._startnum)
+        hi = min(end, self._breaknum)
+        if hi > lo:
+            self.first.feed(x[lo - pos:hi - pos])
+        if end > self._breaknum:
+            self.second.feed(x[max(self._breaknum, pos) - pos:])
+
+    def feed(self, x):
+        with self._lock:
+            pos = self._pos
+            self._pos += x.size
+            if self._breaknum is None:
+                if pos + x.size > self._startnum:
+                    self._held.append((x, pos))
+            else:
+                self._route(x, pos)
+
+    def set_break(self, breaknum):
+        with self._lock:
+            self._breaknum = max(breaknum, self._startnum)
+            for (x, pos) in self._held:
+                self._route(x, pos)
+            self._held = []
+
+
+def tail_recording(recording, sink, stop_event, interval=0.02):
+    """
+    Passes the samples of an AudioBackend recording to sink, as int16
+    arrays, while it is still being recorded.  Once stop_event is set,
+    whatever remains is passed on and the function returns.
+    """
+    while True:
+        stopping = stop_event.is_set()
+        data = recording.read_available()
+        if data.size:
+            sink(data)
+        elif stopping:
+            return
+        else:
+            stop_event.wait(interval)
+
+
+class SampleStore(object):
+    """
+    Collects the samples of a recording as they arrive, for readers that
+    wait for a range of them
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self.nsamples = 0
+
+    def feed(self, x):
+        with self._cond:
+            self._blocks.append(x)
+            self.nsamples += x.size
+            self._cond.notify_all()
+
+    def close(self):
+        """Wakes up readers waiting for samples that will never come"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def wait_slice(self, lo, hi):
+        """Waits for samples lo...hi - 1, or close(), and returns them"""
+        with self._cond:
+            while self.nsamples < hi and not self._closed:
+                self._cond.wait()
+            if len(self._blocks) != 1:
+                self._blocks = [num.concatenate(
+                    self._blocks + [num.zeros((0), num.int16)])]
+            return self._blocks[0][lo:hi]
 
 
 def get_room_echo(t):
@@ -250,12 +1059,11 @@ def get_room_echo(t):
     of a microphone-speaker system, up to a time-delay"""
     R = (num.zeros((MLS_INDEX)) == 0)
     mls = compute_mls(R)
-    mls_wav_file = write_wav(mls)
-    record_file = record_while_playing(mls_wav_file.name, t)
-    mls_wav_file.close()
-    rec_array = read_recorded_file(record_file)
-    record_file.close()
-    os.remove(record_file.name)
+    recording = record_while_playing(render_samples(mls), t)
+    rec_array = recording.read()
+    recording.close()
+    if USE_FHT:
+        return mls_circular_cov(mls, fold(rec_array, mls.size))
     return cross_cov(mls - 0.5, rec_array)
 
 
@@ -264,10 +1072,12 @@ def get_noise_echo(t):
     R = (num.zeros((MLS_INDEX)) == 0)
     mls = compute_mls(R)
 
-    record_wav_file = record_while_playing(False, t)
+    recording = record_while_playing(False, t)
 
-    rec_array = read_recorded_file(record_wav_file)
-    record_wav_file.close()
+    rec_array = recording.read()
+    recording.close()
+    if USE_FHT:
+        return mls_circular_cov(mls, fold(rec_array, mls.size))
     return cross_cov(mls - 0.5, rec_array)
 
 
@@ -315,6 +1125,35 @@ def do_server_seq(server_address, port):
     return dt
 
 
+def do_scheduler_matrix(server_address, port, devices, rounds=1):
+    """
+    Make this computer the scheduler of a measure_dt_matrix, once devices
+    other computers have connected, and return the result.
+    """
+    listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener_socket.bind((server_address, port))
+    listener_socket.listen(devices)
+    sockets = [listener_socket.accept()[0] for i in xrange(devices)]
+    listener_socket.close()
+    result = measure_dt_matrix(sockets, True, rounds)
+    for s in sockets:
+        s.close()
+    return result
+
+
+def do_device_matrix(server_address, port):
+    """
+    Make this computer one of the devices of a measure_dt_matrix, and
+    return the result.
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect((server_address, port))
+    result = measure_dt_matrix(client_socket, False)
+    client_socket.close()
+    return result
+
+
 def do_client_seq(server_address, port):
     """
     Make this computer the client for a distance measurement
@@ -327,292 +1166,1535 @@ def do_client_seq(server_address, port):
     return dt
 
 
-def recvall(s, n):
+# Raised whenever a payload layout or the exchange of messages changes.
+# Version 2 added the mode to 'start', version 3 'drift' to each
+# measure_dt_seq round and the clock ratio of each round to 'results', and
+# version 4 the peak-to-sidelobe ratio to 'matrix'.
+PROTOCOL_VERSION = 4
+MIN_PROTOCOL_VERSION = 4  # Oldest version of a peer that can be measured
+
+# Message types: name -> (number, payload format).  Fields are only ever
+# appended to a payload, and a receiver ignores the bytes past the fields
+# it knows and messages of types it does not know, so that newer peers
+# can talk to older ones.  A format ending in '*' repeats its last field
+# to the end of the payload.
+MESSAGES = {
+    'hello': (1, '!HIB'),  # version, sample rate, MLS order
+    'start': (2, '!HIBB'),  # version, sample rate, MLS order, mode
+    'started': (3, '!'),
+    'playing': (4, '!'),
+    'turn': (5, '!I'),  # round
+    'stop': (6, '!'),
+    'dt': (7, '!d'),
+    'quality': (8, '!d'),  # peak-to-sidelobe ratio
+    'order': (9, '!BB'),  # next MLS order, accept
+    'rounds': (10, '!I'),
+    'results': (11, '!d*'),
+    'schedule': (12, '!IIId'),  # device number, devices, rounds, slot (s)
+    'go': (13, '!'),
+    'peaks': (14, '!d*'),
+    'matrix': (15, '!d*'),
+    'drift': (16, '!d'),  # ratio of own sample clock to the peer's
+}
+
+# Kinds of measurement, announced by the server's start message
+MODE_PAIR = 0  # measure_dt_seq or measure_dt_burst
+MODE_MATRIX = 1  # measure_dt_matrix
+MODE_SIMUL = 2  # measure_dt_simul
+_MESSAGE_NAMES = dict([(number, name)
+                       for (name, (number, f)) in MESSAGES.items()])
+
+# magic, version, type, payload length, send time, echoed send time, and
+# the time for which that was held
+_HEADER = struct.Struct('!2sBBIddd')
+_MAGIC = 'AM'
+# The commands of the text protocol spoken before version 1, any of which
+# an old peer may send first
+_OLD_COMMANDS = ('ready', 'start recording', 'started', 'your turn', 'stop',
+                 'playing')
+
+
+class ProtocolError(Exception):
+    """The peer broke the measurement protocol"""
+    pass
+
+
+class PeerClosed(ProtocolError):
+    """The peer closed the connection"""
+    pass
+
+
+def _payload_format(fmt, size):
+    """Expands a format ending in '*' to fit a payload of size bytes"""
+    if not fmt.endswith('*'):
+        return fmt
+    head = fmt[:-2]
+    item = struct.calcsize('!' + fmt[-2])
+    return head + fmt[-2] * ((size - struct.calcsize(head)) / item)
+
+
+class Channel(object):
+    """
+    Typed, length-prefixed messages over a stream socket.  Every message
+    carries the sender's monotonic send time and echoes the send time of
+    the last message it received, with how long it held it, so that rtt
+    always holds the latest round-trip time (s) of the connection.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.version = PROTOCOL_VERSION  # Lowered to the peer's by hello
+        self.mode = None  # The kind of measurement, set by the handshake
+        self.rtt = None
+        self._peer_sent = 0.0  # Send time of the last message received
+        self._received_at = None  # and when it arrived here
+        self._buf = bytearray(256)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass  # not TCP
+
+    def _encode(self, name, values):
+        """Returns the bytes of a message of type name, sent now"""
+        (number, fmt) = MESSAGES[name]
+        if fmt.endswith('*'):
+            # One field per character, the last one repeated
+            fmt = fmt[:-2] + fmt[-2] * (len(values) - len(fmt) + 3)
+        payload = struct.pack(fmt, *values)
+        now = monotonic()
+        if self._received_at is None:
+            held = 0.0
+        else:
+            held = now - self._received_at
+        return _HEADER.pack(_MAGIC, self.version, number, len(payload), now,
+                            self._peer_sent, held) + payload
+
+    def _check_magic(self, magic):
+        """Raises ProtocolError unless magic begins a message"""
+        if magic == _MAGIC:
+            return
+        if [c for c in _OLD_COMMANDS if c.startswith(magic)]:
+            raise ProtocolError("peer runs the old text protocol")
+        raise ProtocolError("not a measurement message: %r" % magic)
+
+    def _parse_header(self, data):
+        """Checks a message header and returns its fields"""
+        header = _HEADER.unpack(data)
+        self._check_magic(header[0])
+        return header
+
+    def _arrived(self, header):
+        """Notes the times in the header of a message that has arrived"""
+        (magic, version, number, length, sent, echo, held) = header
+        now = monotonic()
+        self._peer_sent = sent
+        self._received_at = now
+        if echo:
+            self.rtt = now - echo - held
+
+    def _decode(self, name, number, payload):
+        """Returns the values of a message, which must be of type name"""
+        if _MESSAGE_NAMES[number] != name:
+            raise ProtocolError("expected %s, received %s"
+                                % (name, _MESSAGE_NAMES[number]))
+        fmt = _payload_format(MESSAGES[name][1], len(payload))
+        n = struct.calcsize(fmt)
+        if len(payload) < n:
+            raise ProtocolError("%s message too short: %i bytes"
+                                % (name, len(payload)))
+        return struct.unpack(fmt, payload[:n])
+
+    def send(self, name, *values):
+        self.sock.sendall(self._encode(name, values))
+
+    def _recv_exactly(self, n):
+        """Receives n bytes into the buffer and returns them"""
+        if n > len(self._buf):
+            self._buf = bytearray(max(n, 2 * len(self._buf)))
+        view = memoryview(self._buf)
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if k == 0:
+                raise PeerClosed("connection closed after %i of %i bytes"
+                                 % (got, n))
+            got += k
+        return view[:n].tobytes()
+
+    def recv(self, name):
+        """
+        Receives the next message, which must be of type name, and returns
+        its values as a tuple.  Messages of unknown types are skipped.
+        """
+        while True:
+            # The magic comes first, so that an old peer's short text
+            # command is recognised rather than waited on
+            magic = self._recv_exactly(len(_MAGIC))
+            self._check_magic(magic)
+            header = self._parse_header(
+                magic + self._recv_exactly(_HEADER.size - len(_MAGIC)))
+            payload = self._recv_exactly(header[3])
+            self._arrived(header)
+            if header[2] in _MESSAGE_NAMES:
+                return self._decode(name, header[2], payload)
+
+    def exchange(self, name, *values):
+        """Sends a message of type name and returns the peer's reply"""
+        self.send(name, *values)
+        return self.recv(name)
+
+
+def as_channel(s):
+    """Returns s if it is a Channel, or a new Channel on the socket s"""
+    if isinstance(s, Channel):
+        return s
+    return Channel(s)
+
+
+def _check_peer(version, rate):
+    """Raises ProtocolError if a peer's hello or start cannot be met"""
+    if version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError("peer speaks protocol version %i, not %i or later"
+                            % (version, MIN_PROTOCOL_VERSION))
+    if rate != REC_HZ:
+        raise ProtocolError("peer records at %i Hz, not %i" % (rate, REC_HZ))
+
+
+def _handshake(channel, am_server, order, start=None, mode=MODE_PAIR):
+    """
+    The client says hello with its parameters, and the server answers
+    with the parameters to use and the kind of measurement, calling
+    start() first if given.  Returns the MLS order chosen by the server,
+    and sets channel.mode to the kind of measurement.  A client whose mode
+    is None takes whichever the server starts.
+    """
+    if am_server:
+        (version, rate, peer_order) = channel.recv('hello')
+    else:
+        channel.send('hello', PROTOCOL_VERSION, REC_HZ, order)
+        (version, rate, order, server_mode) = channel.recv('start')
+        if mode is None:
+            mode = server_mode
+        elif server_mode != mode:
+            raise ProtocolError("peer started measurement mode %i, not %i"
+                                % (server_mode, mode))
+    _check_peer(version, rate)
+    channel.version = min(version, PROTOCOL_VERSION)
+    channel.mode = mode
+    if am_server:
+        if start:
+            start()
+        channel.send('start', channel.version, REC_HZ, order, mode)
+    return order
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt')
+                         or ctypes.util.find_library('c'), use_errno=True)
+    _CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        """Returns the time (s) of a clock that never goes backwards"""
+        t = _timespec()
+        if _librt.clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class PhaseTimer(object):
     """
-    Attempt to receive n bytes from socket s.  Return received message.
-    Fails with "Assertion failed" if a message of incorrect length is received.
+    Turns the phase changes of a measurement into events.  Calling the
+    timer with a phase name and keyword data appends an event to
+    self.events, calls send_signal(phase) and then send_event(event).
+
+    An event is a dict holding the given data and
+      'phase': the name of the phase that begins
+      'time': the monotonic time (s) at which it begins
+      'elapsed': the time (s) since the first event
+      'previous', 'duration': the name and length (s) of the phase that
+        ends, or None for the first event
+    plus any fixed data, such as the role, given to the constructor.
     """
-    received = ''
-    while len(received) < n:
-        q = s.recv(n - len(received))
-        assert len(q) > 0
-        received = received + q
-    return received
 
+    def __init__(self, send_signal=False, send_event=None, **fixed):
+        self._send_signal = send_signal
+        self._send_event = send_event
+        self._fixed = fixed
+        self.events = []
+
+    def __call__(self, phase, **data):
+        now = monotonic()
+        event = dict(self._fixed)
+        event.update(data)
+        event['phase'] = phase
+        event['time'] = now
+        if self.events:
+            last = self.events[-1]
+            event['elapsed'] = now - self.events[0]['time']
+            event['previous'] = last['phase']
+            event['duration'] = now - last['time']
+        else:
+            event['elapsed'] = 0.0
+            event['previous'] = None
+            event['duration'] = None
+        self.events.append(event)
+        if self._send_signal:
+            self._send_signal(phase)
+        if self._send_event:
+            self._send_event(event)
+        return event
+
+
+def _sequences(order):
+    """Returns the server's and client's sequences (mls, mls_rev)"""
+    mls = cache.fetch(('mls', order),
+                      lambda: compute_mls(num.zeros((order)) == 0))
+    mls_rev = cache.fetch(('mls_rev', order), lambda: mls[::-1])
+    return (mls, mls_rev)
+
+
+def simul_codes(order):
+    """
+    Returns the server's and client's sequences for measure_dt_simul, a
+    pair whose cross-covariance is small at every lag.  The server's is
+    the m-sequence of measure_dt_seq.  For odd orders the client's is its
+    decimation by 3; the two make a preferred pair, like those that give
+    Gold codes, with a cross-covariance of at most 1 + 2**((order+1)/2).
+    For even orders, which have no preferred pairs when divisible by 4, it
+    is the small Kasami code of the server's sequence plus its decimation
+    by 2**(order/2) + 1, with a cross-covariance of at most 1 + 2**(order/2)
+    """
+    (mls, mls_rev) = _sequences(order)
+
+    def compute():
+        L = mls.size
+        if order % 2:
+            return mls[3 * num.arange(L) % L]
+        q = 2**(order / 2) + 1
+        return mls != mls[q * num.arange(L) % L]
+    return (mls, cache.fetch(('simul', order), compute))
+
+
+def _coset(d, L):
+    """Returns the d * 2**i modulo L"""
+    c = set()
+    while d not in c:
+        c.add(d)
+        d = 2 * d % L
+    return c
 
-def recvmsg(s, message):
+
+def device_sequence(k, order):
+    """
+    Returns the m-sequence of device k in measure_dt_matrix.  Devices 0
+    and 1 use the server's and client's sequences of measure_dt_seq.  The
+    others use the first decimated by d, mls[d * i % L], which is also an
+    m-sequence when d is coprime to L; no two d differ by a factor of a
+    power of 2, which would only shift the sequence.
+    """
+    (mls, mls_rev) = _sequences(order)
+    if k < 2:
+        return (mls, mls_rev)[k]
+
+    def compute():
+        L = mls.size
+        used = _coset(1, L) | _coset(L - 1, L)
+        found = 1
+        for d in xrange(2, L):
+            if d not in used and fractions.gcd(d, L) == 1:
+                used |= _coset(d, L)
+                found += 1
+                if found == k:
+                    return mls[d * num.arange(L) % L]
+        raise ValueError("order %i has no sequence for device %i"
+                         % (order, k))
+    return cache.fetch(('seq', k, order), compute)
+
+
+def _named_sequence(name, order):
     """
-    Attempt to receive a specific message from a socket.  Returns
-    a boolean indicating whether or not that message was received.
+    Returns the sequence name ('mls', 'mls_rev', the client's simul_codes
+    'simul', or the device_sequence number) of the given order
     """
-    return (message == recvall(s, len(message)))
+    if name == 'mls' or name == 'mls_rev':
+        return _sequences(order)[name == 'mls_rev']
+    if name == 'simul':
+        return simul_codes(order)[1]
+    return device_sequence(name, order)
 
 
-def measure_dt_simul(s, am_server):
+def _find_peak(name, order, rec, use_fht=None):
     """
-    Performs all the actual communication between client and server for
-    distance measurement using simultaneous playback on both computers.
-    The method relies on the very low cross-covariance of certain pairs of
-    m-sequences (MLS), including the pair generated by time-reversal. In
-    practice, due to nonlinearities in the speakers and microphones, it
-    is not usable.
+    Finds the peak of the _named_sequence name of the given order in rec,
+    returning (peak, value, psr)
     """
-    if ('mls', MLS_INDEX) in cache_dict:
-        mls = cache_dict[('mls', MLS_INDEX)]
-    else:
-        R = (num.zeros((MLS_INDEX)) == 0)
-        mls = compute_mls(R)
-        cache_dict[('mls', MLS_INDEX)] = mls
+    if use_fht is None:
+        use_fht = USE_FHT
+    seq = _named_sequence(name, order)
+    if use_fht:
+        return mls_peak_fine(seq, rec, (name, order))
+    seq_float = cache.fetch((name, order, 'float'), lambda: seq - 0.5)
+    xc = cross_cov(seq_float, rec, (name, order, 'float'))
+    k = getpeak(xc)
+    return (k + interpolate_peak(peak_neighbourhood(xc, k)), xc[k],
+            peak_to_sidelobe(xc, k))
+
+
+def cancel_sound(name, order, rec, peak, taps=SIMUL_CANCEL_TAPS, before=16):
+    """
+    Returns rec less the sound of the _named_sequence name found at peak.
+    The impulse response it came through, from before samples ahead of
+    the peak to taps after, is the least-squares fit to the
+    cross-covariance around the peak: each value there is the sum of the
+    taps weighted by the autocovariance of the sequence at their distance.
+    """
+    seq_float = cache.fetch((name, order, 'float'),
+                            lambda: _named_sequence(name, order) - 0.5)
+    xc = cross_cov(seq_float, rec, (name, order, 'float'))
+    lo = max(0, int(round(peak)) - before)
+    hi = min(xc.size, int(round(peak)) + taps)
+    acov = cache.fetch((name, order, 'acov'),
+                       lambda: cross_cov(seq_float, seq_float))
+    i = num.arange(hi - lo)
+    h = num.linalg.solve(acov[abs(i[:, None] - i[None, :])], xc[lo:hi])
+    sound = num.convolve(seq_float, h)[:rec.size - lo]
+    out = rec.astype(real_dtype())
+    out[lo:lo + sound.size] -= sound
+    return out
+
+
+def resample(x, ratio, n=None, start=0.0, taps=16, phases=256):
+    """
+    Returns n values of x (as many as fit by default) interpolated at
+    start, start + ratio, start + 2 ratio...  Each is the dot product of
+    2 taps samples with a Hann-windowed sinc, taken from a table of the
+    given number of fractional delays.
+    """
+    if n is None:
+        n = max(0, int(math.floor((x.size - 1 - start) / ratio)) + 1)
+
+    def table():
+        d = num.arange(phases)[:, None] / float(phases)
+        k = num.arange(1 - taps, taps + 1)[None, :] - d
+        return num.sinc(k) * (0.5 + 0.5 * num.cos(math.pi * k / taps))
+    h = cache.fetch(('resample', taps, phases), table)
+    pos = start + ratio * num.arange(n)
+    i = num.floor(pos).astype(int)
+    phase = num.round((pos - i) * phases).astype(int)
+    i += phase // phases
+    phase %= phases
+    padded = num.concatenate((num.zeros(taps), x, num.zeros(taps + 1)))
+    out = num.zeros(n)
+    i += 1
+    for k in xrange(2 * taps):
+        out += padded[num.clip(i + k, 0, padded.size - 1)] * h[phase, k]
+    return out.astype(real_dtype())
+
+
+def estimate_ratio(name, order, rec, peak, max_ppm=DRIFT_MAX_PPM):
+    """
+    Estimates the ratio of the sample clock of rec to that of the device
+    that played the _named_sequence name found at peak, from how far
+    apart the two halves of the sequence are in rec.  Each half is
+    correlated with rec at the lags where it can be, with the clocks
+    within max_ppm of each other, and its peak interpolated.
+    """
+    seq_float = cache.fetch((name, order, 'float'),
+                            lambda: _named_sequence(name, order) - 0.5)
+    m = seq_float.size / 2
+    w = int(math.ceil(m * max_ppm * 1e-6)) + PEAK_HALFWIDTH + 1
+    found = []
+    for offset in (0, m):
+        lo = int(round(peak)) + offset - w
+        seg = num.zeros(2 * w + m)
+        a = max(0, lo)
+        b = max(a, min(rec.size, lo + seg.size))
+        seg[a - lo:b - lo] = rec[a:b]
+        half = seq_float[offset:offset + m].astype(num.float)
+        xc = num.array([num.dot(half, seg[j:j + m])
+                        for j in xrange(2 * w + 1)])
+        k = min(max(getpeak(xc), PEAK_HALFWIDTH), xc.size - 1 - PEAK_HALFWIDTH)
+        found.append(lo + k + interpolate_peak(peak_neighbourhood(xc, k)))
+    return (found[1] - found[0]) / m
+
+
+def _correct_drift(name, order, rec, peak, margin=64):
+    """
+    Returns (peak, ratio): the ratio of the sample clock of rec to that of
+    the device that played the _named_sequence name found at peak, and the
+    peak found again in rec resampled to that device's clock, where it is
+    not smeared by the difference.  Without DRIFT_COMPENSATION, returns
+    (peak, 1.0).
+    """
+    if not DRIFT_COMPENSATION:
+        return (peak, 1.0)
+    ratio = estimate_ratio(name, order, rec, peak)
+    lo = max(0, int(peak) - margin)
+    y = resample(rec[lo:], ratio, 2**order - 1 + 2 * margin)
+    found = _find_peak(name, order, y, use_fht=False)
+    return (lo + found[0] * ratio, ratio)
 
+
+def _clock_ratio(ratio, other_ratio, am_server):
+    """
+    Returns the ratio of the server's sample clock to the client's, given
+    each peer's estimate of the ratio of its own to the other's
+    """
     if am_server:
-        if ('mls_rev', MLS_INDEX) in cache_dict:
-            mls = cache_dict[('mls_rev', MLS_INDEX)]
-        else:
-            mls = mls[::-1]
-            cache_dict[('mls_rev', MLS_INDEX)] = mls
-    mls_wav_file = write_wav(mls)
+        return (ratio + 1 / other_ratio) / 2
+    return (other_ratio + 1 / ratio) / 2
+
+
+class SharedArrays(object):
+    """
+    Slots for float arrays of up to size elements in anonymous shared
+    memory.  Created before a process pool forks, they are seen by the
+    workers, so recordings reach them without being pickled.
+    """
+
+    def __init__(self, nslots, size):
+        self.nslots = nslots
+        self.size = size
+        self.dtype = real_dtype()
+        self._mm = mmap.mmap(-1, nslots * size * self.dtype.itemsize)
+        self.lock = threading.Lock()
+
+    def view(self, slot, n):
+        return num.frombuffer(self._mm, self.dtype, n,
+                              slot * self.size * self.dtype.itemsize)
+
+
+_pool = None
+_shared = None
+_pool_lock = threading.Lock()
+
+
+def start_workers(n=None, kind=None):
+    """
+    Starts the pool used by run_parallel, with n (default WORKERS)
+    workers of the given kind (default WORKER_POOL).  A process pool forks
+    this process, which is only safe while no other thread runs.
+    """
+    global _pool, _shared
+    n = n or WORKERS
+    kind = kind or WORKER_POOL
+    stop_workers()
+    if kind == 'process':
+        if threading.active_count() > 1:
+            raise RuntimeError("a process pool cannot be started once "
+                               "other threads run")
+        _shared = SharedArrays(max(n, 2), REC_TIMEOUT * REC_HZ)
+        _pool = multiprocessing.Pool(n)
+    else:
+        _pool = multiprocessing.pool.ThreadPool(n)
+
+
+def stop_workers():
+    global _pool, _shared
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _shared = None
+
+
+def _find_peak_shared(name, order, slot, n, use_fht):
+    """_find_peak, in a worker process, of a recording in _shared"""
+    return _find_peak(name, order, _shared.view(slot, n), use_fht)
+
+
+def run_parallel(tasks, use_fht=None):
+    """
+    Runs _find_peak(name, order, rec, use_fht) for each (name, order, rec)
+    in tasks and returns the results in order.  If WORKERS is set the
+    tasks run on the worker pool, otherwise one after the other.  A thread
+    pool is started the first time it is needed; a process pool must have
+    been started by start_workers.
+    """
+    if not WORKERS:
+        return [_find_peak(name, order, rec, use_fht)
+                for (name, order, rec) in tasks]
+    with _pool_lock:
+        if _pool is None:
+            if WORKER_POOL == 'process':
+                raise RuntimeError("start_workers() was not called")
+            start_workers(kind='thread')
+    if use_fht is None:
+        use_fht = USE_FHT
+    if _shared is None or len(tasks) > _shared.nslots or \
+            max([rec.size for (name, order, rec) in tasks]) > _shared.size:
+        pending = [_pool.apply_async(_find_peak, (name, order, rec, use_fht))
+                   for (name, order, rec) in tasks]
+        return [p.get() for p in pending]
+    with _shared.lock:
+        pending = []
+        for (slot, (name, order, rec)) in enumerate(tasks):
+            _shared.view(slot, rec.size)[:] = rec
+            pending.append(_pool.apply_async(
+                _find_peak_shared, (name, order, slot, rec.size, use_fht)))
+        return [p.get() for p in pending]
+
+
+def _correlate_halves(mls, mls_rev, rec1, rec2, order):
+    """
+    Finds the peaks of the server's sequence in rec1 and of the client's
+    in rec2, returning ((s_peak, s_value, s_psr), (c_peak, c_value, c_psr))
+    """
+    return tuple(run_parallel([('mls', order, rec1),
+                               ('mls_rev', order, rec2)]))
+
 
-    ready_command = 'ready'
+class AdaptiveOrder(object):
+    """
+    The state of measure_dt_seq's adaptive mode, kept from one measurement
+    to the next: the MLS order to use next and the quality last seen.
+
+    The peak-to-sidelobe ratio of a correlation grows with the square root
+    of the sequence length, so a ratio measured at one order predicts it
+    at the others.  The first measurement uses min_order as a probe.
+    """
+
+    def __init__(self, target=ADAPTIVE_TARGET_PSR,
+                 min_order=ADAPTIVE_MIN_ORDER, max_order=ADAPTIVE_MAX_ORDER,
+                 margin=1.25):
+        self.target = target
+        self.min_order = min_order
+        self.max_order = max_order
+        self.margin = margin
+        self.order = min_order
+        self.psr = None
+
+    def predict(self, order, psr, new_order):
+        return psr * math.sqrt((2.0**new_order - 1) / (2.0**order - 1))
+
+    def choose(self, order, psr):
+        """
+        Returns the shortest order predicted to reach the target, with a
+        margin, given the ratio psr measured at order.  If psr misses the
+        target, the result is always longer than order, up to max_order.
+        """
+        m = self.min_order
+        while (m < self.max_order
+               and self.predict(order, psr, m) < self.target * self.margin):
+            m += 1
+        if psr < self.target:
+            m = max(m, min(order + 1, self.max_order))
+        return m
+
+
+def _prepare(am_server, order):
+    """Returns (mls, mls_rev, frames), frames being this peer's sound"""
+    (mls, mls_rev) = _sequences(order)
     if am_server:
-        received = recvmsg(s, ready_command)
-        assert received
+        frames = cache.fetch(('frames', 'mls', order),
+                             lambda: render_samples(mls))
     else:
-        s.sendall(ready_command)
+        frames = cache.fetch(('frames', 'mls_rev', order),
+                             lambda: render_samples(mls_rev))
+    return (mls, mls_rev, frames)
+
+
+def _agree_order(channel, am_server, timer, order):
+    """
+    Prepares this peer's sound at the given order and agrees the order
+    with the peer by _handshake.  Returns (order, mls, mls_rev, frames)
+    for the agreed order.
+    """
+    timer('preparing', order=order)
+    (mls, mls_rev, frames) = _prepare(am_server, order)
+
+    timer('waiting')
+    server_order = _handshake(channel, am_server, order)
+    if server_order != order:
+        order = server_order
+        (mls, mls_rev, frames) = _prepare(am_server, order)
+    return (order, mls, mls_rev, frames)
 
-    start_and_play_command = 'start'
+
+def _started(channel, am_server, amp_ringdown):
+    """
+    Tells the server that the client is recording, then waits for the
+    speakers' amplifiers to settle
+    """
     if am_server:
-        (pipeline, rec_wav_file) = start_recording()
-        s.sendall(start_and_play_command)
+        channel.recv('started')
     else:
-        received = recvmsg(s, start_and_play_command)
-        assert received
-        (pipeline, rec_wav_file) = start_recording()
+        channel.send('started')
+    time.sleep(amp_ringdown)
+
 
-    playing_command = 'playing'
-    rectime = 5  # seconds
+def _take_turn(channel, am_server, audio, frames, t1, t2, seq,
+               on_break=None):
+    """
+    Plays the two halves of round seq of a recording started between
+    times t1 and t2: the server plays its frames and hands the turn to
+    the client with 'turn', then the client plays.  Returns (t3,
+    breaknum), the time and first sample of the client's half, which is
+    also passed to on_break as soon as it is known.
+    """
+    ringdown = 0.3  # seconds
     if am_server:
-        received = recvmsg(s, playing_command)
-        assert received
-        play_wav(mls_wav_file.name)
-        time.sleep(rectime)
+        audio.play(frames)
+        time.sleep(ringdown)
     else:
-        play_wav(mls_wav_file.name)
-        s.sendall(playing_command)
+        other_seq = channel.recv('turn')[0]
+        if other_seq != seq:
+            raise ProtocolError("round %i, peer is at %i" % (seq, other_seq))
+    t3 = time.time()
+    breaknum = int(math.ceil((t3 - t1) * REC_HZ))
+    if on_break is not None:
+        on_break(breaknum)
+    time.sleep(t2 - t1)
+    if am_server:
+        channel.send('turn', seq)
+    else:
+        audio.play(frames)
+        time.sleep(ringdown)
+    return (t3, breaknum)
+
+
+class _RoundThreads(object):
+    """
+    Threads that analyze rounds while the next ones are recorded.  join()
+    waits for them all and raises the first exception any of them raised.
+    """
+
+    def __init__(self):
+        self._threads = []
+        self._errors = []
+
+    def start(self, fn, *args):
+        """Runs fn(*args) in a new thread"""
+        def run():
+            try:
+                fn(*args)
+            except Exception:
+                self._errors.append(sys.exc_info())
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            (cls, value, tb) = self._errors[0]
+            raise cls, value, tb
+
+
+def _measure_round(channel, am_server, timer, audio, order):
+    """
+    Performs one measure_dt_seq exchange with sequences of the given order
+    and returns its 'done' event
+    """
+    (order, mls, mls_rev, frames) = _agree_order(channel, am_server, timer,
+                                                 order)
+
+    timer('playing', order=order)
 
-    stop_command = 'stop'
+    amp_ringdown = 0.2
+    startnum = int(math.ceil(amp_ringdown * REC_HZ))
+
+    if STREAM_CORRELATION:
+        mls_float = cache.fetch(('mls_float', order), lambda: mls - 0.5)
+        mls_rev_float = cache.fetch(('mls_rev_float', order),
+                                    lambda: mls_rev - 0.5)
+        stream = SplitStream(
+            StreamingCorrelator(mls_float, ('mls_float', order)),
+            StreamingCorrelator(mls_rev_float, ('mls_rev_float', order)),
+            startnum)
+        # The other's sound is looked at again to correct for drift
+        store = SampleStore()
+
+        def sink(x):
+            stream.feed(x)
+            store.feed(x)
+
+    t1 = time.time()
+    recording = audio.start_recording()
+    t2 = time.time()
+
+    if STREAM_CORRELATION:
+        tail_stop = threading.Event()
+        tail = threading.Thread(target=tail_recording,
+                                args=(recording, sink, tail_stop))
+        tail.daemon = True
+        tail.start()
+
+    try:
+        try:
+            _started(channel, am_server, amp_ringdown)
+            (t3, breaknum) = _take_turn(
+                channel, am_server, audio, frames, t1, t2, 0,
+                stream.set_break if STREAM_CORRELATION else None)
+
+            if am_server:
+                channel.recv('stop')
+            else:
+                channel.send('stop')
+        finally:
+            audio.stop_recording(recording)
+            if STREAM_CORRELATION:
+                tail_stop.set()
+                tail.join()
+        del(frames)
+        if not STREAM_CORRELATION:
+            rec_array = recording.read()
+    finally:
+        recording.close()
+    del(recording)
+
+    breaktime = t3 - t1
+    if STREAM_CORRELATION:
+        (rec1_samples, rec2_samples) = (stream.first.nsamples,
+                                        stream.second.nsamples)
+    else:
+        rec1 = rec_array[startnum:breaknum]
+        rec2 = rec_array[breaknum:]
+        (rec1_samples, rec2_samples) = (num.size(rec1), num.size(rec2))
+
+    timer('processing', breaktime=breaktime, rec1_samples=rec1_samples,
+          rec2_samples=rec2_samples)
+
+    if STREAM_CORRELATION:
+        (s_peak, s_value, s_psr) = stream.first.fine_peak()
+        (c_peak, c_value, c_psr) = stream.second.fine_peak()
+        bounds = [(c.energy, c.nfft) for c in (stream.first, stream.second)]
+        store.close()
+        rec1 = store.wait_slice(startnum, breaknum)
+        rec2 = store.wait_slice(breaknum, store.nsamples)
+    else:
+        ((s_peak, s_value, s_psr), (c_peak, c_value, c_psr)) = \
+            _correlate_halves(mls, mls_rev, rec1, rec2, order)
+        bounds = [(float(num.dot(rec, rec.astype(num.float))),
+                   mls.size + 1 if USE_FHT
+                   else next_fast_len(mls.size + rec.size - 1))
+                  for rec in (rec1, rec2)]
+    peak_error = max([peak_error_bound(mls.size, energy, value, n)
+                      for ((energy, n), value) in zip(bounds,
+                                                      (s_value, c_value))])
     if am_server:
-        s.sendall(stop_command)
+        (c_peak, ratio) = _correct_drift('mls_rev', order, rec2, c_peak)
     else:
-        received = recvmsg(s, stop_command)
-        assert received
-
-    stop_recording(pipeline)
-    mls_wav_file.close()
-    rec_array = read_recorded_file(rec_wav_file)
-    rec_wav_file.close()
-    mls_float = mls - 0.5
-    xc_self = cross_cov(mls_float, rec_array)
-    xc_other = cross_cov(mls_float[::-1], rec_array)
-    dn = getpeak(xc_other) - getpeak(xc_self)
+        (s_peak, ratio) = _correct_drift('mls', order, rec1, s_peak)
+    dn = (c_peak + breaknum) - s_peak
     dt = float(dn) / REC_HZ
-    format_string = '!d'
-    n = struct.calcsize(format_string)
-    s.sendall(struct.pack(format_string, dt))
-    other_dt = struct.unpack(format_string, recvall(s, n))[0]
+    ratio = _clock_ratio(ratio, channel.exchange('drift', ratio)[0],
+                         am_server)
+    other_dt = channel.exchange('dt', dt)[0]
+    if ARCHIVE_DIR:
+        if STREAM_CORRELATION:
+            rec_array = store.wait_slice(0, store.nsamples)
+        archive.save(ARCHIVE_DIR, rec_array, 'seq', 0 if am_server else 1,
+                     order, REC_HZ, 2, 1,
+                     [(startnum, breaknum, 0), (breaknum, rec_array.size, 1)],
+                     [breaktime, dt, other_dt, ratio])
+
+    # Both times in samples of the server's clock
+    if am_server:
+        roundtrip = abs(dt - other_dt * ratio)
+    else:
+        roundtrip = abs(dt * ratio - other_dt)
 
-    roundtrip = dt + other_dt
+    # pylab.plot(xc_server)
+    # pylab.show()
 
-    return roundtrip / 2
+    return timer('done', s_peak=float(s_peak), c_peak=float(c_peak),
+                 s_value=float(s_value), c_value=float(c_value),
+                 s_psr=float(s_psr), c_psr=float(c_psr),
+                 peak_error=peak_error, dt=dt, other_dt=other_dt,
+                 ppm=(ratio - 1) * 1e6, rtt=channel.rtt, order=order,
+                 result=roundtrip / 2)
 
 
-def measure_dt_seq(s, am_server, send_signal=False):
+def measure_dt_seq(s, am_server, send_signal=False, audio=None,
+                   send_event=None, order=None, adaptive=None):
     """
     This function performs distance measurement using sequential playback.
     In this method, the server plays its sound first, and the client plays
     only after the server has finished.  The first and second halves of the
     recording are analyzed separately.  This method is much more tolerant
     of low-quality speaker systems and is known to work.
+    s is a connected socket or a Channel, and audio the AudioBackend to
+    use, by default the module's backend.
+    send_signal(phase) is called with the name of each phase as it begins,
+    and send_event(event) with the corresponding PhaseTimer event.
+    order is the MLS order, by default MLS_INDEX.
+
+    If adaptive is an AdaptiveOrder, both peers must pass one.  The order
+    then comes from it, and after each exchange the peers share the worse
+    peak-to-sidelobe ratio either of them saw.  The server picks the order
+    for the next measurement and whether to accept this one; if not, the
+    exchange is repeated at the longer order.
     """
+    if audio is None:
+        audio = backend
+    channel = as_channel(s)
+    timer = PhaseTimer(send_signal, send_event,
+                       role='server' if am_server else 'client')
+
+    if adaptive is None:
+        return _measure_round(channel, am_server, timer, audio,
+                              order or MLS_INDEX)['result']
+
+    while True:
+        event = _measure_round(channel, am_server, timer, audio,
+                               adaptive.order)
+        order = event['order']
+        psr = min(event['s_psr'], event['c_psr'])
+        psr = min(psr, channel.exchange('quality', psr)[0])
+        if am_server:
+            next_order = adaptive.choose(order, psr)
+            accept = psr >= adaptive.target or order >= adaptive.max_order
+            channel.send('order', next_order, accept)
+        else:
+            (next_order, accept) = channel.recv('order')
+        adaptive.order = next_order
+        adaptive.psr = psr
+        if accept:
+            return event['result']
 
-    if send_signal:
-        send_signal('preparing')
-
-    if ('mls', MLS_INDEX) in cache_dict:
-        mls = cache_dict[('mls', MLS_INDEX)]
-    else:
-        R = (num.zeros((MLS_INDEX)) == 0)
-        mls = compute_mls(R)
-        cache_dict[('mls', MLS_INDEX)] = mls
 
-    if ('mls_rev', MLS_INDEX) in cache_dict:
-        mls_rev = cache_dict[('mls_rev', MLS_INDEX)]
+def measure_dt_simul(s, am_server, send_signal=False, audio=None,
+                     send_event=None, order=None, fallback=True):
+    """
+    Performs distance measurement using simultaneous playback on both
+    computers, in half the time of measure_dt_seq.  Each plays one of
+    simul_codes, whose low cross-covariance lets each find both sounds in
+    one recording.  The sound of a peer's own speaker is far louder than
+    the other's, so it is found first and cancelled before looking for
+    the other.  Nonlinearities in the speakers and microphones leave some
+    of it behind, so the peers share the worst peak-to-sidelobe ratio
+    either of them saw; if it is below SIMUL_MIN_PSR, they repeat the
+    measurement with measure_dt_seq, unless fallback is False.
+    The arguments are those of measure_dt_seq.  The 'done' event of the
+    simultaneous measurement has its 'separation' and 'fallback'; on
+    fallback, those of measure_dt_seq follow.
+    """
+    if audio is None:
+        audio = backend
+    channel = as_channel(s)
+    order = order or MLS_INDEX
+    timer = PhaseTimer(send_signal, send_event,
+                       role='server' if am_server else 'client')
+    # The server plays the m-sequence and the client the other code
+    names = ('mls', 'simul') if am_server else ('simul', 'mls')
+
+    def prepare(order):
+        return cache.fetch(('frames', names[0], order), lambda: render_samples(
+            simul_codes(order)[not am_server]))
+
+    timer('preparing', order=order)
+    frames = prepare(order)
+
+    timer('waiting')
+    recordings = []
+    server_order = _handshake(channel, am_server, order,
+                              lambda: recordings.append(
+                                  audio.start_recording()),
+                              mode=MODE_SIMUL)
+    if server_order != order:
+        order = server_order
+        frames = prepare(order)
+    if not am_server:
+        recordings.append(audio.start_recording())
+    recording = recordings[0]
+
+    timer('playing', order=order)
+    amp_ringdown = 0.2
+    startnum = int(math.ceil(amp_ringdown * REC_HZ))
+    ringdown = 0.3  # seconds
+    if am_server:
+        channel.recv('started')
+        time.sleep(amp_ringdown)
+        channel.send('turn', 0)
+        audio.play(frames)
+        time.sleep(ringdown)
+        channel.recv('stop')
     else:
-        mls_rev = mls[::-1]
-        cache_dict[('mls_rev', MLS_INDEX)] = mls_rev
-
+        channel.send('started')
+        channel.recv('turn')
+        audio.play(frames)
+        time.sleep(ringdown)
+        channel.send('stop')
+
+    audio.stop_recording(recording)
+    rec_array = recording.read(real_dtype())[startnum:]
+    recording.close()
+    del(recording)
+
+    timer('processing', samples=rec_array.size)
+    own = _find_peak(names[0], order, rec_array, use_fht=False)
+    residual = cancel_sound(names[0], order, rec_array, own[0])
+    other = _find_peak(names[1], order, residual, use_fht=False)
+    separation = min(own[2], other[2])
+    separation = min(separation, channel.exchange('quality', separation)[0])
+    (other_peak, ratio) = _correct_drift(names[1], order, residual, other[0])
+    dn = other_peak - own[0]
+    dt = float(dn) / REC_HZ
+    ratio = _clock_ratio(ratio, channel.exchange('drift', ratio)[0],
+                         am_server)
+    other_dt = channel.exchange('dt', dt)[0]
+    # Both times in samples of the server's clock
     if am_server:
-        mls_wav_file = write_wav(mls)
+        result = (dt + other_dt * ratio) / 2
     else:
-        mls_wav_file = write_wav(mls_rev)
-
-    if send_signal:
-        send_signal('waiting')
-    ready_command = 'ready'
+        result = (dt * ratio + other_dt) / 2
+    back = fallback and separation < SIMUL_MIN_PSR
+    timer('done', own_peak=float(own[0]), other_peak=float(other_peak),
+          own_psr=float(own[2]), other_psr=float(other[2]),
+          separation=separation, fallback=back, dt=dt, other_dt=other_dt,
+          ppm=(ratio - 1) * 1e6, rtt=channel.rtt, order=order,
+          result=result)
+    if back:
+        return _measure_round(channel, am_server, timer, audio,
+                              order)['result']
+    return result
+
+
+def aggregate(values, trim=BURST_TRIM, z=1.96):
+    """
+    Returns robust statistics of a list of measurements as a dict:
+      'n': the number of values
+      'median', 'trimmed_mean': the trimmed_mean drops the fraction trim
+        of the values at each end
+      'low', 'high': a distribution-free confidence interval for the
+        median, from order statistics, at the level of the normal
+        quantile z (95% by default); the extremes for small n
+      'spread': the median absolute deviation, scaled to estimate the
+        standard deviation of normally distributed values
+    """
+    a = num.sort(num.asarray(values, num.float))
+    n = a.size
+    cut = int(trim * n)
+    kept = a[cut:n - cut]
+    half = z * math.sqrt(n) / 2
+    lo = max(0, int(math.floor(n / 2.0 - half)))
+    hi = min(n - 1, int(math.ceil(n / 2.0 + half)) - 1)
+    median = float(num.median(a))
+    return {'n': n,
+            'median': median,
+            'trimmed_mean': float(kept.mean()),
+            'low': float(a[lo]),
+            'high': float(a[hi]),
+            'spread': 1.4826 * float(num.median(num.abs(a - median)))}
+
+
+def _burst_round(am_server, order, mls, mls_rev, rec1, rec2):
+    """
+    Analyzes a round of measure_dt_burst whose halves were recorded in
+    rec1 and rec2, and returns (dt, psr, ratio, s_value, c_value): the
+    time (s) between the two sounds, the worse peak_to_sidelobe ratio, the
+    ratio of the sample clocks by this peer, and the server's and the
+    client's correlation peaks
+    """
+    ((s_peak, s_value, s_psr), (c_peak, c_value, c_psr)) = \
+        _correlate_halves(mls, mls_rev, rec1, rec2, order)
     if am_server:
-        received = recvmsg(s, ready_command)
-        assert received
+        (c_peak, ratio) = _correct_drift('mls_rev', order, rec2, c_peak)
     else:
-        s.sendall(ready_command)
+        (s_peak, ratio) = _correct_drift('mls', order, rec1, s_peak)
+    dn = (c_peak + rec1.size) - s_peak
+    return (float(dn) / REC_HZ, min(s_psr, c_psr), ratio, s_value, c_value)
+
+
+def _burst_row(analyses):
+    """
+    Returns the results message of a peer, given its _burst_round of each
+    round: the dt, the worse peak_to_sidelobe and the clock ratio of each
+    """
+    return [x for analysis in analyses for x in analysis[:3]]
 
-    start_and_play_command = 'start recording'
+
+def _burst_stats(am_server, mine, other):
+    """
+    Works out a burst from the results messages of both peers, and
+    returns (results, ratio, psr): the result of each round, the median
+    ratio of the server's sample clock to the client's, and the median
+    worse peak-to-sidelobe ratio
+    """
+    if len(other) != len(mine):
+        raise ProtocolError("%i results for %i rounds"
+                            % (len(other) / 3, len(mine) / 3))
+    n = len(mine)
+    # The clocks do not change over a burst, so their ratio is the median
+    ratio = float(num.median([_clock_ratio(mine[i], other[i], am_server)
+                              for i in xrange(2, n, 3)]))
+    (server, client) = (mine, other) if am_server else (other, mine)
+    results = [abs(server[i] - client[i] * ratio) / 2
+               for i in xrange(0, n, 3)]
+    psr = float(num.median([min(mine[i], other[i])
+                            for i in xrange(1, n, 3)]))
+    return (results, ratio, psr)
+
+
+def measure_dt_burst(s, am_server, rounds=BURST_ROUNDS, send_signal=False,
+                     audio=None, send_event=None, order=None, adaptive=None):
+    """
+    Performs rounds measure_dt_seq exchanges back to back within a single
+    recording, and returns the aggregate of their results.  The server's
+    rounds is used by both peers, and each turn carries the round number.
+    The peaks of each round are found in a worker thread while the next
+    round is recorded, and the peers exchange all their times at the end.
+
+    The 'done' event holds the aggregate and 'results', the result of each
+    round.  If adaptive is an AdaptiveOrder, its order is used for the
+    whole burst, and the next order is agreed from the median quality of
+    the rounds.
+    """
+    if audio is None:
+        audio = backend
+    channel = as_channel(s)
+    if adaptive is not None:
+        order = adaptive.order
+    order = order or MLS_INDEX
+    timer = PhaseTimer(send_signal, send_event,
+                       role='server' if am_server else 'client')
+
+    (order, mls, mls_rev, frames) = _agree_order(channel, am_server, timer,
+                                                 order)
     if am_server:
-        s.sendall(start_and_play_command)
+        channel.send('rounds', rounds)
     else:
-        received = recvmsg(s, start_and_play_command)
-        assert received
+        rounds = channel.recv('rounds')[0]
+
+    amp_ringdown = 0.2
+
+    analyses = [None] * rounds
+    slots = []  # Where each half of each round is, for the archive
+    workers = _RoundThreads()
 
-    if send_signal:
-        send_signal('playing')
+    def analyze(k, startnum, breaknum, endnum):
+        rec1 = store.wait_slice(startnum, breaknum).astype(real_dtype())
+        rec2 = store.wait_slice(breaknum, endnum).astype(real_dtype())
+        analyses[k] = _burst_round(am_server, order, mls, mls_rev, rec1,
+                                   rec2)
 
     t1 = time.time()
-    (pipeline, rec_wav_file) = start_recording_alsa()
+    recording = audio.start_recording()
     t2 = time.time()
 
-    start_confirmation_command = 'started'
-    if am_server:
-        received = recvmsg(s, start_confirmation_command)
-        assert received
-    else:
-        s.sendall(start_confirmation_command)
+    store = SampleStore()
+    tail_stop = threading.Event()
+    tail = threading.Thread(target=tail_recording,
+                            args=(recording, store.feed, tail_stop))
+    tail.daemon = True
+    tail.start()
+    try:
+        _started(channel, am_server, amp_ringdown)
+
+        startnum = int(math.ceil(amp_ringdown * REC_HZ))
+        for k in xrange(rounds):
+            timer('playing', seq=k)
+            # Each peer hands the turn over by sending the round number
+            breaknum = _take_turn(channel, am_server, audio, frames, t1, t2,
+                                  k)[1]
+            if am_server:
+                other_seq = channel.recv('turn')[0]
+                if other_seq != k:
+                    raise ProtocolError("round %i, peer is at %i"
+                                        % (k, other_seq))
+                endnum = int(math.ceil((time.time() - t1) * REC_HZ))
+                time.sleep(t2 - t1)
+            else:
+                endnum = int(math.ceil((time.time() - t1) * REC_HZ))
+                channel.send('turn', k)
+            workers.start(analyze, k, startnum, breaknum, endnum)
+            slots.extend([(startnum, breaknum, 0), (breaknum, endnum, 1)])
+            startnum = endnum
+
+        if am_server:
+            channel.recv('stop')
+        else:
+            channel.send('stop')
+    finally:
+        audio.stop_recording(recording)
+        tail_stop.set()
+        tail.join()
+        store.close()
+        recording.close()
+    del(recording)
+
+    timer('processing', rounds=rounds, samples=store.nsamples)
+    workers.join()
+
+    mine = _burst_row(analyses)
+    other = channel.exchange('results', *mine)
+    (results, ratio, psr) = _burst_stats(am_server, mine, other)
+    if ARCHIVE_DIR:
+        _archive(store, 'burst', 0 if am_server else 1, order, 2, rounds,
+                 slots, mine + list(other))
+
+    if adaptive is not None:
+        if am_server:
+            next_order = adaptive.choose(order, psr)
+            channel.send('order', next_order, True)
+        else:
+            next_order = channel.recv('order')[0]
+        adaptive.order = next_order
+        adaptive.psr = psr
 
-    amp_ringdown = 0.2
-    time.sleep(amp_ringdown)
+    stats = aggregate(results)
+    timer('done', results=results, psr=psr, ppm=(ratio - 1) * 1e6,
+          rtt=channel.rtt, order=order, **stats)
+    return stats
 
-    handoff_command = 'your turn'
-    ringdown = 0.3  # seconds
-    if am_server:
-        print "about to play_wav"
-        play_wav_alsa(mls_wav_file.name)
-        print "played wav"
-        time.sleep(ringdown)
-        t3 = time.time()
-        time.sleep(t2 - t1)
-        s.sendall(handoff_command)
-    else:
-        received = recvmsg(s, handoff_command)
-        assert received
-        t3 = time.time()
-        time.sleep(t2 - t1)
-        play_wav_alsa(mls_wav_file.name)
-        time.sleep(ringdown)
 
-    stop_command = 'stop'
-    if am_server:
-        received = recvmsg(s, stop_command)
-        assert received
-    else:
-        s.sendall(stop_command)
+MATRIX_KEYS = ('median', 'low', 'high', 'ppm')
 
-    stop_recording_alsa(pipeline)
-    del(pipeline)
-    mls_wav_file.close()
-    del(mls_wav_file)
-    rec_array = read_recorded_file(rec_wav_file)
-    rec_wav_file.close()
-    os.remove(rec_wav_file.name)
-    del(rec_wav_file)
 
-    if send_signal:
-        send_signal('processing')
+def _slot_windows(times, slot, sample):
+    """
+    Returns the (first, end) samples of the window of each slot starting
+    at the given times, from MATRIX_GUARD before it starts to as long
+    before the next; sample(t) is the sample recorded at time t
+    """
+    return [(sample(t - MATRIX_GUARD), sample(t + slot - MATRIX_GUARD))
+            for t in times]
 
-    breaktime = t3 - t1
-    print breaktime
-    breaknum = int(math.ceil(breaktime * REC_HZ))
-    startnum = int(math.ceil(amp_ringdown * REC_HZ))
-    rec1 = rec_array[startnum:breaknum]
-    rec2 = rec_array[breaknum:]
-    print num.size(rec1)
-    print num.size(rec2)
 
-    if ('mls_float', MLS_INDEX) in cache_dict:
-        mls_float = cache_dict[('mls_float', MLS_INDEX)]
-    else:
-        mls_float = mls - 0.5
-        cache_dict[('mls_float', MLS_INDEX)] = mls_float
+def _slot_layout(windows):
+    """Returns the archive.Capture slots of the _slot_windows of a round"""
+    return [(first, end, k) for (k, (first, end)) in enumerate(windows)]
+
+
+def _archive(store, kind, index, order, n, rounds, slots, values):
+    """
+    Saves the recording in store to ARCHIVE_DIR, with the arguments of
+    archive.save
+    """
+    archive.save(ARCHIVE_DIR, store.wait_slice(0, store.nsamples), kind,
+                 index, order, REC_HZ, n, rounds, slots, values)
+
+
+def _slot_peaks(index, order, windows, recs):
+    """
+    Finds device k's sequence in recs[k], the recording of its slot, and
+    returns a (time, psr, ratio, value) for each: the time (s) from the
+    start of the recording, the ratio of the sample clock of device index
+    to that of device k, and the magnitude of the peak
+    """
+    found = run_parallel([(k, order, rec.astype(real_dtype()))
+                          for (k, rec) in enumerate(recs)])
+    peaks = []
+    for (k, (lo, hi)) in enumerate(windows):
+        (peak, value, psr) = found[k]
+        ratio = 1.0
+        if k != index:
+            (peak, ratio) = _correct_drift(k, order, recs[k], peak)
+        peaks.append((float(lo + peak) / REC_HZ, psr, ratio, abs(value)))
+    return peaks
+
+
+def _peaks_row(peaks):
+    """
+    Returns the peaks message of a device, given its _slot_peaks for each
+    round: the times of all rounds, then their ratios psr, then the ratios
+    of the clocks
+    """
+    return [x for k in xrange(3) for p in peaks for x in zip(*p)[k]]
+
+
+def _matrix_stats(rows, n, rounds):
+    """
+    Works out the result of every pair of devices from the peaks messages
+    of all n, returning a dict of n x n lists for each of MATRIX_KEYS, and
+    'psr', the median over the rounds of the worst peak-to-sidelobe ratio
+    """
+    m = rounds * n
+    for row in rows:
+        if len(row) != 3 * m:
+            raise ProtocolError("%i peaks for %i rounds of %i devices"
+                                % (len(row) / 3, rounds, n))
+    # heard[j][r][i]: when device j heard device i in round r, and
+    # clocks[j][r][i] the ratio of their sample clocks
+    heard = [[row[r * n:(r + 1) * n] for r in xrange(rounds)]
+             for row in rows]
+    clocks = [[row[2 * m + r * n:2 * m + (r + 1) * n]
+               for r in xrange(rounds)] for row in rows]
+    psr = float(num.median([min([row[m + r * n + i]
+                                 for row in rows for i in xrange(n)])
+                            for r in xrange(rounds)]))
+    stats = dict([(key, []) for key in MATRIX_KEYS])
+    for i in xrange(n):
+        for key in stats:
+            stats[key].append([0.0] * n)
+        for j in xrange(n):
+            if i == j:
+                continue
+            ratio = float(num.median([
+                _clock_ratio(clocks[i][r][j], clocks[j][r][i], True)
+                for r in xrange(rounds)]))
+            # In samples of device i's clock
+            results = [abs((heard[i][r][j] - heard[i][r][i])
+                           - (heard[j][r][j] - heard[j][r][i]) * ratio)
+                       / 2 for r in xrange(rounds)]
+            a = aggregate(results)
+            a['ppm'] = (ratio - 1) * 1e6
+            for key in stats:
+                stats[key][i][j] = a[key]
+    stats['psr'] = psr
+    return stats
+
+
+def _matrix_result(index, n, order, rounds, peaks):
+    """
+    Returns the part of the result of measure_dt_matrix that is this
+    device's own, given its _slot_peaks for each round
+    """
+    return {'index': index, 'n': n, 'order': order, 'rounds': rounds,
+            'peak': [float(num.median([p[k][3] for p in peaks]))
+                     for k in xrange(n)]}
+
+
+def _matrix_flatten(stats):
+    """Returns the matrix message of _matrix_stats: the matrices, then psr"""
+    return ([x for key in MATRIX_KEYS for row in stats[key] for x in row]
+            + [stats['psr']])
+
+
+def _matrix_unflatten(flat, n):
+    """Returns the _matrix_stats in a matrix message"""
+    if len(flat) != len(MATRIX_KEYS) * n * n + 1:
+        raise ProtocolError("%i values for %i %i x %i matrices and psr"
+                            % (len(flat), len(MATRIX_KEYS), n, n))
+    stats = dict([(key, [list(flat[(k * n + i) * n:(k * n + i + 1) * n])
+                         for i in xrange(n)])
+                  for (k, key) in enumerate(MATRIX_KEYS)])
+    stats['psr'] = flat[-1]
+    return stats
 
-    if ('mls_rev_float', MLS_INDEX) in cache_dict:
-        mls_rev_float = cache_dict[('mls_rev_float', MLS_INDEX)]
+
+def measure_dt_matrix(s, am_scheduler, rounds=1, send_signal=False,
+                      audio=None, send_event=None, order=None,
+                      adaptive=None):
+    """
+    Ranges any number of devices at once.  The scheduler passes as s a
+    list of connections (sockets or Channels) to all the other devices,
+    and each of them its connection to the scheduler.  The scheduler
+    numbers the devices, itself 0, and each device plays its own
+    device_sequence in its own time slot, rounds times over.  Every device
+    records the whole schedule once and finds the peaks of all the
+    sequences in it, a round at a time while the next is recorded.  The
+    scheduler then works out the result of each pair as measure_dt_seq
+    would, and sends the matrix to all.
+
+    Returns a dict with 'index', the number of this device, 'n', the
+    number of devices, 'order' and 'rounds', as used, and 'median', 'low'
+    and 'high', n x n lists of the aggregate over the rounds of the
+    results, as measure_dt_burst gives for two devices, and 'ppm', by how
+    much the sample clock of each device is faster than that of each
+    other.  'peak' is the median magnitude of the correlation peak of each
+    device in this one's recording, and 'psr' the median over the rounds
+    of the worst peak-to-sidelobe ratio of any device.  rounds, order and
+    adaptive (an AdaptiveOrder) are taken from the scheduler.
+    """
+    if audio is None:
+        audio = backend
+    if am_scheduler:
+        channels = [as_channel(c) for c in s]
+        if adaptive is not None:
+            order = adaptive.order
     else:
-        mls_rev_float = mls_rev - 0.5
-        cache_dict[('mls_rev_float', MLS_INDEX)] = mls_rev_float
-    xc_server = cross_cov(mls_float, rec1, ('mls_float', MLS_INDEX))
-    xc_client = cross_cov(mls_rev_float, rec2, ('mls_rev_float', MLS_INDEX))
-    s_peak = getpeak(xc_server)
-    c_peak = getpeak(xc_client)
-    print xc_server[s_peak]
-    print xc_client[c_peak]
-    dn = (c_peak + breaknum) - s_peak
-    dt = float(dn) / REC_HZ
-    format_string = '!d'
-    n = struct.calcsize(format_string)
-    s.sendall(struct.pack(format_string, dt))
-    other_dt = struct.unpack(format_string, recvall(s, n))[0]
+        channels = [as_channel(s)]
+    order = order or MLS_INDEX
+    timer = PhaseTimer(send_signal, send_event,
+                       role='scheduler' if am_scheduler else 'device')
+
+    timer('preparing', order=order)
+    _sequences(order)
+
+    timer('waiting')
+    if am_scheduler:
+        (index, n) = (0, len(channels) + 1)
+        slot = float(2**order - 1) / REC_HZ + 2 * MATRIX_GUARD
+        for (i, channel) in enumerate(channels):
+            _handshake(channel, True, order, mode=MODE_MATRIX)
+            channel.send('schedule', i + 1, n, rounds, slot)
+    else:
+        order = _handshake(channels[0], False, order, mode=MODE_MATRIX)
+        (index, n, rounds, slot) = channels[0].recv('schedule')
+    frames = cache.fetch(('frames', 'seq', index, order),
+                         lambda: render_samples(device_sequence(index,
+                                                                order)))
 
-    roundtrip = abs(dt - other_dt)
+    def sample(t):
+        return max(0, int(math.ceil((t - t1) * REC_HZ)))
 
-    # pylab.plot(xc_server)
-    # pylab.show()
+    peaks = [None] * rounds
+    slots = []  # Where the slot of each device is, for the archive
+    workers = _RoundThreads()
+
+    def analyze(r, windows):
+        recs = [store.wait_slice(lo, hi) for (lo, hi) in windows]
+        peaks[r] = _slot_peaks(index, order, windows, recs)
 
-    if send_signal:
-        send_signal('done')
+    t1 = time.time()
+    recording = audio.start_recording()
+
+    store = SampleStore()
+    tail_stop = threading.Event()
+    tail = threading.Thread(target=tail_recording,
+                            args=(recording, store.feed, tail_stop))
+    tail.daemon = True
+    tail.start()
+    try:
+        if am_scheduler:
+            for channel in channels:
+                channel.recv('started')
+            for channel in channels:
+                channel.send('go')
+        else:
+            channels[0].send('started')
+            channels[0].recv('go')
+        amp_ringdown = 0.2
+        t_start = time.time() + amp_ringdown + MATRIX_GUARD
+
+        for r in xrange(rounds):
+            timer('playing', seq=r, index=index, n=n)
+            times = [t_start + (r * n + i) * slot for i in xrange(n)]
+            windows = _slot_windows(times, slot, sample)
+            workers.start(analyze, r, windows)
+            slots.extend(_slot_layout(windows))
+            time.sleep(max(0, times[index] - time.time()))
+            audio.play(frames)
+        time.sleep(max(0, t_start + rounds * n * slot - time.time()))
+    finally:
+        audio.stop_recording(recording)
+        tail_stop.set()
+        tail.join()
+        store.close()
+        recording.close()
+    del(recording)
+
+    timer('processing', rounds=rounds, samples=store.nsamples)
+    workers.join()
+
+    mine = _peaks_row(peaks)
+    if am_scheduler:
+        rows = [mine] + [channel.recv('peaks') for channel in channels]
+        stats = _matrix_stats(rows, n, rounds)
+        if ARCHIVE_DIR:
+            _archive(store, 'matrix', index, order, n, rounds, slots,
+                     [x for row in rows for x in row])
+        next_order = order
+        if adaptive is not None:
+            next_order = adaptive.choose(order, stats['psr'])
+        flat = _matrix_flatten(stats)
+        for channel in channels:
+            channel.send('matrix', *flat)
+            channel.send('order', next_order, True)
+    else:
+        channels[0].send('peaks', *mine)
+        if ARCHIVE_DIR:
+            _archive(store, 'matrix', index, order, n, rounds, slots, mine)
+        stats = _matrix_unflatten(channels[0].recv('matrix'), n)
+        next_order = channels[0].recv('order')[0]
+    if adaptive is not None:
+        adaptive.order = next_order
+        adaptive.psr = stats['psr']
 
-    return roundtrip / 2
+    result = _matrix_result(index, n, order, rounds, peaks)
+    result.update(stats)
+    timer('done', **result)
+    return result
 
 
 def getpeak(a):
     return num.argmax(abs(a))
 
 
-def speed_of_sound(t=25.0, h=0.6, p=101325.0, x_c=0.0004):
-    """
-    t= temperature in Celsius
-    h = relative humidity as a fraction
-    p = pressure in Pa
-    x_c = mole fraction of CO2
-    returns an estimate of the speed of sound in (m/s)
-    from Cramer, O. "The variation of the specific heat ratio and the
-    speed of sound in air with temperature, pressure, humidity, and
-    CO2 concentration". Journal of the Acoustical Society of America,
-    1993, Vol. 93, Issue 5, p. 2510, eq. 15 and A1-A3."""
-
-    a0 = 331.5024
-    a1 = 0.603055
-    a2 = -0.000528
-    a3 = 51.471935
-    a4 = 0.1495874
-    a5 = -0.000782
-    a6 = -1.82e-7
-    a7 = 3.73e-8
-    a8 = -2.93e-10
-    a9 = -85.20931
-    a10 = -0.228525
-    a11 = 5.91e-5
-    a12 = -2.835149
-    a13 = -2.15e-13
-    a14 = 29.179762
-    a15 = 0.000486
-
-    t2 = t**2
-    T = t + 273.15
-
-    f = 1.00062 + 3.14e-8 * p + 5.6e-7 * t2
-    psv = math.exp(1.2811805e-5 * (T**2) - 1.9509874e-2 * T +
-                   34.04926034 - 6.3536311e3 / T)  # Pa
-    x_w = h * f * psv / p
-
-    return a0 + a1 * t + a2 * t2 + (a3 + a4 * t + a5 * t2) * x_w \
-        + (a6 + a7 * t + a8 * t2) * p + (a9 + a10 * t + a11 * t2) * x_c \
-        + a12 * (x_w**2) + a13 * (p**2) + a14 * (x_c**2) + a15 * x_w * p * x_c
+def peak_neighbourhood(a, k, h=None):
+    """
+    Returns a[k - h:k + h + 1], with zeros beyond the ends of a.  h
+    defaults to PEAK_HALFWIDTH.
+    """
+    if h is None:
+        h = PEAK_HALFWIDTH
+    y = num.zeros((2 * h + 1))
+    lo = max(0, k - h)
+    hi = min(a.size, k + h + 1)
+    y[lo - (k - h):hi - (k - h)] = a[lo:hi]
+    return y
+
+
+def _parabolic_vertex(y0, y1, y2):
+    """Offset from the middle of the vertex of the parabola through y"""
+    d = y0 - 2 * y1 + y2
+    if d >= 0:
+        return 0.0
+    return max(-0.5, min(0.5, 0.5 * (y0 - y2) / d))
+
+
+def interpolate_peak(y, method=None):
+    """
+    Estimates the fractional offset of a correlation peak from the middle
+    sample of y, an odd-length neighbourhood of the integer peak, as from
+    peak_neighbourhood.  method is one of
+      'parabolic': fits a parabola to the three middle samples
+      'gaussian': fits a parabola to their logarithms, which is exact for
+        a Gaussian peak
+      'sinc': evaluates the band-limited (sinc) interpolation of all of y
+        on a grid of 1/32 sample near the peak, then refines on that grid
+      None: returns 0.0
+    method defaults to PEAK_INTERPOLATION.
+    """
+    if method is None:
+        method = PEAK_INTERPOLATION
+    if not method:
+        return 0.0
+    h = y.size / 2
+    y = y * math.copysign(1, y[h])  # Negative peaks count too
+    if method == 'parabolic':
+        return _parabolic_vertex(y[h - 1], y[h], y[h + 1])
+    if method == 'gaussian':
+        if min(y[h - 1], y[h], y[h + 1]) <= 0:
+            return _parabolic_vertex(y[h - 1], y[h], y[h + 1])
+        return _parabolic_vertex(math.log(y[h - 1]), math.log(y[h]),
+                                 math.log(y[h + 1]))
+    if method == 'sinc':
+        x = num.linspace(-1, 1, 65)
+        fine = num.dot(num.sinc(x[:, num.newaxis] - num.arange(-h, h + 1)),
+                       y)
+        i = max(1, min(x.size - 2, num.argmax(fine)))
+        step = x[1] - x[0]
+        return x[i] + step * _parabolic_vertex(fine[i - 1], fine[i],
+                                               fine[i + 1])
+    raise ValueError("unknown peak interpolation: %r" % method)
+
+
+def peak_to_sidelobe(a, k, h=None):
+    """
+    Returns the ratio of |a[k]| to the RMS of a outside k - h...k + h,
+    a measure of how far the peak at k stands above the noise floor.  h
+    defaults to PEAK_HALFWIDTH.
+    """
+    if h is None:
+        h = PEAK_HALFWIDTH
+    lo = max(0, k - h)
+    hi = min(a.size, k + h + 1)
+    n = a.size - (hi - lo)
+    if n <= 0:
+        return float('inf')
+    energy = num.dot(a[:lo], a[:lo]) + num.dot(a[hi:], a[hi:])
+    if energy <= 0:
+        return float('inf')
+    return abs(a[k]) / math.sqrt(energy / n)
+
+
+def getpeak_fine(a, method=None):
+    """Like getpeak, but refined to a fractional index by interpolate_peak"""
+    k = getpeak(a)
+    return k + interpolate_peak(peak_neighbourhood(a, k), method)
 
 
 def interactive_mode():
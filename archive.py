@@ -0,0 +1,192 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+An archive of the raw recordings of measurements, so that they can be
+processed again offline.
+
+Each capture is one file: a fixed header, the slot layout of the
+recording and the values needed to work out the measurement again, then
+the whole recording as little-endian int16.  A slot is the stretch of the
+recording in which one device plays: the two halves of a measure_dt_seq
+round, of each round of measure_dt_burst, or the slot of each device in
+each round of measure_dt_matrix.  Opening a capture reads only the header
+and maps the samples, so any number of captures can be gone through one
+after the other at the speed of the disk.  arange writes a capture of
+every measurement when arange.ARCHIVE_DIR is set; replay.py processes
+them.
+"""
+
+import glob
+import math
+import os
+import os.path
+import struct
+import time
+
+import numpy as num
+
+SUFFIX = '.dcap'
+
+_MAGIC = 'DCAP'
+_VERSION = 2
+# magic, version, kind, number of this device, MLS order, sample rate,
+# samples, devices, rounds, slots, values, time of the capture
+_HEADER = struct.Struct('<4sHBBBIIHHHHd')
+_SLOT = struct.Struct('<IIB')  # first and end sample, device that plays
+_ALIGN = 64  # The samples start at a multiple of this
+# Version 1 only held measure_dt_seq rounds: magic, version, role, MLS
+# order, sample rate, samples, first sample of the first half, first
+# sample of the second half, time of the capture, breaktime, dt, the
+# peer's dt, ratio of the sample clocks
+_HEADER_1 = struct.Struct('<4sHBBIIIIddddd')
+_SAMPLES_AT_1 = 64
+
+# Kinds of capture.  The values of each:
+#   'seq': breaktime (s), dt, the peer's dt and the ratio of the server's
+#     sample clock to the client's
+#   'burst': the results message of this device, then the peer's
+#   'matrix': the peaks messages of all the devices, in order, as the
+#     scheduler has them, or only this device's
+KINDS = ('seq', 'burst', 'matrix')
+
+
+class ArchiveError(Exception):
+    """The file is not a capture this version can read"""
+    pass
+
+
+class Capture(object):
+    """
+    A capture opened from the archive.  samples is the whole recording,
+    mapped read-only, and the header fields are attributes: kind, one of
+    KINDS, index, the number of this device (the server is 0), role
+    ('server' or 'client', or 'scheduler' or 'device'), order, rate, n,
+    the number of devices, rounds, time, slots, a (first, end, device)
+    for each slot, and values, as described by KINDS.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        header = f.read(_HEADER_1.size)
+        if len(header) >= 6 and struct.unpack('<H', header[4:6])[0] == 1:
+            samples_at = self._read_1(header)
+        else:
+            samples_at = self._read(f, header[:_HEADER.size])
+        f.close()
+        if self.kind == 'matrix':
+            self.role = 'scheduler' if self.index == 0 else 'device'
+        else:
+            self.role = ('server', 'client')[self.index]
+        if os.path.getsize(path) < samples_at + 2 * self.nsamples:
+            raise ArchiveError("%s: truncated capture" % path)
+        if self.nsamples:
+            self.samples = num.memmap(path, '<i2', 'r', samples_at,
+                                      (self.nsamples,))
+        else:
+            self.samples = num.zeros((0), num.int16)
+
+    def _read(self, f, header):
+        """Reads the header and returns the offset of the samples"""
+        if len(header) < _HEADER.size:
+            raise ArchiveError("%s: too short for a capture" % self.path)
+        (magic, version, kind, self.index, self.order, self.rate,
+         self.nsamples, self.n, self.rounds, nslots, nvalues,
+         self.time) = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise ArchiveError("%s: not a capture" % self.path)
+        if version != _VERSION or kind >= len(KINDS):
+            raise ArchiveError("%s: capture version %i, kind %i"
+                               % (self.path, version, kind))
+        self.kind = KINDS[kind]
+        f.seek(_HEADER.size)
+        data = f.read(nslots * _SLOT.size + 8 * nvalues)
+        if len(data) < nslots * _SLOT.size + 8 * nvalues:
+            raise ArchiveError("%s: truncated capture" % self.path)
+        self.slots = [_SLOT.unpack_from(data, k * _SLOT.size)
+                      for k in xrange(nslots)]
+        self.values = num.frombuffer(data, '<f8', nvalues,
+                                     nslots * _SLOT.size)
+        return _samples_at(nslots, nvalues)
+
+    def _read_1(self, header):
+        """Reads a version 1 header, of a measure_dt_seq round"""
+        if len(header) < _HEADER_1.size:
+            raise ArchiveError("%s: too short for a capture" % self.path)
+        (magic, version, self.index, self.order, self.rate, self.nsamples,
+         startnum, breaknum, self.time, breaktime, dt, other_dt,
+         ratio) = _HEADER_1.unpack(header)
+        if magic != _MAGIC:
+            raise ArchiveError("%s: not a capture" % self.path)
+        (self.kind, self.n, self.rounds) = ('seq', 2, 1)
+        self.slots = [(startnum, breaknum, 0),
+                      (breaknum, self.nsamples, 1)]
+        self.values = num.array([breaktime, dt, other_dt, ratio])
+        return _SAMPLES_AT_1
+
+    def slot(self, k):
+        """The samples of slot k"""
+        (first, end, device) = self.slots[k]
+        return self.samples[first:end]
+
+
+def _samples_at(nslots, nvalues):
+    """Returns the offset of the samples, after the header and layout"""
+    size = _HEADER.size + nslots * _SLOT.size + 8 * nvalues
+    return int(math.ceil(float(size) / _ALIGN)) * _ALIGN
+
+
+def save(directory, samples, kind, index, order, rate, n, rounds, slots,
+         values):
+    """
+    Writes a capture of the recording samples to a new file in directory,
+    which is created if need be, and returns its path.  The arguments are
+    the attributes of the Capture.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    now = time.time()
+    name = 'capture-%s-%06i-%s-%i' % (time.strftime('%Y%m%d-%H%M%S',
+                                                    time.localtime(now)),
+                                      int(now % 1 * 1e6), kind, index)
+    path = os.path.join(directory, name + SUFFIX)
+    samples = num.asarray(samples).astype('<i2')
+    head = (_HEADER.pack(_MAGIC, _VERSION, KINDS.index(kind), index, order,
+                         rate, samples.size, n, rounds, len(slots),
+                         len(values), now)
+            + ''.join([_SLOT.pack(*slot) for slot in slots])
+            + num.asarray(values, '<f8').tostring())
+    f = open(path + '.part', 'wb')
+    f.write(head + '\0' * (_samples_at(len(slots), len(values)) - len(head)))
+    f.write(samples.tostring())
+    f.close()
+    os.rename(path + '.part', path)
+    return path
+
+
+def captures(paths):
+    """
+    Yields the Capture of each file in paths, and of each capture file in
+    the directories among them, in order of name
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(glob.glob(os.path.join(path, '*' + SUFFIX)))
+        else:
+            names = [path]
+        for name in names:
+            yield Capture(name)
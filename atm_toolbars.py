@@ -16,7 +16,7 @@
 
 from gi.repository import Gtk
 from gi.repository import GObject
-import arange
+import acoustics
 import locale
 from gettext import gettext as _
 
@@ -134,7 +134,7 @@ class TempToolbar(Gtk.Toolbar):
         h = self.get_humid()
 
         if (t is not None) and (h is not None):
-            s = arange.speed_of_sound(t, h / 100)
+            s = acoustics.speed_of_sound(t, h / 100)
             self._set_speed(s)
         else:
             self._result.set_text('')
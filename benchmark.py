@@ -0,0 +1,542 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Benchmarks for the signal processing in arange.  These need no sound
+hardware.  Run as
+
+    python benchmark.py mls [nmin [nmax]]
+    python benchmark.py correlator [seconds]
+    python benchmark.py accuracy [trials [noise]]
+    python benchmark.py e2e [runs [output.json]]
+    python benchmark.py burst [rounds]
+    python benchmark.py simul [runs [drive]]
+    python benchmark.py workers [seconds]
+    python benchmark.py precision [seconds]
+    python benchmark.py startup [runs]
+    python benchmark.py compare baseline.json current.json [tolerance]
+
+The e2e suite writes JSON results; compare exits with status 1 if any
+median in current.json is more than tolerance (default 0.2) slower.
+startup times the import of each module the activity needs, and exits
+with status 1 if importing activity loads any of STARTUP_DEFERRED.
+"""
+
+import StringIO
+import json
+import math
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as num
+
+import arange
+import roomsim
+
+PHASES = ('preparing', 'waiting', 'playing', 'processing')
+
+# Modules timed by bench_startup, those the activity imports first
+STARTUP_MODULES = ('gi.repository.Gtk', 'sugar3.activity.activity',
+                   'atm_toolbars', 'smoot_toolbar', 'acoustics', 'dbus',
+                   'gi.repository.TelepathyGLib', 'numpy', 'arange',
+                   'engine', 'history', 'activity')
+# and those it must only import once sharing or measuring starts
+STARTUP_DEFERRED = ('dbus', 'gi.repository.TelepathyGLib', 'numpy',
+                    'arange', 'engine', 'history')
+
+_IMPORT_TIMER = '''
+import json, sys, time
+t = time.time()
+try:
+    __import__(sys.argv[1])
+except Exception as e:
+    print json.dumps({'error': '%s: %s' % (type(e).__name__, e)})
+else:
+    print json.dumps({'time': time.time() - t,
+                      'loaded': [m for m in sys.argv[2:] if m in sys.modules]})
+'''
+
+
+def _best_time(func, repeat):
+    """Returns the smallest wall time (s) of repeat calls of func()"""
+    best = None
+    for i in xrange(repeat):
+        t = time.time()
+        func()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def _cpu_time(func, repeat):
+    """Returns the mean process CPU time (s) of repeat calls of func()"""
+    t = time.clock()
+    for i in xrange(repeat):
+        func()
+    return (time.clock() - t) / repeat
+
+
+def _synthetic_recording(mls, seconds, offset=5000, seed=0):
+    """An int16 recording of the given length with mls buried in noise"""
+    rng = num.random.RandomState(seed)
+    rec = rng.normal(0, 500, int(seconds * arange.REC_HZ))
+    rec[offset:offset + mls.size] += 2000 * (mls[:rec.size - offset] - 0.5)
+    return rec.astype(num.int16)
+
+
+def bench_mls(nmin=10, nmax=24, repeat=3):
+    """
+    Compares the naive per-sample LFSR with the block generator used by
+    compute_mls for MLS orders nmin...nmax, checking that both agree.
+    """
+    print "%3s %10s %12s %12s %8s" % ('n', 'length', 'LFSR (s)',
+                                      'blocks (s)', 'speedup')
+    for n in xrange(nmin, nmax + 1):
+        taps = [i - 1 for i in arange.MLS_TAPS[n]]
+        m = 2**n - 1
+
+        def naive():
+            return arange.LFSR(num.zeros((n)) == 0, taps, m)
+
+        def blocks():
+            return arange.LFSR_blocks(num.zeros((n)) == 0, taps, m)
+
+        assert (naive() == blocks()).all()
+        # The naive generator takes minutes for large n; time it once.
+        t_naive = _best_time(naive, 1 if n > 18 else repeat)
+        t_blocks = _best_time(blocks, repeat)
+        print "%3i %10i %12.4f %12.4f %8.0f" % (n, m, t_naive, t_blocks,
+                                                t_naive / t_blocks)
+
+
+def bench_correlator(seconds=1.0, repeat=20):
+    """
+    Compares the CPU time of finding the peak of one half of a measurement
+    (a recording of the given length) with the FFT cross_cov and with the
+    fast Hadamard transform.  Both run on a single core, so the ratio is
+    what a low-end single-core machine saves per correlation.
+    """
+    mls = arange.compute_mls(num.zeros((arange.MLS_INDEX)) == 0)
+    mls_float = mls - 0.5
+    rec = _synthetic_recording(mls, seconds)
+    arange.cache.clear()
+
+    def fft():
+        return arange.getpeak(arange.cross_cov(mls_float, rec, 'bench'))
+
+    def fht():
+        return arange.mls_peak(mls, rec, 'bench')[0]
+
+    assert fft() == fht()
+    t_fft = _cpu_time(fft, repeat)
+    t_fht = _cpu_time(fht, repeat)
+    print "MLS order %i, %i samples" % (arange.MLS_INDEX, rec.size)
+    print "FFT cross_cov: %8.2f ms CPU" % (1000 * t_fft)
+    print "FHT mls_peak:  %8.2f ms CPU" % (1000 * t_fht)
+    print "saved:         %8.2f ms CPU (%.1fx)" % (
+        1000 * (t_fft - t_fht), t_fft / t_fht)
+
+
+def bench_accuracy(trials=200, noise=2000.0, orders=(10, 11, 12, 13, 14),
+                   methods=(None, 'parabolic', 'gaussian', 'sinc')):
+    """
+    Measures the precision of the peak position found by mls_peak_fine for
+    each MLS order and peak interpolation method.  Each trial buries the
+    sequence, delayed by a random fractional number of samples and passed
+    through the simulated speaker, in Gaussian noise of the given standard
+    deviation (unit amplitude for the sequence).  Reports the standard
+    deviation of the error, in samples and in mm of measured distance
+    (a distance combines four peaks, halved, so its error is about that of
+    one peak).
+    """
+    room = roomsim.Room()
+    mm_per_sample = 1000 * room.speed / arange.REC_HZ
+    rng = num.random.RandomState(0)
+    print "%5s %10s %12s %8s" % ('order', 'method', 'std (smp)', 'std (mm)')
+    for n in orders:
+        mls = arange.compute_mls(num.zeros((n)) == 0)
+        errors = dict([(m, []) for m in methods])
+        for i in xrange(trials):
+            d = 200 + rng.uniform(0, 1)
+            (n0, h) = roomsim.fractional_delay(d)
+            x = num.convolve(num.convolve(mls - 0.5, h), room.speaker_ir)
+            rec = rng.normal(0, noise, n0 + x.size + 200)
+            rec[n0:n0 + x.size] += 1000 * x
+            for m in methods:
+                if m is None:
+                    p = arange.mls_peak(mls, rec)[0]
+                else:
+                    p = arange.mls_peak_fine(mls, rec, method=m)[0]
+                errors[m].append(p - d)
+        for m in methods:
+            # The offset of the speaker response is common to both peers
+            e = num.std(errors[m])
+            print "%5i %10s %12.3f %8.2f" % (n, m, e, e * mm_per_sample)
+
+
+def _quiet(func, *args):
+    """Calls func(*args) with the prints of arange sent to /dev/null"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _summary(values):
+    a = num.asarray(values, num.float)
+    return {'median': float(num.median(a)),
+            'mean': float(a.mean()),
+            'min': float(a.min()),
+            'p90': float(num.percentile(a, 90)),
+            'max': float(a.max())}
+
+
+def _component_times(repeat=5):
+    """Times the parts of a measurement that can regress on their own"""
+    mls = arange.compute_mls(num.zeros((arange.MLS_INDEX)) == 0)
+    mls_float = mls - 0.5
+    rec = _synthetic_recording(mls, 1.0)
+    raw = _synthetic_recording(mls, arange.REC_TIMEOUT).tostring()
+    (a, b) = socket.socketpair()
+    (ca, cb) = (arange.Channel(a), arange.Channel(b))
+
+    def handshake():
+        ca.send('started')
+        cb.recv('started')
+        cb.send('stop')
+        ca.recv('stop')
+
+    times = {
+        'compute_mls': _best_time(
+            lambda: arange.compute_mls(num.zeros((arange.MLS_INDEX)) == 0),
+            repeat),
+        'cross_cov': _best_time(
+            lambda: arange.cross_cov(mls_float, rec), repeat),
+        'mls_peak': _best_time(lambda: arange.mls_peak(mls, rec), repeat),
+        'read_raw': _best_time(
+            lambda: arange.read_raw(StringIO.StringIO(raw)), repeat),
+        'handshake': _best_time(handshake, 10 * repeat),
+    }
+    a.close()
+    b.close()
+    return times
+
+
+def bench_e2e(runs=10, output=None, distance=2.0):
+    """
+    Runs runs complete measure_dt_seq rounds, server and client in this
+    process over a socketpair, with a simulated room, and reports the
+    distribution of the wall time of each phase for each role, the process
+    CPU time and peak memory per round, and component timings.  The
+    results are returned, and written as JSON to output if given.
+    """
+    room = roomsim.Room(distance=distance)
+    phases = {'server': dict([(p, []) for p in PHASES]),
+              'client': dict([(p, []) for p in PHASES])}
+    cpu = []
+    wall = []
+    distances = []
+
+    def record(event):
+        if event['previous'] in PHASES:
+            phases[event['role']][event['previous']].append(
+                event['duration'])
+
+    def run():
+        c = time.clock()
+        t = time.time()
+        (dt, other) = roomsim.run_pair(
+            room, lambda s, am_server, audio: arange.measure_dt_seq(
+                s, am_server, audio=audio, send_event=record))
+        wall.append(time.time() - t)
+        cpu.append(time.clock() - c)
+        distances.append(dt * room.speed - arange.OLPC_OFFSET)
+
+    for i in xrange(runs):
+        _quiet(run)
+
+    results = {
+        'version': 1,
+        'mls_index': arange.MLS_INDEX,
+        'rec_hz': arange.REC_HZ,
+        'runs': runs,
+        'distance': distance,
+        'phases': dict([(role, dict([(p, _summary(v))
+                                     for (p, v) in phases[role].items()]))
+                        for role in phases]),
+        'round': _summary(wall),
+        'cpu': _summary(cpu),
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'measured': _summary(distances),
+        'components': _quiet(_component_times),
+    }
+    for role in ('server', 'client'):
+        for p in PHASES:
+            r = results['phases'][role][p]
+            print "%-7s %-11s median %7.1f ms  p90 %7.1f ms" % (
+                role, p, 1000 * r['median'], 1000 * r['p90'])
+    print "round   median %7.1f ms wall, %7.1f ms CPU, peak RSS %i kB" % (
+        1000 * results['round']['median'], 1000 * results['cpu']['median'],
+        results['maxrss_kb'])
+    for (name, t) in sorted(results['components'].items()):
+        print "%-11s %8.3f ms" % (name, 1000 * t)
+    if output:
+        f = open(output, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    return results
+
+
+def bench_burst(rounds=5, distance=2.0, order=13):
+    """
+    Compares the wall time and spread of rounds serial measure_dt_seq
+    rounds with one measure_dt_burst of as many rounds, in a simulated
+    room
+    """
+    room = roomsim.Room(distance=distance, noise=300.0)
+
+    def serial():
+        def measure(s, am_server, audio):
+            return arange.measure_dt_seq(s, am_server, audio=audio,
+                                         order=order)
+        return [roomsim.run_pair(room, measure)[0] for i in xrange(rounds)]
+
+    def burst():
+        return roomsim.run_pair(
+            room, lambda s, am_server, audio: arange.measure_dt_burst(
+                s, am_server, rounds, audio=audio, order=order))[0]
+
+    t = time.time()
+    stats = arange.aggregate(_quiet(serial))
+    t_serial = time.time() - t
+    t = time.time()
+    burst_stats = _quiet(burst)
+    t_burst = time.time() - t
+    print "%-7s %8s %12s %12s" % ('', 'wall (s)', 'median (m)', 'CI (mm)')
+    for (name, wall, st) in (('serial', t_serial, stats),
+                             ('burst', t_burst, burst_stats)):
+        print "%-7s %8.2f %12.4f %12.2f" % (
+            name, wall, st['median'] * room.speed - arange.OLPC_OFFSET,
+            1000 * (st['high'] - st['low']) * room.speed)
+
+
+def bench_simul(runs=3, drive=None, distance=3.0, order=13):
+    """
+    Compares the wall time and result of measure_dt_seq and
+    measure_dt_simul in a simulated room whose speakers are driven to
+    distortion by drive, and how often measure_dt_simul falls back
+    """
+    room = roomsim.Room(distance=distance, drive=drive)
+    fallbacks = []
+
+    def record(event):
+        if event['phase'] == 'done' and 'fallback' in event:
+            fallbacks.append(event['fallback'])
+
+    print "%-6s %8s %12s" % ('', 'wall (s)', 'median (m)')
+    for (name, measure) in (('seq', arange.measure_dt_seq),
+                            ('simul', arange.measure_dt_simul)):
+        def run():
+            return roomsim.run_pair(
+                room, lambda s, am_server, audio: measure(
+                    s, am_server, audio=audio, order=order,
+                    send_event=record))[0]
+        t = time.time()
+        results = [_quiet(run) for i in xrange(runs)]
+        print "%-6s %8.2f %12.4f" % (
+            name, (time.time() - t) / runs,
+            num.median(results) * room.speed - arange.OLPC_OFFSET)
+    print "simul fell back in %i of %i" % (sum(fallbacks) / 2, runs)
+
+
+def bench_workers(seconds=2.0, repeat=10):
+    """
+    Compares the wall time of correlating both halves of a measurement,
+    each a recording of the given length, one after the other and on pools
+    of two thread or process workers, with the FHT and the FFT
+    """
+    (mls, mls_rev) = arange._sequences(arange.MLS_INDEX)
+    rec1 = _synthetic_recording(mls, seconds).astype(num.float)
+    rec2 = _synthetic_recording(mls_rev, seconds, seed=1).astype(num.float)
+    print "%i cores, MLS order %i, 2 x %i samples" % (
+        multiprocessing.cpu_count(), arange.MLS_INDEX, rec1.size)
+    print "%-8s %10s %10s" % ('workers', 'FHT (ms)', 'FFT (ms)')
+    for kind in (None, 'thread', 'process'):
+        if kind:
+            arange.WORKERS = 2
+            arange.start_workers(2, kind)
+        times = []
+        for use_fht in (True, False):
+            def halves():
+                return arange.run_parallel([('mls', arange.MLS_INDEX, rec1),
+                                            ('mls_rev', arange.MLS_INDEX,
+                                             rec2)], use_fht)
+            halves()
+            times.append(_best_time(halves, repeat))
+        print "%-8s %10.2f %10.2f" % (kind or 'serial', 1000 * times[0],
+                                      1000 * times[1])
+        arange.stop_workers()
+        arange.WORKERS = 0
+
+
+def bench_precision(seconds=2.0, repeat=10):
+    """
+    Compares cross_cov and the streaming correlator at each PRECISION:
+    the transform length against the power of 2 used before, the CPU
+    time, the bytes of the result, the peak found, and its error bound
+    """
+    mls = arange.compute_mls(num.zeros((arange.MLS_INDEX)) == 0)
+    rec = _synthetic_recording(mls, seconds)
+    n = max(mls.size, rec.size)
+    print "MLS order %i, %i samples: transform of %i, was %i" % (
+        arange.MLS_INDEX, rec.size, arange.next_fast_len(mls.size + n - 1),
+        2**int(math.ceil(math.log(n, 2))))
+    print "%-8s %12s %12s %10s %18s %12s" % (
+        'dtype', 'cross_cov', 'streaming', 'xc (kB)', 'peak', 'bound')
+    precision = arange.PRECISION
+    for p in ('float64', 'float32'):
+        arange.PRECISION = p
+        arange.cache.clear()
+        template = (mls - 0.5).astype(arange.real_dtype())
+
+        def fft():
+            return arange.cross_cov(template, rec, 'bench')
+
+        def streaming():
+            c = arange.StreamingCorrelator(template, 'bench')
+            for i in xrange(0, rec.size, 4800):
+                c.feed(rec[i:i + 4800])
+            return c
+
+        xc = fft()
+        c = streaming()
+        (peak, value, psr) = c.fine_peak()
+        print "%-8s %9.2f ms %9.2f ms %10i %18.10f %12.3g" % (
+            p, 1000 * _cpu_time(fft, repeat),
+            1000 * _cpu_time(streaming, repeat), xc.nbytes / 1024, peak,
+            arange.peak_error_bound(mls.size, c.energy, value, c.nfft))
+    arange.PRECISION = precision
+
+
+def _import_time(module):
+    """
+    Imports module in a new interpreter and returns its report: the time
+    taken and which of STARTUP_DEFERRED it loaded, or the error
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_TIMER, module] + list(STARTUP_DEFERRED),
+        cwd=here)
+    return json.loads(output.splitlines()[-1])
+
+
+def bench_startup(runs=5):
+    """
+    Times the import of each of STARTUP_MODULES in a new interpreter, with
+    all it imports in turn, as the median of runs, and lists which of
+    STARTUP_DEFERRED each loads.  Returns those that activity loads, or
+    None if activity could not be imported, so was not checked.
+    """
+    print "%-30s %11s  %s" % ('module', 'import (ms)', 'loads')
+    eager = None
+    for module in STARTUP_MODULES:
+        reports = [_import_time(module) for i in xrange(runs)]
+        if 'error' in reports[0]:
+            print "%-30s %11s  %s" % (module, '-', reports[0]['error'])
+            continue
+        loaded = [m for m in reports[0]['loaded'] if m != module]
+        print "%-30s %11.1f  %s" % (
+            module, 1000 * num.median([r['time'] for r in reports]),
+            " ".join(loaded))
+        if module == 'activity':
+            eager = loaded
+    if eager is None:
+        print "NOT CHECKED activity could not be imported"
+        return None
+    for m in eager:
+        print "REGRESSION activity imports %s at startup" % m
+    return eager
+
+
+def _timings(results):
+    """Returns the timings of JSON results from bench_e2e, by name"""
+    timings = {'round': results['round']['median'],
+               'cpu': results['cpu']['median']}
+    for role in results['phases']:
+        for p in results['phases'][role]:
+            timings['%s %s' % (role, p)] = results['phases'][role][p]['median']
+    timings.update(results['components'])
+    return timings
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    Lists the timings in the JSON results current that are more than
+    tolerance (a fraction) slower than in baseline.  Returns the list.
+    Timings in only one of the two are listed apart and not compared.
+    """
+    old = _timings(json.load(open(baseline)))
+    new = _timings(json.load(open(current)))
+    for name in sorted(set(new) - set(old)):
+        print "ADDED      %-20s               %10.4f" % (name, new[name])
+    for name in sorted(set(old) - set(new)):
+        print "REMOVED    %-20s %10.4f" % (name, old[name])
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        (a, b) = (old[name], new[name])
+        if b > a * (1 + tolerance):
+            print "REGRESSION %-20s %10.4f -> %10.4f" % (name, a, b)
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] == 'mls':
+        bench_mls(*[int(a) for a in sys.argv[2:4]])
+    elif sys.argv[1] == 'correlator':
+        bench_correlator(*[float(a) for a in sys.argv[2:3]])
+    elif sys.argv[1] == 'accuracy':
+        bench_accuracy(*([int(a) for a in sys.argv[2:3]]
+                         + [float(a) for a in sys.argv[3:4]]))
+    elif sys.argv[1] == 'e2e':
+        bench_e2e(*([int(a) for a in sys.argv[2:3]] + sys.argv[3:4]))
+    elif sys.argv[1] == 'burst':
+        bench_burst(*[int(a) for a in sys.argv[2:3]])
+    elif sys.argv[1] == 'simul':
+        bench_simul(*([int(a) for a in sys.argv[2:3]]
+                      + [float(a) for a in sys.argv[3:4]]))
+    elif sys.argv[1] == 'workers':
+        bench_workers(*[float(a) for a in sys.argv[2:3]])
+    elif sys.argv[1] == 'precision':
+        bench_precision(*[float(a) for a in sys.argv[2:3]])
+    elif sys.argv[1] == 'startup':
+        eager = bench_startup(*[int(a) for a in sys.argv[2:3]])
+        if eager is None or eager:
+            sys.exit(1)
+    elif sys.argv[1] == 'compare' and len(sys.argv) >= 4:
+        if compare(*(sys.argv[2:4] + [float(a) for a in sys.argv[4:5]])):
+            sys.exit(1)
+    else:
+        print __doc__
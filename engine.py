@@ -0,0 +1,1304 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+An event loop that runs measurements as coroutines, so that one thread
+can drive the protocol of any number of sessions, waiting on sockets and
+timers instead of blocking on them.
+
+Python 2 has no asyncio, so coroutines are generators in its style.  A
+coroutine yields a Future, another coroutine or a list of them to wait
+for it, gets the result back from the yield or has the exception raised
+there, and returns a value by raising Return(value).  A Task runs a
+coroutine; cancelling it raises Cancelled at the yield it is waiting at.
+
+Loop runs on select(), for use without a user interface; GLibLoop runs
+the same coroutines on the GLib main loop, as the activity does.
+measure_seq and measure_matrix are the coroutines of measure_dt_seq and
+measure_dt_matrix.  The audio calls that block and the correlations run
+in short-lived threads whose results are awaited.
+"""
+
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import math
+import os
+import select
+import socket
+import threading
+import time
+import traceback
+import types
+
+import numpy as num
+
+import arange
+
+TIMEOUT = arange.REC_TIMEOUT  # Longest wait (s) for a peer mid-measurement
+TAIL_INTERVAL = 0.02  # Time (s) between reads of a running recording
+FRAME_INTERVAL = 1.0 / 30  # Time (s) between Dispatcher updates
+
+_logger = logging.getLogger('distance-engine')
+
+
+class Cancelled(Exception):
+    """Raised in a coroutine whose Task was cancelled"""
+    pass
+
+
+class Timeout(arange.ProtocolError):
+    """The peer took too long to answer"""
+    pass
+
+
+class Return(Exception):
+    """Raised by a coroutine to return value"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Handle(object):
+    """A callback scheduled on a Loop, which can be cancelled"""
+
+    def __init__(self, fn, args):
+        self._fn = fn
+        self._args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            self._fn(*self._args)
+        except Exception:
+            _logger.exception("error in callback %r" % self._fn)
+
+
+class Loop(object):
+    """
+    Runs callbacks, timers and socket watches in one thread on select().
+    call_soon_threadsafe is the only method for use from other threads.
+    """
+
+    def __init__(self):
+        self._ready = collections.deque()
+        self._timers = []  # heap of (time, sequence number, Handle)
+        self._sequence = itertools.count()
+        self._readers = {}
+        self._writers = {}
+        self._lock = threading.Lock()
+        (self._wake_r, self._wake_w) = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+
+    def time(self):
+        return arange.monotonic()
+
+    def call_soon(self, fn, *args):
+        handle = Handle(fn, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_later(self, delay, fn, *args):
+        handle = Handle(fn, args)
+        heapq.heappush(self._timers, (self.time() + delay,
+                                      next(self._sequence), handle))
+        return handle
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self._lock:
+            handle = self.call_soon(fn, *args)
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return handle
+
+    def add_reader(self, fd, fn, *args):
+        self._readers[fd] = Handle(fn, args)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, fn, *args):
+        self._writers[fd] = Handle(fn, args)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - self.time())
+        else:
+            timeout = None
+        try:
+            (r, w, x) = select.select(list(self._readers) + [self._wake_r],
+                                      list(self._writers), [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            (r, w) = ([], [])
+        for fd in r:
+            if fd == self._wake_r:
+                try:
+                    os.read(self._wake_r, 4096)
+                except OSError:
+                    pass
+            elif fd in self._readers:
+                self._ready.append(self._readers[fd])
+        for fd in w:
+            if fd in self._writers:
+                self._ready.append(self._writers[fd])
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            self._ready.append(heapq.heappop(self._timers)[2])
+        with self._lock:
+            handles = list(self._ready)
+            self._ready.clear()
+        for handle in handles:
+            handle.run()
+
+    def run_until_complete(self, awaitable):
+        """Runs the loop until awaitable is done and returns its result"""
+        future = as_future(self, awaitable)
+        while not future.done():
+            self._run_once()
+        return future.result()
+
+    def close(self):
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class GLibLoop(Loop):
+    """
+    A Loop whose callbacks, timers and socket watches are GLib sources, so
+    that coroutines run on the GLib main loop along with the user
+    interface
+    """
+
+    def __init__(self):
+        from gi.repository import GLib
+        self._glib = GLib
+        self._sources = {}
+
+    def _source(self, handle):
+        def callback(*args):
+            handle.run()
+            return False
+        return callback
+
+    def call_soon(self, fn, *args):
+        handle = Handle(fn, args)
+        self._glib.idle_add(self._source(handle))
+        return handle
+
+    def call_later(self, delay, fn, *args):
+        handle = Handle(fn, args)
+        self._glib.timeout_add(int(math.ceil(1000 * max(0, delay))),
+                               self._source(handle))
+        return handle
+
+    call_soon_threadsafe = call_soon  # idle_add may be called from any thread
+
+    def _watch(self, fd, condition, fn, args):
+        handle = Handle(fn, args)
+
+        def callback(source, condition):
+            handle.run()
+            return True
+        return self._glib.io_add_watch(
+            fd, self._glib.PRIORITY_DEFAULT,
+            condition | self._glib.IO_HUP | self._glib.IO_ERR, callback)
+
+    def add_reader(self, fd, fn, *args):
+        self.remove_reader(fd)
+        self._sources[(fd, 'r')] = self._watch(fd, self._glib.IO_IN, fn,
+                                               args)
+
+    def remove_reader(self, fd):
+        source = self._sources.pop((fd, 'r'), None)
+        if source is not None:
+            self._glib.source_remove(source)
+
+    def add_writer(self, fd, fn, *args):
+        self.remove_writer(fd)
+        self._sources[(fd, 'w')] = self._watch(fd, self._glib.IO_OUT, fn,
+                                               args)
+
+    def remove_writer(self, fd):
+        source = self._sources.pop((fd, 'w'), None)
+        if source is not None:
+            self._glib.source_remove(source)
+
+    def run_until_complete(self, awaitable):
+        future = as_future(self, awaitable)
+        main = self._glib.MainLoop()
+        future.add_done_callback(lambda f: main.quit())
+        if not future.done():
+            main.run()
+        return future.result()
+
+    def close(self):
+        for source in self._sources.values():
+            self._glib.source_remove(source)
+        self._sources = {}
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Future(object):
+    """The result of an operation that has not finished yet"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._retrieved = False  # Whether the outcome was looked at
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exception, Cancelled)
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("result of a future that is not done")
+        self._retrieved = True
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        self._retrieved = True
+        return self._exception
+
+    def _finish(self):
+        self._done = True
+        for fn in self._callbacks:
+            self.loop.call_soon(fn, self)
+        self._callbacks = []
+
+    def set_result(self, value):
+        if not self._done:
+            self._result = value
+            self._finish()
+
+    def set_exception(self, exception):
+        if not self._done:
+            self._exception = exception
+            self._finish()
+
+    def cancel(self):
+        if self._done:
+            return False
+        self.set_exception(Cancelled())
+        return True
+
+    def add_done_callback(self, fn):
+        if self._done:
+            self.loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+
+class Task(Future):
+    """
+    Runs a coroutine on loop; the Future of its return value.  An
+    exception the coroutine raises is logged unless something looks at it
+    by the time the loop gets round to it, as no one else would see it.
+    """
+
+    def __init__(self, loop, coroutine):
+        Future.__init__(self, loop)
+        self._coroutine = coroutine
+        self._waiting = None
+        self._must_cancel = False
+        loop.call_soon(self._step)
+
+    def cancel(self):
+        if self._done:
+            return False
+        if self._waiting is not None:
+            self._waiting.cancel()
+        else:
+            self._must_cancel = True
+        return True
+
+    def _step(self, value=None, exception=None):
+        if self._done:
+            return
+        if self._must_cancel:
+            (self._must_cancel, exception) = (False, Cancelled())
+        self._waiting = None
+        try:
+            if exception is None:
+                awaited = self._coroutine.send(value)
+            else:
+                awaited = self._coroutine.throw(exception)
+        except Return as r:
+            self.set_result(r.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception as e:
+            self.set_exception(e)
+            if not isinstance(e, Cancelled):
+                self.loop.call_soon(self._report, traceback.format_exc())
+        else:
+            try:
+                self._waiting = as_future(self.loop, awaited)
+            except TypeError as e:
+                self.loop.call_soon(self._step, None, e)
+                return
+            self._waiting.add_done_callback(self._wakeup)
+
+    def _report(self, trace):
+        if not self._retrieved:
+            _logger.error("error in task %r\n%s"
+                          % (self._coroutine, trace.rstrip()))
+
+    def _wakeup(self, future):
+        try:
+            value = future.result()
+        except Exception as e:
+            self._step(None, e)
+        else:
+            self._step(value)
+
+
+def as_future(loop, awaitable):
+    """
+    Returns a Future for awaitable: a Future, a coroutine, which is
+    started as a Task, or a list of them, which are gathered
+    """
+    if isinstance(awaitable, Future):
+        return awaitable
+    if isinstance(awaitable, types.GeneratorType):
+        return Task(loop, awaitable)
+    if isinstance(awaitable, (list, tuple)):
+        return gather(loop, awaitable)
+    raise TypeError("cannot wait for %r" % (awaitable,))
+
+
+def gather(loop, awaitables):
+    """
+    Returns a Future of the list of the results of all of awaitables.  If
+    any fails, the others are cancelled.
+    """
+    futures = [as_future(loop, a) for a in awaitables]
+    outer = Future(loop)
+    pending = [len(futures)]
+
+    def done(future):
+        if future.exception() is not None:
+            if not outer.done():
+                outer.set_exception(future.exception())
+                for f in futures:
+                    f.cancel()
+            return
+        pending[0] -= 1
+        if pending[0] == 0:
+            outer.set_result([f.result() for f in futures])
+
+    if not futures:
+        outer.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    outer.add_done_callback(
+        lambda f: f.cancelled() and [g.cancel() for g in futures])
+    return outer
+
+
+def sleep(loop, delay):
+    """Returns a Future that is done delay seconds from now"""
+    future = Future(loop)
+    handle = loop.call_later(delay, future.set_result, None)
+    future.add_done_callback(lambda f: handle.cancel())
+    return future
+
+
+def sleep_until(loop, t):
+    """Returns a Future that is done at time.time() t"""
+    return sleep(loop, max(0, t - time.time()))
+
+
+def wait_for(loop, awaitable, timeout):
+    """
+    Returns a Future of the result of awaitable, which fails with Timeout
+    and cancels awaitable if it takes more than timeout seconds
+    """
+    inner = as_future(loop, awaitable)
+    if timeout is None:
+        return inner
+    outer = Future(loop)
+
+    def expire():
+        if not inner.done():
+            outer.set_exception(Timeout("no answer in %.1f s" % timeout))
+            inner.cancel()
+
+    handle = loop.call_later(timeout, expire)
+
+    def done(future):
+        handle.cancel()
+        if future.exception() is not None:
+            outer.set_exception(future.exception())
+        else:
+            outer.set_result(future.result())
+    inner.add_done_callback(done)
+    outer.add_done_callback(lambda f: f.cancelled() and inner.cancel())
+    return outer
+
+
+def run_in_thread(loop, fn, *args):
+    """
+    Returns a Future of fn(*args), called in a new thread.  Cancelling the
+    Future does not stop the call, whose result is then dropped.
+    """
+    future = Future(loop)
+
+    def run():
+        try:
+            value = fn(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, value)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+class Dispatcher(object):
+    """
+    Applies updates to the user interface on loop, at most once a frame,
+    from any thread and without waiting for them.  Updates are posted
+    under a key, one for each widget property, and only the latest update
+    of each key is applied; the others are dropped as coalesced.
+    """
+
+    def __init__(self, loop, interval=FRAME_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self._pending = collections.OrderedDict()  # key -> (fn, args, t)
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self.posted = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.max_depth = 0
+        self.latency_total = 0.0  # Time (s) from post to update, summed
+        self.max_latency = 0.0
+
+    def post(self, key, fn, *args):
+        """Calls fn(*args) on the loop by the next frame, unless replaced"""
+        with self._lock:
+            t = arange.monotonic()
+            if key in self._pending:
+                # Keep the time of the oldest, as the update is that late
+                t = self._pending.pop(key)[2]
+                self.coalesced += 1
+            self._pending[key] = (fn, args, t)
+            self.posted += 1
+            self.max_depth = max(self.max_depth, len(self._pending))
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            self.loop.call_soon_threadsafe(self.loop.call_later,
+                                           self.interval, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            updates = self._pending.values()
+            self._pending.clear()
+            self._scheduled = False
+        now = arange.monotonic()
+        for (fn, args, t) in updates:
+            try:
+                fn(*args)
+            except Exception:
+                _logger.exception("error in update %r" % fn)
+            latency = now - t
+            with self._lock:
+                self.applied += 1
+                self.latency_total += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        """Returns a dict of the queue depth and the update counters"""
+        with self._lock:
+            return {'depth': len(self._pending),
+                    'max_depth': self.max_depth,
+                    'posted': self.posted,
+                    'coalesced': self.coalesced,
+                    'applied': self.applied,
+                    'mean_latency': (self.latency_total / self.applied
+                                     if self.applied else None),
+                    'max_latency': self.max_latency}
+
+
+def accept(loop, sock):
+    """Returns a Future of the (socket, address) of the next connection"""
+    future = Future(loop)
+    sock.setblocking(0)
+
+    def ready():
+        try:
+            (conn, address) = sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            loop.remove_reader(sock.fileno())
+            future.set_exception(e)
+            return
+        loop.remove_reader(sock.fileno())
+        future.set_result((conn, address))
+
+    loop.add_reader(sock.fileno(), ready)
+    future.add_done_callback(lambda f: loop.remove_reader(sock.fileno()))
+    return future
+
+
+class AsyncChannel(arange.Channel):
+    """
+    A Channel on a non-blocking socket, whose send, recv and exchange are
+    coroutines.  recv gives up with Timeout after timeout seconds, unless
+    it is given another.  Once the connection fails, or a message is given
+    up half read, broken is set and the channel cannot be used again.
+    """
+
+    def __init__(self, loop, sock, timeout=TIMEOUT):
+        arange.Channel.__init__(self, sock)
+        sock.setblocking(0)
+        self.loop = loop
+        self.timeout = timeout
+        self.broken = False
+        self._received = bytearray()
+        self._in_message = False  # Between a header and its payload
+        self._fd = sock.fileno()
+
+    def alive(self):
+        """
+        Returns whether the channel can still be used: it is not broken
+        and the peer has not closed the connection.  Only to be called
+        between messages.
+        """
+        if self.broken or self._in_message:
+            return False
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) != ''
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def _write(self, data):
+        future = Future(self.loop)
+        view = [memoryview(data)]
+
+        def ready():
+            try:
+                k = self.sock.send(view[0])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.loop.remove_writer(self._fd)
+                future.set_exception(arange.PeerClosed(str(e)))
+                return
+            view[0] = view[0][k:]
+            if not len(view[0]):
+                self.loop.remove_writer(self._fd)
+                future.set_result(None)
+
+        ready()
+        if not future.done():
+            self.loop.add_writer(self._fd, ready)
+            future.add_done_callback(
+                lambda f: self.loop.remove_writer(self._fd))
+        return future
+
+    def _read(self, n):
+        """Returns a Future of the next n bytes"""
+        future = Future(self.loop)
+
+        def ready():
+            while len(self._received) < n:
+                try:
+                    data = self.sock.recv(max(4096, n - len(self._received)))
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return
+                    self.loop.remove_reader(self._fd)
+                    future.set_exception(arange.PeerClosed(str(e)))
+                    return
+                if not data:
+                    self.loop.remove_reader(self._fd)
+                    future.set_exception(arange.PeerClosed(
+                        "connection closed after %i of %i bytes"
+                        % (len(self._received), n)))
+                    return
+                self._received.extend(data)
+            self.loop.remove_reader(self._fd)
+            data = bytes(self._received[:n])
+            del self._received[:n]
+            future.set_result(data)
+
+        ready()
+        if not future.done():
+            self.loop.add_reader(self._fd, ready)
+            future.add_done_callback(
+                lambda f: self.loop.remove_reader(self._fd))
+        return future
+
+    def send(self, name, *values):
+        try:
+            yield self._write(self._encode(name, values))
+        except arange.PeerClosed:
+            self.broken = True
+            raise
+
+    def _recv(self, name):
+        while True:
+            magic = yield self._read(len(arange._MAGIC))
+            self._check_magic(magic)
+            self._in_message = True
+            header = self._parse_header(magic + (yield self._read(
+                arange._HEADER.size - len(arange._MAGIC))))
+            payload = yield self._read(header[3])
+            self._in_message = False
+            self._arrived(header)
+            if header[2] in arange._MESSAGE_NAMES:
+                raise Return(self._decode(name, header[2], payload))
+
+    def recv(self, name, timeout=False):
+        """
+        Receives the next message, which must be of type name, and returns
+        its values.  timeout, if not False, replaces self.timeout.
+        """
+        if timeout is False:
+            timeout = self.timeout
+        try:
+            values = yield wait_for(self.loop, self._recv(name), timeout)
+        except Timeout:
+            # The payload of a header already read would be taken for the
+            # next header
+            if self._in_message:
+                self.broken = True
+            raise
+        except arange.ProtocolError:
+            self.broken = True
+            raise
+        raise Return(values)
+
+    def exchange(self, name, *values):
+        yield self.send(name, *values)
+        raise Return((yield self.recv(name)))
+
+
+class AsyncAudio(object):
+    """
+    Awaitable operations of an AudioBackend.  Starting, stopping and
+    playing run in threads, as they may block; a running recording is
+    read by a coroutine on the loop.
+    """
+
+    def __init__(self, loop, audio=None):
+        self.loop = loop
+        self.audio = audio or arange.backend
+
+    def start_recording(self):
+        return run_in_thread(self.loop, self.audio.start_recording)
+
+    def stop_recording(self, recording):
+        return run_in_thread(self.loop, self.audio.stop_recording, recording)
+
+    def play(self, frames):
+        return run_in_thread(self.loop, self.audio.play, frames)
+
+    def tail(self, recording, sink, stop_event, interval=TAIL_INTERVAL):
+        """
+        Coroutine of arange.tail_recording: passes the samples of recording
+        to sink as they arrive, until stop_event is set and none are left
+        """
+        while True:
+            stopping = stop_event.is_set()
+            data = recording.read_available()
+            if data.size:
+                sink(data)
+            elif stopping:
+                return
+            if not stopping:
+                yield sleep(self.loop, interval)
+
+
+def handshake(channel, am_server, order, mode=arange.MODE_PAIR):
+    """
+    Coroutine of arange._handshake, waiting for as long as the peer takes
+    to start.  Returns the MLS order chosen by the server, and sets
+    channel.mode.  A client whose mode is None takes whichever the server
+    starts.
+    """
+    if am_server:
+        (version, rate, peer_order) = yield channel.recv('hello', None)
+    else:
+        yield channel.send('hello', arange.PROTOCOL_VERSION, arange.REC_HZ,
+                           order)
+        (version, rate, order, server_mode) = yield channel.recv('start',
+                                                                 None)
+        if mode is None:
+            mode = server_mode
+        elif server_mode != mode:
+            raise arange.ProtocolError(
+                "peer started measurement mode %i, not %i"
+                % (server_mode, mode))
+    arange._check_peer(version, rate)
+    channel.version = min(version, arange.PROTOCOL_VERSION)
+    channel.mode = mode
+    if am_server:
+        yield channel.send('start', channel.version, arange.REC_HZ, order,
+                           mode)
+    raise Return(order)
+
+
+class _Recorder(object):
+    """A recording read into a SampleStore by a coroutine while it runs"""
+
+    def __init__(self, audio):
+        self.audio = audio
+        self.store = arange.SampleStore()
+        self.recording = None
+        self._stop = threading.Event()
+        self._tail = None
+        self.closed = False  # Set once all the samples are in the store
+
+    def start(self):
+        self.recording = yield self.audio.start_recording()
+        self._tail = Task(self.audio.loop, self.audio.tail(
+            self.recording, self.store.feed, self._stop))
+
+    def stop(self):
+        if self.recording is None:
+            return
+        (recording, self.recording) = (self.recording, None)
+        try:
+            yield self.audio.stop_recording(recording)
+            self._stop.set()
+            yield self._tail
+        finally:
+            self._stop.set()
+            self.store.close()
+            self.closed = True
+            recording.close()
+
+    def abandon(self):
+        """
+        Gives up the recording after a failure, without waiting: it is
+        stopped and closed in a thread, as stopping may block
+        """
+        if self.recording is None:
+            return
+        (recording, self.recording) = (self.recording, None)
+        self._tail.cancel()
+        self.store.close()
+        self.closed = True
+
+        def stop():
+            try:
+                self.audio.audio.stop_recording(recording)
+            except Exception:
+                _logger.exception("error stopping an abandoned recording")
+            finally:
+                recording.close()
+        run_in_thread(self.audio.loop, stop)
+
+    def wait_for(self, end):
+        """
+        Waits until the samples up to end have been read, or the recording
+        is over, so that store.wait_slice will not block
+        """
+        while self.store.nsamples < end and not self.closed:
+            yield sleep(self.audio.loop, TAIL_INTERVAL)
+
+
+def _seq_round(channel, am_server, timer, audio, order):
+    """The coroutine of arange._measure_round, on an AsyncChannel"""
+    loop = channel.loop
+    timer('preparing', order=order)
+    (mls, mls_rev, frames) = arange._prepare(am_server, order)
+
+    timer('waiting')
+    server_order = yield handshake(channel, am_server, order)
+    if server_order != order:
+        order = server_order
+        (mls, mls_rev, frames) = arange._prepare(am_server, order)
+
+    timer('playing', order=order)
+    amp_ringdown = 0.2
+    startnum = int(math.ceil(amp_ringdown * arange.REC_HZ))
+    ringdown = 0.3  # seconds
+
+    recorder = _Recorder(audio)
+    try:
+        t1 = time.time()
+        yield recorder.start()
+        t2 = time.time()
+
+        if am_server:
+            yield channel.recv('started')
+        else:
+            yield channel.send('started')
+
+        yield sleep(loop, amp_ringdown)
+
+        if am_server:
+            yield audio.play(frames)
+            yield sleep(loop, ringdown)
+            t3 = time.time()
+            breaknum = int(math.ceil((t3 - t1) * arange.REC_HZ))
+            yield sleep(loop, t2 - t1)
+            yield channel.send('turn', 0)
+        else:
+            yield channel.recv('turn')
+            t3 = time.time()
+            breaknum = int(math.ceil((t3 - t1) * arange.REC_HZ))
+            yield sleep(loop, t2 - t1)
+            yield audio.play(frames)
+            yield sleep(loop, ringdown)
+
+        if am_server:
+            yield channel.recv('stop')
+        else:
+            yield channel.send('stop')
+        yield recorder.stop()
+    finally:
+        recorder.abandon()
+
+    store = recorder.store
+    rec1 = store.wait_slice(startnum, breaknum).astype(arange.real_dtype())
+    rec2 = store.wait_slice(breaknum, store.nsamples).astype(
+        arange.real_dtype())
+    timer('processing', breaktime=t3 - t1, rec1_samples=rec1.size,
+          rec2_samples=rec2.size)
+
+    ((s_peak, s_value, s_psr), (c_peak, c_value, c_psr)) = \
+        yield run_in_thread(loop, arange._correlate_halves, mls, mls_rev,
+                            rec1, rec2, order)
+    bounds = [(float(num.dot(rec, rec)),
+               mls.size + 1 if arange.USE_FHT
+               else arange.next_fast_len(mls.size + rec.size - 1))
+              for rec in (rec1, rec2)]
+    peak_error = max([arange.peak_error_bound(mls.size, energy, value, n)
+                      for ((energy, n), value) in zip(bounds,
+                                                      (s_value, c_value))])
+    if am_server:
+        (c_peak, ratio) = yield run_in_thread(
+            loop, arange._correct_drift, 'mls_rev', order, rec2, c_peak)
+    else:
+        (s_peak, ratio) = yield run_in_thread(
+            loop, arange._correct_drift, 'mls', order, rec1, s_peak)
+    dn = (c_peak + breaknum) - s_peak
+    dt = float(dn) / arange.REC_HZ
+    ratio = arange._clock_ratio(
+        ratio, (yield channel.exchange('drift', ratio))[0], am_server)
+    other_dt = (yield channel.exchange('dt', dt))[0]
+    if arange.ARCHIVE_DIR:
+        arange._archive(store, 'seq', 0 if am_server else 1, order, 2, 1,
+                        [(startnum, breaknum, 0),
+                         (breaknum, store.nsamples, 1)],
+                        [t3 - t1, dt, other_dt, ratio])
+
+    # Both times in samples of the server's clock
+    if am_server:
+        roundtrip = abs(dt - other_dt * ratio)
+    else:
+        roundtrip = abs(dt * ratio - other_dt)
+
+    raise Return(timer('done', s_peak=float(s_peak), c_peak=float(c_peak),
+                       s_value=float(s_value), c_value=float(c_value),
+                       s_psr=float(s_psr), c_psr=float(c_psr),
+                       peak_error=peak_error, dt=dt, other_dt=other_dt,
+                       ppm=(ratio - 1) * 1e6, rtt=channel.rtt, order=order,
+                       result=roundtrip / 2))
+
+
+def measure_seq(channel, am_server, send_signal=False, audio=None,
+                send_event=None, order=None, adaptive=None):
+    """
+    The coroutine of arange.measure_dt_seq, on an AsyncChannel and an
+    AsyncAudio, by default on arange.backend.  Returns the result.
+    """
+    if not isinstance(audio, AsyncAudio):
+        audio = AsyncAudio(channel.loop, audio)
+    timer = arange.PhaseTimer(send_signal, send_event,
+                              role='server' if am_server else 'client')
+
+    if adaptive is None:
+        event = yield _seq_round(channel, am_server, timer, audio,
+                                 order or arange.MLS_INDEX)
+        raise Return(event['result'])
+
+    while True:
+        event = yield _seq_round(channel, am_server, timer, audio,
+                                 adaptive.order)
+        order = event['order']
+        psr = min(event['s_psr'], event['c_psr'])
+        psr = min(psr, (yield channel.exchange('quality', psr))[0])
+        if am_server:
+            next_order = adaptive.choose(order, psr)
+            accept = psr >= adaptive.target or order >= adaptive.max_order
+            yield channel.send('order', next_order, accept)
+        else:
+            (next_order, accept) = yield channel.recv('order')
+        adaptive.order = next_order
+        adaptive.psr = psr
+        if accept:
+            raise Return(event['result'])
+
+
+def _pair_result(am_server, order, analyses, results, ratio, psr):
+    """
+    Returns the result of a burst in the form of measure_matrix's, the
+    server being device 0, given the _burst_round of each round, the
+    result of each round, the ratio of the server's sample clock to the
+    client's and the median worse peak-to-sidelobe ratio
+    """
+    stats = arange.aggregate(results)
+    result = {'index': 0 if am_server else 1, 'n': 2, 'order': order,
+              'rounds': len(results), 'psr': psr,
+              'ppm': [[0.0, (ratio - 1) * 1e6], [(1 / ratio - 1) * 1e6, 0.0]],
+              'peak': [float(num.median([abs(a[k]) for a in analyses]))
+                       for k in (3, 4)]}
+    for key in ('median', 'low', 'high'):
+        result[key] = [[0.0, stats[key]], [stats[key], 0.0]]
+    return result
+
+
+def _burst(channel, am_server, timer, audio, order, rounds, adaptive):
+    """
+    The coroutine of arange.measure_dt_burst after the handshake.  Each
+    round is analyzed in a thread as soon as it has been recorded.
+    """
+    loop = channel.loop
+    (mls, mls_rev, frames) = arange._prepare(am_server, order)
+    if am_server:
+        yield channel.send('rounds', rounds)
+    else:
+        rounds = (yield channel.recv('rounds'))[0]
+
+    amp_ringdown = 0.2
+    ringdown = 0.3  # seconds
+    recorder = _Recorder(audio)
+    analyses = [None] * rounds
+    slots = []  # Where each half of each round is, for the archive
+
+    def analyze(k, startnum, breaknum, endnum):
+        yield recorder.wait_for(endnum)
+        rec1 = recorder.store.wait_slice(startnum, breaknum).astype(
+            arange.real_dtype())
+        rec2 = recorder.store.wait_slice(breaknum, endnum).astype(
+            arange.real_dtype())
+        analyses[k] = yield run_in_thread(loop, arange._burst_round,
+                                          am_server, order, mls, mls_rev,
+                                          rec1, rec2)
+
+    def turn(k):
+        other_seq = (yield channel.recv('turn'))[0]
+        if other_seq != k:
+            raise arange.ProtocolError("round %i, peer is at %i"
+                                       % (k, other_seq))
+
+    def sample():
+        return int(math.ceil((time.time() - t1) * arange.REC_HZ))
+
+    tasks = []
+    try:
+        t1 = time.time()
+        yield recorder.start()
+        t2 = time.time()
+
+        if am_server:
+            yield channel.recv('started')
+        else:
+            yield channel.send('started')
+        yield sleep(loop, amp_ringdown)
+
+        startnum = int(math.ceil(amp_ringdown * arange.REC_HZ))
+        for k in xrange(rounds):
+            timer('playing', seq=k)
+            # Each peer hands the turn over by sending the round number
+            if am_server:
+                yield audio.play(frames)
+                yield sleep(loop, ringdown)
+                breaknum = sample()
+                yield sleep(loop, t2 - t1)
+                yield channel.send('turn', k)
+                yield turn(k)
+                endnum = sample()
+                yield sleep(loop, t2 - t1)
+            else:
+                yield turn(k)
+                breaknum = sample()
+                yield sleep(loop, t2 - t1)
+                yield audio.play(frames)
+                yield sleep(loop, ringdown)
+                endnum = sample()
+                yield channel.send('turn', k)
+            tasks.append(Task(loop, analyze(k, startnum, breaknum, endnum)))
+            slots.extend([(startnum, breaknum, 0), (breaknum, endnum, 1)])
+            startnum = endnum
+
+        if am_server:
+            yield channel.recv('stop')
+        else:
+            yield channel.send('stop')
+        yield recorder.stop()
+
+        timer('processing', rounds=rounds, samples=recorder.store.nsamples)
+        yield tasks
+    finally:
+        for task in tasks:
+            task.cancel()
+        recorder.abandon()
+
+    mine = arange._burst_row(analyses)
+    other = yield channel.exchange('results', *mine)
+    (results, ratio, psr) = arange._burst_stats(am_server, mine, other)
+    if arange.ARCHIVE_DIR:
+        arange._archive(recorder.store, 'burst', 0 if am_server else 1,
+                        order, 2, rounds, slots, mine + list(other))
+
+    if adaptive is not None:
+        if am_server:
+            next_order = adaptive.choose(order, psr)
+            yield channel.send('order', next_order, True)
+        else:
+            next_order = (yield channel.recv('order'))[0]
+        adaptive.order = next_order
+        adaptive.psr = psr
+
+    result = _pair_result(am_server, order, analyses, results, ratio, psr)
+    timer('done', results=results, rtt=channel.rtt, **result)
+    raise Return(result)
+
+
+def measure_pair(channel, am_server, rounds=arange.BURST_ROUNDS,
+                 send_signal=False, audio=None, send_event=None, order=None,
+                 adaptive=None):
+    """
+    The coroutine of arange.measure_dt_burst, each peer handing the turn
+    to the other, so it needs no time slots.  Returns the result in the
+    form of measure_matrix's, the server being device 0.
+    """
+    if not isinstance(audio, AsyncAudio):
+        audio = AsyncAudio(channel.loop, audio)
+    if adaptive is not None:
+        order = adaptive.order
+    order = order or arange.MLS_INDEX
+    timer = arange.PhaseTimer(send_signal, send_event,
+                              role='server' if am_server else 'client')
+
+    timer('preparing', order=order)
+    arange._prepare(am_server, order)
+
+    timer('waiting')
+    order = yield handshake(channel, am_server, order)
+    result = yield _burst(channel, am_server, timer, audio, order, rounds,
+                          adaptive)
+    raise Return(result)
+
+
+def follow(channel, send_signal=False, audio=None, send_event=None,
+           order=None, adaptive=None):
+    """
+    Takes part in whichever measurement the laptop at the other end of
+    channel starts: a measure_pair, as its client, or a measure_matrix, as
+    a device.  Returns the result of either.
+    """
+    if not isinstance(audio, AsyncAudio):
+        audio = AsyncAudio(channel.loop, audio)
+    if adaptive is not None:
+        order = adaptive.order
+    order = order or arange.MLS_INDEX
+    timer = arange.PhaseTimer(send_signal, send_event, role='follower')
+
+    timer('preparing', order=order)
+    arange._sequences(order)
+
+    timer('waiting')
+    order = yield handshake(channel, False, order, mode=None)
+    if channel.mode == arange.MODE_PAIR:
+        result = yield _burst(channel, False, timer, audio, order, None,
+                              adaptive)
+    elif channel.mode == arange.MODE_MATRIX:
+        schedule = yield channel.recv('schedule')
+        result = yield _matrix([channel], False, timer, audio, order,
+                               schedule, adaptive)
+    else:
+        raise arange.ProtocolError("peer started unknown measurement mode %i"
+                                   % channel.mode)
+    raise Return(result)
+
+
+def measure_matrix(channels, am_scheduler, rounds=1, send_signal=False,
+                   audio=None, send_event=None, order=None, adaptive=None):
+    """
+    The coroutine of arange.measure_dt_matrix.  The scheduler passes a
+    list of AsyncChannels, and shakes hands with all the devices at once;
+    the others pass one.  Each round is analyzed in a thread as soon as
+    it has been recorded.  Returns the same dict.
+    """
+    if am_scheduler:
+        loop = channels[0].loop if channels else None
+        if adaptive is not None:
+            order = adaptive.order
+    else:
+        channels = [channels]
+        loop = channels[0].loop
+    if not isinstance(audio, AsyncAudio):
+        audio = AsyncAudio(loop, audio)
+    order = order or arange.MLS_INDEX
+    timer = arange.PhaseTimer(send_signal, send_event,
+                              role='scheduler' if am_scheduler else 'device')
+
+    timer('preparing', order=order)
+    arange._sequences(order)
+
+    timer('waiting')
+    if am_scheduler:
+        n = len(channels) + 1
+        slot = float(2**order - 1) / arange.REC_HZ + 2 * arange.MATRIX_GUARD
+
+        def start(i, channel):
+            yield handshake(channel, True, order, mode=arange.MODE_MATRIX)
+            yield channel.send('schedule', i + 1, n, rounds, slot)
+        yield [start(i, channel) for (i, channel) in enumerate(channels)]
+        schedule = (0, n, rounds, slot)
+    else:
+        order = yield handshake(channels[0], False, order,
+                                mode=arange.MODE_MATRIX)
+        schedule = yield channels[0].recv('schedule')
+    result = yield _matrix(channels, am_scheduler, timer, audio, order,
+                           schedule, adaptive)
+    raise Return(result)
+
+
+def _matrix(channels, am_scheduler, timer, audio, order, schedule,
+            adaptive):
+    """
+    The coroutine of arange.measure_dt_matrix after the handshakes, given
+    this device's (index, n, rounds, slot)
+    """
+    loop = audio.loop
+    (index, n, rounds, slot) = schedule
+    frames = arange.cache.fetch(
+        ('frames', 'seq', index, order),
+        lambda: arange.render_samples(arange.device_sequence(index, order)))
+
+    recorder = _Recorder(audio)
+    peaks = [None] * rounds
+    slots = []  # Where the slot of each device is, for the archive
+
+    def analyze(r, windows):
+        yield recorder.wait_for(windows[-1][1])
+        recs = [recorder.store.wait_slice(lo, hi) for (lo, hi) in windows]
+        peaks[r] = yield run_in_thread(loop, arange._slot_peaks, index,
+                                       order, windows, recs)
+
+    analyses = []
+    try:
+        t1 = time.time()
+        yield recorder.start()
+
+        if am_scheduler:
+            yield [channel.recv('started') for channel in channels]
+            yield [channel.send('go') for channel in channels]
+        else:
+            yield channels[0].send('started')
+            yield channels[0].recv('go')
+        amp_ringdown = 0.2
+        t_start = time.time() + amp_ringdown + arange.MATRIX_GUARD
+
+        def sample(t):
+            return max(0, int(math.ceil((t - t1) * arange.REC_HZ)))
+
+        for r in xrange(rounds):
+            timer('playing', seq=r, index=index, n=n)
+            times = [t_start + (r * n + i) * slot for i in xrange(n)]
+            windows = arange._slot_windows(times, slot, sample)
+            analyses.append(Task(loop, analyze(r, windows)))
+            slots.extend(arange._slot_layout(windows))
+            yield sleep_until(loop, times[index])
+            yield audio.play(frames)
+        yield sleep_until(loop, t_start + rounds * n * slot)
+        yield recorder.stop()
+
+        timer('processing', rounds=rounds, samples=recorder.store.nsamples)
+        yield analyses
+    finally:
+        for analysis in analyses:
+            analysis.cancel()
+        recorder.abandon()
+
+    mine = arange._peaks_row(peaks)
+    if am_scheduler:
+        rows = [mine] + (yield [channel.recv('peaks')
+                                for channel in channels])
+        stats = arange._matrix_stats(rows, n, rounds)
+        if arange.ARCHIVE_DIR:
+            arange._archive(recorder.store, 'matrix', index, order, n,
+                            rounds, slots, [x for row in rows for x in row])
+        next_order = order
+        if adaptive is not None:
+            next_order = adaptive.choose(order, stats['psr'])
+        flat = arange._matrix_flatten(stats)
+
+        def finish(channel):
+            yield channel.send('matrix', *flat)
+            yield channel.send('order', next_order, True)
+        yield [finish(channel) for channel in channels]
+    else:
+        yield channels[0].send('peaks', *mine)
+        if arange.ARCHIVE_DIR:
+            arange._archive(recorder.store, 'matrix', index, order, n,
+                            rounds, slots, mine)
+        stats = arange._matrix_unflatten(
+            (yield channels[0].recv('matrix')), n)
+        next_order = (yield channels[0].recv('order'))[0]
+    if adaptive is not None:
+        adaptive.order = next_order
+        adaptive.psr = stats['psr']
+
+    result = arange._matrix_result(index, n, order, rounds, peaks)
+    result.update(stats)
+    timer('done', **result)
+    raise Return(result)
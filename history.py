@@ -0,0 +1,205 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+The history of the measurements of a session, one record per pair of
+laptops measured, kept in a binary file of one array per column.
+
+The file is a header followed by the columns, each with room for the same
+number of records.  It is memory-mapped, so opening it reads only the
+header, a column is read from disk when it is first looked at, and
+appending a record writes one value to each column and the new count to
+the header.  When the columns are full, the file is rewritten with twice
+the room.
+"""
+
+import math
+import os
+import shutil
+import struct
+
+import numpy as num
+
+# Name and little-endian type of each column, widest first to keep each
+# aligned
+COLUMNS = (('time', '<f8'),  # When the measurement finished (s since 1970)
+           ('dt', '<f8'),  # Median one-way propagation time (s)
+           ('distance', '<f8'),  # Distance (m), offset corrected
+           ('spread', '<f8'),  # Half width of its confidence interval (m)
+           ('speed', '<f8'),  # Speed of sound used (m/s)
+           ('own_peak', '<f4'),  # Correlation peak of this laptop's sound
+           ('peer_peak', '<f4'),  # and of the other's, in this recording
+           ('psr', '<f4'),  # Worst peak-to-sidelobe ratio, if known
+           ('ppm', '<f4'),  # How much faster the other's sample clock runs
+           ('rounds', '<u2'),  # Rounds of the measurement
+           ('order', 'u1'),  # MLS order of the sequences
+           ('devices', 'u1'),  # Number of laptops measured at once
+           ('device', 'u1'),  # Number of this laptop
+           ('peer', 'u1'))  # Number of the other laptop
+
+_MAGIC = 'DHST'
+_VERSION = 1
+# magic, version, number of columns, records, room for records
+_HEADER = struct.Struct('<4sHHII')
+_ALIGN = 64  # Room is kept a multiple of this, so columns stay aligned
+INITIAL_CAPACITY = 256
+
+_dtypes = [(name, num.dtype(t)) for (name, t) in COLUMNS]
+
+
+class HistoryError(Exception):
+    """The file is not a history this version can read"""
+    pass
+
+
+def _offsets(capacity):
+    """Returns the offset of each column in a file with the given room"""
+    offsets = {}
+    offset = _ALIGN
+    for (name, dtype) in _dtypes:
+        offsets[name] = offset
+        offset += capacity * dtype.itemsize
+    return (offsets, offset)
+
+
+def _create(path, capacity):
+    (offsets, size) = _offsets(capacity)
+    f = open(path, 'wb')
+    f.write(_HEADER.pack(_MAGIC, _VERSION, len(COLUMNS), 0, capacity))
+    f.truncate(size)
+    f.close()
+
+
+class History(object):
+    """
+    The measurement history in the file at path, which is created empty if
+    it does not exist.  len() gives the number of records, column(name)
+    the values of one column and record(i) those of one record, as a dict.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            _create(path, INITIAL_CAPACITY)
+        self._open()
+
+    def _open(self):
+        self._map = num.memmap(self.path, num.uint8, 'r+')
+        if self._map.size < _HEADER.size:
+            raise HistoryError("%s: too short for a history" % self.path)
+        (magic, version, ncolumns, count, capacity) = _HEADER.unpack(
+            self._map[:_HEADER.size].tostring())
+        if magic != _MAGIC:
+            raise HistoryError("%s: not a history" % self.path)
+        if version != _VERSION or ncolumns != len(COLUMNS):
+            raise HistoryError("%s: history version %i, with %i columns"
+                               % (self.path, version, ncolumns))
+        (offsets, size) = _offsets(capacity)
+        if self._map.size < size or count > capacity:
+            raise HistoryError("%s: truncated history" % self.path)
+        self._count = count
+        self._capacity = capacity
+        self._columns = dict(
+            [(name, self._map[offsets[name]:offsets[name]
+                              + capacity * dtype.itemsize].view(dtype))
+             for (name, dtype) in _dtypes])
+
+    def __len__(self):
+        return self._count
+
+    def column(self, name):
+        """Returns the values of column name, as a read-only array"""
+        a = self._columns[name][:self._count]
+        a.flags.writeable = False
+        return a
+
+    def record(self, i):
+        """Returns record i as a dict of Python values"""
+        if not -self._count <= i < self._count:
+            raise IndexError("record %i of %i" % (i, self._count))
+        i %= self._count
+        return dict([(name, self._columns[name][i].item())
+                     for (name, dtype) in _dtypes])
+
+    def append(self, **values):
+        """
+        Adds a record with the given value of each column.  Missing values
+        are NaN, or 0 in the integer columns.
+        """
+        unknown = set(values) - set(self._columns)
+        if unknown:
+            raise KeyError("no column %s" % ", ".join(sorted(unknown)))
+        if self._count == self._capacity:
+            self._grow()
+        i = self._count
+        for (name, dtype) in _dtypes:
+            value = values.get(name)
+            if value is None:
+                value = 0 if dtype.kind == 'u' else float('nan')
+            self._columns[name][i] = value
+        self._count += 1
+        self._map[:_HEADER.size] = num.frombuffer(
+            _HEADER.pack(_MAGIC, _VERSION, len(COLUMNS), self._count,
+                         self._capacity), num.uint8)
+
+    def _grow(self):
+        capacity = max(INITIAL_CAPACITY,
+                       int(math.ceil(2.0 * self._capacity / _ALIGN)) * _ALIGN)
+        temp = self.path + '.new'
+        _create(temp, capacity)
+        (offsets, size) = _offsets(capacity)
+        new = num.memmap(temp, num.uint8, 'r+')
+        for (name, dtype) in _dtypes:
+            n = self._count * dtype.itemsize
+            new[offsets[name]:offsets[name] + n] = \
+                self._columns[name][:self._count].view(num.uint8)
+        new[:_HEADER.size] = num.frombuffer(
+            _HEADER.pack(_MAGIC, _VERSION, len(COLUMNS), self._count,
+                         capacity), num.uint8)
+        new.flush()
+        del new
+        self.close()
+        os.rename(temp, self.path)
+        self._open()
+
+    def flush(self):
+        """Writes the changes to disk"""
+        self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._columns = {}
+            self._map = None
+
+    def save(self, f):
+        """Writes the history to the open file f, as a single copy"""
+        self.flush()
+        source = open(self.path, 'rb')
+        shutil.copyfileobj(source, f)
+        source.close()
+
+
+def load(f, path):
+    """
+    Copies the history at the current position of the open file f, up to
+    its end, to path and returns it.  If f is at its end, the history at
+    path starts empty.
+    """
+    target = open(path, 'wb')
+    shutil.copyfileobj(f, target)
+    target.close()
+    return History(path)
@@ -0,0 +1,154 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Measures distances with measure_dt_seq from the command line, without
+Sugar, for scripted and long-running tests.  One computer runs
+
+    python measure.py server [options]
+
+and the other
+
+    python measure.py client HOST [options]
+
+with the same --count.  Each measurement is written to standard output as
+one line of JSON, with the time each phase took; a failure is written as
+a line with "error" and ends the run with status 1.
+"""
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+import arange
+
+PORT = 7357  # Default port of the server
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description="Measure the distance to another computer by sound.")
+    parser.add_argument('role', choices=('server', 'client'))
+    parser.add_argument('host', nargs='?', default='',
+                        help="the server to connect to, or the address to "
+                        "listen on (default all)")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--count', type=int, default=1,
+                        help="measurements to make (default 1)")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="pause (s) between measurements")
+    order = parser.add_mutually_exclusive_group()
+    order.add_argument('--order', type=int, default=None,
+                       help="MLS order (default %i)" % arange.MLS_INDEX)
+    order.add_argument('--adaptive', action='store_true',
+                       help="choose the MLS order from the signal quality")
+    parser.add_argument('--rate', type=int, default=arange.REC_HZ,
+                        help="sample rate (Hz, default %i)" % arange.REC_HZ)
+    parser.add_argument('--temperature', type=float, default=25.0,
+                        help="air temperature (C, default 25)")
+    parser.add_argument('--humidity', type=float, default=0.6,
+                        help="relative humidity (fraction, default 0.6)")
+    parser.add_argument('--pressure', type=float, default=101325.0,
+                        help="air pressure (Pa, default 101325)")
+    parser.add_argument('--co2', type=float, default=0.0004,
+                        help="mole fraction of CO2 (default 0.0004)")
+    parser.add_argument('--archive', metavar='DIR', default=None,
+                        help="keep the recordings in DIR for replay.py")
+    return parser
+
+
+def connect(options):
+    """Returns the socket connected to the peer, as the role in options"""
+    if options.role == 'client':
+        if not options.host:
+            raise SystemExit("the client needs the host of the server")
+        return socket.create_connection((options.host, options.port))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((options.host, options.port))
+    listener.listen(1)
+    (s, address) = listener.accept()
+    listener.close()
+    return s
+
+
+def record(seq, result, events, speed):
+    """
+    Returns the JSON record of measurement seq, given its result, the
+    PhaseTimer events of its rounds and the speed of sound
+    """
+    done = events[-1]
+    phases = {}
+    for event in events:
+        if event['previous'] is not None:
+            phases[event['previous']] = (phases.get(event['previous'], 0.0)
+                                         + event['duration'])
+    return {'seq': seq, 'role': done['role'], 'time': time.time(),
+            'dt': result, 'distance': result * speed - arange.OLPC_OFFSET,
+            'speed': speed, 'order': done['order'],
+            'rounds': len([e for e in events if e['phase'] == 'done']),
+            'psr': min(done['s_psr'], done['c_psr']), 'ppm': done['ppm'],
+            'peak_error': done['peak_error'], 'rtt': done['rtt'],
+            'phases': phases, 'elapsed': done['time'] - events[0]['time']}
+
+
+def run(s, am_server, options, audio=None, out=sys.stdout):
+    """
+    Makes options.count measurements with the peer connected to s and
+    writes their records to out.  Returns 0, or 1 after a failure.
+    """
+    channel = arange.as_channel(s)
+    speed = arange.speed_of_sound(options.temperature, options.humidity,
+                                  options.pressure, options.co2)
+    adaptive = arange.AdaptiveOrder() if options.adaptive else None
+    for seq in xrange(options.count):
+        if seq and options.interval:
+            time.sleep(options.interval)
+        events = []
+        try:
+            result = arange.measure_dt_seq(
+                channel, am_server, audio=audio, send_event=events.append,
+                order=options.order, adaptive=adaptive)
+        except (arange.ProtocolError, socket.error) as e:
+            out.write(json.dumps({'seq': seq, 'error': str(e)}) + '\n')
+            out.flush()
+            return 1
+        out.write(json.dumps(record(seq, result, events, speed),
+                             sort_keys=True) + '\n')
+        out.flush()
+    return 0
+
+
+def main(argv=None):
+    options = _parser().parse_args(argv)
+    arange.REC_HZ = options.rate
+    if options.archive:
+        arange.ARCHIVE_DIR = options.archive
+    # Keep standard output for the records, whatever else prints
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    s = connect(options)
+    try:
+        return run(s, options.role == 'server', options, out=out)
+    finally:
+        s.close()
+        arange.backend.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Works out archived measurements again (see archive.py) with variants of
+the signal processing, to compare them on real recordings.  Run as
+
+    python replay.py variants
+    python replay.py variant[,variant...] capture-or-directory...
+
+For each capture, prints for each variant how far the times this device
+measured move from the original (samples, the median over the rounds) and
+the distance (m) to each other device whose times are in the capture:
+the peer of measure_dt_seq and measure_dt_burst, and, in the scheduler's
+capture of measure_dt_matrix, all the others.  Then prints the median
+change and the median and spread of the distance between each pair of
+devices over all the captures.  Captures are opened one at a time, so
+there can be any number.
+"""
+
+import sys
+from collections import OrderedDict
+
+import numpy as num
+
+import archive
+import arange
+
+HIGHPASS_WIDTH = 31  # Samples in the moving average taken off by highpass
+
+
+def _fine(method):
+    def find(name, order, rec):
+        seq = arange._named_sequence(name, order)
+        return arange.mls_peak_fine(seq, rec, (name, order), method)
+    return find
+
+
+def _fft(name, order, rec):
+    return arange._find_peak(name, order, rec, use_fht=False)
+
+
+def highpass(rec, width=HIGHPASS_WIDTH):
+    """Returns rec less its moving average, which has no delay"""
+    return rec - num.convolve(rec, num.ones(width) / width, 'same')
+
+
+def _highpassed(find):
+    def find_highpassed(name, order, rec):
+        return find(name, order, highpass(rec).astype(arange.real_dtype()))
+    return find_highpassed
+
+
+# Each finds the _named_sequence name of the given order in a recording
+# and returns (peak, value, psr), as arange._find_peak
+VARIANTS = OrderedDict([
+    ('default', arange._find_peak),
+    ('fft', _fft),
+    ('sinc', _fine('sinc')),
+    ('parabolic', _fine('parabolic')),
+    ('gaussian', _fine('gaussian')),
+    ('integer', _fine(None)),
+    ('highpass', _highpassed(arange._find_peak)),
+])
+
+
+def _halves(capture, find, rec1, rec2):
+    """
+    Finds the server's sequence in rec1 and the client's in rec2, the two
+    halves of a round, and returns (s_peak, c_peak, ratio, psr), the peak
+    of the peer's sequence corrected for its clock, the ratio of the clocks
+    by _correct_drift and the worse psr
+    """
+    order = capture.order
+    rec1 = rec1.astype(arange.real_dtype())
+    rec2 = rec2.astype(arange.real_dtype())
+    (s_peak, s_value, s_psr) = find('mls', order, rec1)
+    (c_peak, c_value, c_psr) = find('mls_rev', order, rec2)
+    if capture.role == 'server':
+        (c_peak, ratio) = arange._correct_drift('mls_rev', order, rec2,
+                                                c_peak)
+    else:
+        (s_peak, ratio) = arange._correct_drift('mls', order, rec1, s_peak)
+    return (s_peak, c_peak, ratio, min(s_psr, c_psr))
+
+
+def _replay_seq(capture, find):
+    """replay of a measure_dt_seq round, as _measure_round works it out"""
+    (breaktime, old_dt, other_dt, ratio) = capture.values
+    (s_peak, c_peak, own_ratio, psr) = _halves(
+        capture, find, capture.slot(0), capture.slot(1))
+    dt = float((c_peak + capture.slots[1][0]) - s_peak) / capture.rate
+    if capture.role == 'server':
+        roundtrip = abs(dt - other_dt * ratio)
+    else:
+        roundtrip = abs(dt * ratio - other_dt)
+    return ((dt - old_dt) * capture.rate, {(0, 1): roundtrip / 2}, psr)
+
+
+def _replay_burst(capture, find):
+    """replay of a measure_dt_burst, as it works out its rounds"""
+    m = 3 * capture.rounds
+    (old, other) = (capture.values[:m], capture.values[m:])
+    mine = []
+    for k in xrange(capture.rounds):
+        (rec1, rec2) = (capture.slot(2 * k), capture.slot(2 * k + 1))
+        (s_peak, c_peak, ratio, psr) = _halves(capture, find, rec1, rec2)
+        mine.extend([float((c_peak + rec1.size) - s_peak) / capture.rate,
+                     psr, ratio])
+    (results, ratio, psr) = arange._burst_stats(capture.role == 'server',
+                                                mine, list(other))
+    change = num.median([mine[i] - old[i] for i in xrange(0, m, 3)])
+    return (change * capture.rate, {(0, 1): float(num.median(results))},
+            psr)
+
+
+def _replay_matrix(capture, find):
+    """replay of a measure_dt_matrix, as _slot_peaks finds the peaks"""
+    (index, n, rounds) = (capture.index, capture.n, capture.rounds)
+    m = rounds * n
+    rows = [list(capture.values[i:i + 3 * m])
+            for i in xrange(0, len(capture.values), 3 * m)]
+    old = rows[index] if len(rows) == n else rows[0]
+    peaks = []
+    for r in xrange(rounds):
+        found = []
+        for k in xrange(r * n, (r + 1) * n):
+            (first, end, device) = capture.slots[k]
+            rec = capture.slot(k).astype(arange.real_dtype())
+            (peak, value, psr) = find(device, capture.order, rec)
+            ratio = 1.0
+            if device != index:
+                (peak, ratio) = arange._correct_drift(device, capture.order,
+                                                      rec, peak)
+            found.append((float(first + peak) / capture.rate, psr, ratio,
+                          abs(value)))
+        peaks.append(found)
+    mine = arange._peaks_row(peaks)
+    change = num.median([mine[i] - old[i] for i in xrange(m)])
+    if len(rows) < n:
+        # A device only has its own times
+        psr = float(num.median([min(mine[m + r * n:m + (r + 1) * n])
+                                for r in xrange(rounds)]))
+        return (change * capture.rate, {}, psr)
+    rows[index] = mine
+    stats = arange._matrix_stats(rows, n, rounds)
+    results = dict([((index, j), stats['median'][index][j])
+                    for j in xrange(n) if j != index])
+    return (change * capture.rate, results, stats['psr'])
+
+
+_REPLAYS = {'seq': _replay_seq, 'burst': _replay_burst,
+            'matrix': _replay_matrix}
+
+
+def replay(capture, find):
+    """
+    Works out the measurement in capture again with find, one of
+    VARIANTS, and returns (change, results, psr): the median change in the
+    times this device measured (samples), the result, as the measurement
+    would have given it, for each (device, device) pair whose times are in
+    the capture, and the median worst psr
+    """
+    return _REPLAYS[capture.kind](capture, find)
+
+
+def main(names, paths):
+    finds = [VARIANTS[name] for name in names]
+    speed = arange.speed_of_sound()
+    # For each variant, the change in the times (samples) of every
+    # capture, and the distances (m) between each pair of devices
+    changes = [[] for name in names]
+    distances = [{} for name in names]
+    for capture in archive.captures(paths):
+        if capture.rate != arange.REC_HZ:
+            print "%s: recorded at %i Hz, not %i" % (capture.path,
+                                                     capture.rate,
+                                                     arange.REC_HZ)
+            continue
+        line = "%s %s %s %2i" % (capture.path, capture.kind, capture.role,
+                                 capture.order)
+        for (k, find) in enumerate(finds):
+            (change, results, psr) = replay(capture, find)
+            changes[k].append(change)
+            line += "  %s %+.2f" % (names[k], change)
+            for (pair, result) in sorted(results.items()):
+                distance = result * speed - arange.OLPC_OFFSET
+                distances[k].setdefault(pair, []).append(distance)
+                line += " %i-%i %.3f" % (pair + (distance,))
+        print line
+    if not changes[0]:
+        print "no captures"
+        return
+    for (k, name) in enumerate(names):
+        print ("%s: %i captures, median change %+.2f samples"
+               % (name, len(changes[k]), num.median(changes[k])))
+        for (pair, values) in sorted(distances[k].items()):
+            print ("  %i-%i: median distance %.3f m, spread %.3f m"
+                   % (pair + (num.median(values), num.std(values))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'variants':
+        print " ".join(VARIANTS)
+    elif len(sys.argv) >= 3:
+        names = sys.argv[1].split(',')
+        unknown = [name for name in names if name not in VARIANTS]
+        if unknown:
+            print "unknown variant %s; try %s" % (", ".join(unknown),
+                                                  " ".join(VARIANTS))
+            sys.exit(2)
+        main(names, sys.argv[2:])
+    else:
+        print __doc__
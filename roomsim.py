@@ -0,0 +1,274 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+A simulated room with two or more laptops, each with a speaker and a
+microphone, for running measurements on machines with no sound card.
+
+Sound is placed on a sample grid shared by all devices, counted from the
+creation of the room, so the propagation delays, impulse responses, device
+latencies and noise are reproducible for a given seed even though the
+measurement itself runs in real time.
+"""
+
+import math
+import socket
+import threading
+import time
+
+import numpy as num
+
+import arange
+
+
+def fractional_delay(d, taps=32):
+    """
+    Returns (n0, h): an impulse response h, starting at sample n0, that
+    delays a signal by d samples using a Hann-windowed sinc
+    """
+    n0 = int(math.floor(d)) - taps / 2 + 1
+    k = num.arange(n0, n0 + taps)
+    window = 0.5 + 0.5 * num.cos(math.pi * (k - d) / (taps / 2))
+    return (n0, num.sinc(k - d) * window)
+
+
+class Room(object):
+    """
+    Two virtual devices, separated by distance (m), in air at the given
+    temperature (C) and relative humidity (fraction).  For more devices,
+    positions gives the (x, y) position (m) of each instead.
+
+    speaker_ir and mic_ir are the impulse responses of each speaker and
+    microphone.  Each start of playback or recording is delayed by latency
+    plus a uniformly distributed jitter (s).  Each recording has Gaussian
+    noise of standard deviation noise, while full-scale playback arrives at
+    1 m with amplitude gain (int16 units).  self_distance is the distance
+    from each speaker to the microphone of the same device.  If drive is
+    set, each speaker distorts its output x to tanh(drive x) / drive.
+    ppm gives, for each device, how much faster (in parts per million)
+    its sample clock runs than the grid.
+    """
+
+    def __init__(self, distance=1.0, t=25.0, h=0.6,
+                 speaker_ir=(0.3, 1.0, 0.2, -0.4, -0.1), mic_ir=(1.0,),
+                 latency=0.02, jitter=0.01, noise=100.0, gain=2000.0,
+                 self_distance=-arange.OLPC_OFFSET, seed=0, positions=None,
+                 drive=None, ppm=None):
+        self.distance = distance
+        if positions is None:
+            positions = [(0.0, 0.0), (distance, 0.0)]
+        self.positions = num.asarray(positions, num.float)
+        self.speed = arange.speed_of_sound(t, h)
+        self.speaker_ir = num.asarray(speaker_ir, num.float)
+        self.mic_ir = num.asarray(mic_ir, num.float)
+        self.latency = latency
+        self.jitter = jitter
+        self.noise = noise
+        self.gain = gain
+        self.self_distance = self_distance
+        self.seed = seed
+        self.drive = drive
+        self._epoch = time.time()
+        # For each sound, the (grid index, samples) heard by each device
+        self._sounds = []
+        self._lock = threading.Lock()
+        if ppm is None:
+            ppm = [0.0] * len(self.positions)
+        self.devices = [SimulatedDevice(self, i, ppm[i])
+                        for i in xrange(len(self.positions))]
+
+    def now(self):
+        """Returns the current position on the sample grid"""
+        return int((time.time() - self._epoch) * arange.REC_HZ)
+
+    def path_distance(self, i, j):
+        if i == j:
+            return self.self_distance
+        return float(num.hypot(*(self.positions[i] - self.positions[j])))
+
+    def emit(self, emitter, delay, signal):
+        """
+        Plays signal from device emitter, starting delay samples from now,
+        and works out what each device will hear of it.  Now is taken once
+        the sound is ready, so that no recording can have gone past it.
+        """
+        heard = []
+        sound = num.convolve(signal, self.speaker_ir)
+        if self.drive:
+            sound = num.tanh(self.drive * sound) / self.drive
+        for listener in xrange(len(self.devices)):
+            r = self.path_distance(emitter, listener)
+            (n0, h) = fractional_delay(r / self.speed * arange.REC_HZ)
+            h = num.convolve(h, self.mic_ir)
+            x = num.convolve(sound, h) * (self.gain / max(r, 0.1))
+            heard.append((n0, x))
+        with self._lock:
+            start = self.now() + delay
+            self._sounds.append([(start + i, y) for (i, y) in heard])
+
+    def render(self, listener, start, n, rng=None):
+        """
+        Returns the n samples heard by device listener from grid index
+        start, as floats, with noise drawn from rng if given
+        """
+        if rng is None:
+            out = num.zeros(n)
+        else:
+            out = rng.normal(0, self.noise, n)
+        with self._lock:
+            sounds = [heard[listener] for heard in self._sounds]
+        for (first, x) in sounds:
+            lo = max(start, first)
+            hi = min(start + n, first + x.size)
+            if hi > lo:
+                out[lo - start:hi - start] += x[lo - first:hi - first]
+        return out
+
+
+class SimulatedRecording(object):
+    """A recording made by a SimulatedDevice"""
+
+    def __init__(self, device, start, rng):
+        self._device = device
+        self._start = start
+        self._next = start
+        self._count = 0  # Samples recorded at the device's clock
+        self._stop = None
+        self._rng = rng
+
+    def _until(self, end):
+        rate = self._device.rate
+        if rate == 1:
+            n = max(0, end - self._next)
+            x = self._device.room.render(self._device.index, self._next, n,
+                                         self._rng)
+            self._next += n
+        else:
+            # Sample k of the device's clock falls at grid index
+            # start + k / rate; render and resample what lies before end
+            taps = 16
+            count = int(math.floor((end - taps - self._start) * rate))
+            n = max(0, count - self._count)
+            first = self._start + self._count / rate
+            lo = int(math.floor(first)) - taps
+            hi = int(math.ceil(first + n / rate)) + taps + 1
+            grid = self._device.room.render(self._device.index, lo, hi - lo)
+            x = arange.resample(grid, 1 / rate, n, first - lo, taps)
+            x = x + self._rng.normal(0, self._device.room.noise, n)
+            self._count += n
+        return num.clip(num.round(x), -32768, 32767).astype(num.int16)
+
+    def read_available(self):
+        end = self._device.room.now()
+        if self._stop is not None:
+            end = min(end, self._stop)
+        return self._until(end)
+
+    def read(self, dtype=None):
+        if self._stop is None:
+            a = self.read_available()
+        else:
+            a = self._until(self._stop)
+        if dtype is not None:
+            return a.astype(dtype)
+        return a
+
+    def close(self):
+        pass
+
+
+class SimulatedDevice(arange.AudioBackend):
+    """One of the laptops in a Room, used as an audio backend"""
+
+    def __init__(self, room, index, ppm=0.0):
+        self.room = room
+        self.index = index
+        self.rate = 1 + ppm * 1e-6  # Device samples per grid sample
+        # Separate streams, so that the noise does not depend on timing
+        self._latency_rng = num.random.RandomState((room.seed, index, 0))
+        self._noise_seed = (room.seed, index, 1)
+        self._recordings = 0
+
+    def _delay(self):
+        return int((self.room.latency
+                    + self._latency_rng.uniform(0, self.room.jitter))
+                   * arange.REC_HZ)
+
+    def play(self, frames):
+        left = num.frombuffer(frames, num.uint8)[::2]
+        signal = (left.astype(num.float) - 128) / 128
+        if self.rate != 1:
+            signal = arange.resample(signal, self.rate).astype(num.float)
+        delay = self._delay()
+        self.room.emit(self.index, delay, signal)
+        time.sleep(float(delay + signal.size) / arange.REC_HZ)
+
+    def start_recording(self):
+        delay = self._delay()
+        rng = num.random.RandomState(self._noise_seed + (self._recordings,))
+        self._recordings += 1
+        time.sleep(float(delay) / arange.REC_HZ)
+        return SimulatedRecording(self, self.room.now(), rng)
+
+    def stop_recording(self, recording):
+        recording._stop = self.room.now()
+
+
+def run_pair(room, measure=arange.measure_dt_seq):
+    """
+    Runs the server and client roles of measure (measure_dt_seq by
+    default) against each other over a socketpair, with the two devices of
+    room, and returns the (server, client) results
+    """
+    (server_socket, client_socket) = socket.socketpair()
+    results = [None, None]
+
+    def client():
+        results[1] = measure(client_socket, False, audio=room.devices[1])
+
+    helper = threading.Thread(target=client)
+    helper.start()
+    results[0] = measure(server_socket, True, audio=room.devices[0])
+    helper.join()
+    server_socket.close()
+    client_socket.close()
+    return tuple(results)
+
+
+def run_group(room, measure=arange.measure_dt_matrix, **kwargs):
+    """
+    Runs measure (measure_dt_matrix by default) with device 0 of room as
+    the scheduler and the others connected to it over socketpairs, and
+    returns the result of each device.  kwargs are passed to the scheduler.
+    """
+    pairs = [socket.socketpair() for i in xrange(len(room.devices) - 1)]
+    results = [None] * len(room.devices)
+
+    def device(i):
+        results[i] = measure(pairs[i - 1][1], False, audio=room.devices[i])
+
+    helpers = [threading.Thread(target=device, args=(i,))
+               for i in xrange(1, len(room.devices))]
+    for helper in helpers:
+        helper.start()
+    results[0] = measure([p[0] for p in pairs], True, audio=room.devices[0],
+                         **kwargs)
+    for helper in helpers:
+        helper.join()
+    for p in pairs:
+        p[0].close()
+        p[1].close()
+    return results
@@ -0,0 +1,106 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import unittest
+
+import numpy as num
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import arange
+
+ORDERS = range(5, 15)
+
+
+def periodic_correlation(a, b):
+    """
+    Returns the periodic correlation of binary sequences a and b, as +1
+    and -1, at every lag
+    """
+    fa = num.fft.rfft(1 - 2 * num.asarray(a, num.float))
+    fb = num.fft.rfft(1 - 2 * num.asarray(b, num.float))
+    return num.rint(num.fft.irfft(num.conjugate(fa) * fb, len(a)))
+
+
+class CodesTest(unittest.TestCase):
+
+    def test_lfsr_blocks(self):
+        for order in (3, 7, 12):
+            taps = [i - 1 for i in arange.MLS_TAPS[order]]
+            m = 2**order - 1
+            self.assertEqual(
+                list(arange.LFSR_blocks(num.zeros((order)) == 0, taps, m)),
+                list(arange.LFSR(num.zeros((order)) == 0, taps, m)))
+
+    def test_mls(self):
+        # An m-sequence correlates to -1 with itself at every other lag
+        for order in ORDERS:
+            (mls, mls_rev) = arange._sequences(order)
+            self.assertEqual(mls.size, 2**order - 1)
+            c = periodic_correlation(mls, mls)
+            self.assertEqual(c[0], mls.size)
+            self.assertTrue((c[1:] == -1).all(), order)
+
+    def test_simul_bound(self):
+        for order in ORDERS:
+            (mls, code) = arange.simul_codes(order)
+            self.assertEqual(code.size, mls.size)
+            if order % 2:
+                bound = 1 + 2**((order + 1) / 2)
+            else:
+                bound = 1 + 2**(order / 2)
+            c = periodic_correlation(mls, code)
+            self.assertTrue(abs(c).max() <= bound,
+                            "order %i: %i > %i" % (order, abs(c).max(),
+                                                   bound))
+
+    def test_gold_values(self):
+        # A preferred pair takes only the values -1, -t and t - 2
+        for order in (5, 7, 9, 11, 13):
+            (mls, code) = arange.simul_codes(order)
+            t = 1 + 2**((order + 1) / 2)
+            values = set(periodic_correlation(mls, code))
+            self.assertTrue(values <= set([-1, -t, t - 2]), order)
+
+    def test_kasami_values(self):
+        # The small Kasami code correlates with the m-sequence to -1, -s or
+        # s - 2 at every lag
+        for order in (6, 8, 10, 12, 14):
+            (mls, code) = arange.simul_codes(order)
+            s = 1 + 2**(order / 2)
+            values = set(periodic_correlation(mls, code))
+            self.assertTrue(values <= set([-1, -s, s - 2]), order)
+
+    def test_device_sequences(self):
+        order = 11
+        seqs = [arange.device_sequence(k, order) for k in xrange(6)]
+        self.assertTrue((seqs[0] == arange._sequences(order)[0]).all())
+        self.assertTrue((seqs[1] == arange._sequences(order)[1]).all())
+        for seq in seqs:
+            c = periodic_correlation(seq, seq)
+            self.assertTrue((c[1:] == -1).all())
+        # No two are shifts of each other
+        for i in xrange(len(seqs)):
+            for j in xrange(i):
+                c = periodic_correlation(seqs[i], seqs[j])
+                self.assertTrue(abs(c).max() < seqs[i].size / 4, (i, j))
+
+
+if __name__ == '__main__':
+    unittest.main()
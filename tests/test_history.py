@@ -0,0 +1,120 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import history
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append(self):
+        h = history.History(self.path)
+        self.assertEqual(len(h), 0)
+        h.append(time=1.5, dt=0.01, distance=3.25, rounds=8, order=12,
+                 devices=2, device=0, peer=1)
+        h.append(time=2.5, psr=40.0)
+        self.assertEqual(len(h), 2)
+        r = h.record(0)
+        self.assertEqual(r['distance'], 3.25)
+        self.assertEqual((r['rounds'], r['order'], r['peer']), (8, 12, 1))
+        self.assertTrue(math.isnan(r['psr']))
+        self.assertEqual(h.record(-1)['psr'], 40.0)
+        self.assertEqual(h.record(-1)['rounds'], 0)
+        self.assertEqual(list(h.column('time')), [1.5, 2.5])
+        self.assertRaises(IndexError, h.record, 2)
+        self.assertRaises(KeyError, h.append, height=1.0)
+        h.close()
+
+    def test_grow(self):
+        h = history.History(self.path)
+        n = history.INITIAL_CAPACITY * 2 + 1
+        for i in xrange(n):
+            h.append(time=float(i), devices=i % 256)
+        self.assertEqual(len(h), n)
+        self.assertEqual(list(h.column('time')), map(float, xrange(n)))
+        self.assertEqual(h.record(n - 1)['devices'], (n - 1) % 256)
+        h.close()
+        self.assertFalse(os.path.exists(self.path + '.new'))
+
+    def test_reopen(self):
+        h = history.History(self.path)
+        for i in xrange(history.INITIAL_CAPACITY + 3):
+            h.append(time=float(i), distance=i / 10.0)
+        h.close()
+        h = history.History(self.path)
+        self.assertEqual(len(h), history.INITIAL_CAPACITY + 3)
+        self.assertEqual(h.record(-1)['distance'],
+                         (history.INITIAL_CAPACITY + 2) / 10.0)
+        h.append(time=-1.0)
+        self.assertEqual(h.record(-1)['time'], -1.0)
+        h.close()
+
+    def test_save_load(self):
+        h = history.History(self.path)
+        h.append(time=7.0, ppm=-12.5)
+        copy = os.path.join(self.dir, 'copy')
+        f = open(copy, 'wb')
+        f.write('journal data')
+        h.save(f)
+        f.close()
+        h.close()
+        f = open(copy, 'rb')
+        f.seek(len('journal data'))
+        loaded = history.load(f, os.path.join(self.dir, 'loaded'))
+        f.close()
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(loaded.record(0)['ppm'], -12.5)
+        loaded.close()
+
+    def test_truncated(self):
+        h = history.History(self.path)
+        h.append(time=1.0)
+        h.close()
+        size = os.path.getsize(self.path)
+        f = open(self.path, 'r+b')
+        f.truncate(size - 1)
+        f.close()
+        self.assertRaises(history.HistoryError, history.History, self.path)
+        f = open(self.path, 'r+b')
+        f.truncate(10)
+        f.close()
+        self.assertRaises(history.HistoryError, history.History, self.path)
+
+    def test_not_a_history(self):
+        f = open(self.path, 'wb')
+        f.write('x' * 100)
+        f.close()
+        self.assertRaises(history.HistoryError, history.History, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+# Copyright 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import arange
+import engine
+
+
+def _raw(number, payload, version=arange.PROTOCOL_VERSION):
+    """Returns the bytes of a message of type number, as a peer sends it"""
+    return arange._HEADER.pack(arange._MAGIC, version, number, len(payload),
+                               1.0, 0.0, 0.0) + payload
+
+
+class ChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.a, self.b) = socket.socketpair()
+        self.ca = arange.Channel(self.a)
+        self.cb = arange.Channel(self.b)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_round_trip(self):
+        self.ca.send('hello', arange.PROTOCOL_VERSION, arange.REC_HZ, 14)
+        self.assertEqual(self.cb.recv('hello'),
+                         (arange.PROTOCOL_VERSION, arange.REC_HZ, 14))
+        self.ca.send('dt', 0.0125)
+        self.assertEqual(self.cb.recv('dt'), (0.0125,))
+        self.ca.send('started')
+        self.assertEqual(self.cb.recv('started'), ())
+        values = [0.01, 40.0, 1.00002, 0.011, 38.5, 0.99998]
+        self.cb.send('results', *values)
+        self.assertEqual(list(self.ca.recv('results')), values)
+        self.cb.send('results')
+        self.assertEqual(self.ca.recv('results'), ())
+
+    def test_every_message(self):
+        for (name, (number, fmt)) in sorted(arange.MESSAGES.items()):
+            fields = fmt[1:].rstrip('*')
+            values = [{'d': 0.5, 'B': 7, 'H': 300, 'I': 70000}[c]
+                      for c in fields]
+            self.ca.send(name, *values)
+            self.assertEqual(list(self.cb.recv(name)), values, name)
+
+    def test_rtt(self):
+        self.assertEqual(self.ca.rtt, None)
+        thread = threading.Thread(
+            target=lambda: self.cb.send('dt', self.cb.recv('dt')[0]))
+        thread.start()
+        self.assertEqual(self.ca.exchange('dt', 1.0), (1.0,))
+        thread.join()
+        self.assertTrue(self.ca.rtt >= 0)
+
+    def test_wrong_type(self):
+        self.ca.send('stop')
+        self.assertRaises(arange.ProtocolError, self.cb.recv, 'dt')
+
+    def test_unknown_type_skipped(self):
+        self.a.sendall(_raw(200, 'from a newer version'))
+        self.ca.send('turn', 3)
+        self.assertEqual(self.cb.recv('turn'), (3,))
+
+    def test_longer_payload(self):
+        # A newer peer may append fields
+        self.a.sendall(_raw(arange.MESSAGES['turn'][0],
+                            struct.pack('!Id', 5, 2.5)))
+        self.assertEqual(self.cb.recv('turn'), (5,))
+
+    def test_short_payload(self):
+        self.a.sendall(_raw(arange.MESSAGES['dt'][0], 'abc'))
+        self.assertRaises(arange.ProtocolError, self.cb.recv, 'dt')
+
+    def test_not_a_message(self):
+        self.a.sendall('GET / HTTP/1.0\r\n\r\n' + '\0' * 40)
+        self.assertRaises(arange.ProtocolError, self.cb.recv, 'hello')
+
+    def test_old_text_protocol(self):
+        for command in ('ready', 'start recording', 'your turn'):
+            (a, b) = socket.socketpair()
+            a.sendall(command)
+            try:
+                arange.Channel(b).recv('hello')
+            except arange.ProtocolError as e:
+                self.assertEqual(str(e), "peer runs the old text protocol")
+            else:
+                self.fail("no error for %r" % command)
+            a.close()
+            b.close()
+
+    def test_closed(self):
+        self.a.close()
+        self.assertRaises(arange.PeerClosed, self.cb.recv, 'hello')
+
+
+class HandshakeTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.a, self.b) = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def _server(self, result, **kwargs):
+        def run():
+            try:
+                result.append(arange._handshake(arange.Channel(self.a), True,
+                                                12, **kwargs))
+            except arange.ProtocolError as e:
+                result.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_agree(self):
+        result = []
+        thread = self._server(result)
+        channel = arange.Channel(self.b)
+        self.assertEqual(arange._handshake(channel, False, 14), 12)
+        thread.join()
+        self.assertEqual(result, [12])
+        self.assertEqual(channel.mode, arange.MODE_PAIR)
+        self.assertEqual(channel.version, arange.PROTOCOL_VERSION)
+
+    def test_mode(self):
+        result = []
+        thread = self._server(result, mode=arange.MODE_MATRIX)
+        self.assertRaises(arange.ProtocolError, arange._handshake,
+                          arange.Channel(self.b), False, 12)
+        thread.join()
+
+    def test_any_mode(self):
+        result = []
+        thread = self._server(result, mode=arange.MODE_MATRIX)
+        channel = arange.Channel(self.b)
+        arange._handshake(channel, False, 12, mode=None)
+        thread.join()
+        self.assertEqual(channel.mode, arange.MODE_MATRIX)
+
+    def test_old_version(self):
+        result = []
+        thread = self._server(result)
+        arange.Channel(self.b).send('hello', arange.MIN_PROTOCOL_VERSION - 1,
+                                    arange.REC_HZ, 12)
+        thread.join()
+        self.assertTrue(isinstance(result[0], arange.ProtocolError))
+        self.assertTrue('version' in str(result[0]))
+
+    def test_newer_version(self):
+        result = []
+        thread = self._server(result)
+        channel = arange.Channel(self.b)
+        channel.send('hello', arange.PROTOCOL_VERSION + 1, arange.REC_HZ, 12)
+        self.assertEqual(channel.recv('start')[0], arange.PROTOCOL_VERSION)
+        thread.join()
+
+    def test_rate(self):
+        result = []
+        thread = self._server(result)
+        arange.Channel(self.b).send('hello', arange.PROTOCOL_VERSION,
+                                    arange.REC_HZ + 1, 12)
+        thread.join()
+        self.assertTrue(isinstance(result[0], arange.ProtocolError))
+
+
+class AsyncChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = engine.Loop()
+        (self.a, self.b) = socket.socketpair()
+        self.ca = engine.AsyncChannel(self.loop, self.a, timeout=1.0)
+        self.cb = engine.AsyncChannel(self.loop, self.b, timeout=1.0)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_round_trip(self):
+        values = [0.25] * 1000
+        result = self.loop.run_until_complete([
+            self.ca.send('peaks', *values), self.cb.recv('peaks')])
+        self.assertEqual(list(result[1]), values)
+        self.assertTrue(self.cb.alive())
+
+    def test_handshake(self):
+        result = self.loop.run_until_complete([
+            engine.handshake(self.ca, True, 12, mode=arange.MODE_MATRIX),
+            engine.handshake(self.cb, False, 14, mode=None)])
+        self.assertEqual(result, [12, 12])
+        self.assertEqual(self.cb.mode, arange.MODE_MATRIX)
+
+    def test_old_text_protocol(self):
+        self.a.sendall('ready')
+        try:
+            self.loop.run_until_complete(self.cb.recv('hello'))
+        except arange.ProtocolError as e:
+            self.assertEqual(str(e), "peer runs the old text protocol")
+        else:
+            self.fail("no error")
+        self.assertFalse(self.cb.alive())
+
+    def test_timeout(self):
+        self.assertRaises(engine.Timeout, self.loop.run_until_complete,
+                          self.cb.recv('dt', 0.05))
+        self.assertTrue(self.cb.alive())
+
+    def test_closed(self):
+        self.a.close()
+        self.assertFalse(self.cb.alive())
+        self.assertRaises(arange.PeerClosed, self.loop.run_until_complete,
+                          self.cb.recv('dt'))
+
+
+if __name__ == '__main__':
+    unittest.main()